@@ -0,0 +1,479 @@
+"""
+Backfill / reconcile from Stripe after downtime or exhausted webhook retries.
+
+    python backfill.py --since 2026-10-01 [--until 2026-10-05] [--dry-run]
+
+Pages stripe.Event.list for the handled event types in [since, until) and
+stripe.Subscription.list, then works out the end state the webhook would have
+reached -- each event goes through stripe_events.decide(), the webhook's own
+rules, fed from the listed subscriptions instead of one Subscription.retrieve
+per event -- and applies it with multi-row writes in a handful of transactions:
+
+  * veil_subscriptions: each guild's actions folded oldest first over its
+    current row, then every active subscription Stripe lists now is written
+    over that; only rows that differ are touched,
+  * event_watermarks (EVENT_ORDERING): events are ordered against the
+    watermarks the webhook left, so one older than what a guild already has is
+    stale here too, and the watermarks move with the rows,
+  * coin packs from checkout sessions nobody credited yet,
+  * tier bonuses, recorded with the webhook's grant keys so none is paid twice.
+
+Applied events are recorded -- in webhook_inbox as `done` with WEBHOOK_INBOX,
+so a late Stripe retry is not queued again, otherwise in backfill_events --
+and events already recorded in either (or queued for the inbox workers) are
+skipped, so a rerun over the same range changes nothing. --dry-run prints the
+diff and writes nothing.
+
+A coin pack is only credited when it is provably unpaid: its session has no
+coin_purchase_credits row (written with every credit since that table was
+added) and, for older credits, with WEBHOOK_INBOX every received event is in
+webhook_inbox, with COIN_LEDGER every credit is in coin_ledger. Without either
+the candidates are listed and skipped unless --credit-coins is given. Superseded subscriptions that the webhook would have
+cancelled (two active subscriptions for one guild) are reported, not cancelled.
+
+Stripe keeps events for 30 days.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+import stripe
+from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+
+load_dotenv()
+
+# imported after load_dotenv so their env settings are visible
+import bonus_engine
+import coin_ledger
+import event_order
+import inbox
+from db_pool import get_db_conn
+from event_order import EVENT_ORDERING, UNORDERED, stripe_shard, turn
+from stripe_events import HANDLED_TYPES, Cancel, CoinPack, PaymentFailed, SetTier, decide, next_row, renews_at
+from subscription_cache import observe_event, snapshot_from_subscription, subscription_cache
+from support_relay import relay_line
+from webhook_common import bonus_amounts, coin_topup_line, tier_map, to_int_or_none, upgrade_line
+
+stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+stripe.api_base = os.getenv("STRIPE_API_BASE", stripe.api_base)
+
+BACKFILL_CHUNK = int(os.getenv("BACKFILL_CHUNK", "1000"))  # rows per transaction
+
+ACTIVE_STATUSES = ("active", "trialing")
+
+# events applied by a run without WEBHOOK_INBOX (with it they go to webhook_inbox)
+SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS backfill_events (
+        event_id   TEXT PRIMARY KEY,
+        event_type TEXT NOT NULL,
+        applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+"""
+
+
+def _chunks(rows, size=BACKFILL_CHUNK):
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
+
+
+def ensure_schema():
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute(SCHEMA_SQL)
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Stripe
+# ─────────────────────────────────────────────────────────────────────────────
+
+def fetch_subscriptions() -> list:
+    """Every subscription Stripe lists as current, newest first; primes the snapshot cache."""
+    # hold all of them, so invoice events never fall back to Subscription.retrieve
+    subscription_cache.maxsize = max(subscription_cache.maxsize, 1_000_000)
+    subs = []
+    for sub in stripe.Subscription.list(limit=100).auto_paging_iter():
+        snap = snapshot_from_subscription(sub)
+        subscription_cache.put(snap)
+        subs.append(dict(snap, status=sub.get("status")))
+    return subs
+
+
+def fetch_events(since: int, until: int) -> list:
+    """Handled events created in [since, until), oldest first."""
+    events = stripe.Event.list(created={"gte": since, "lt": until}, types=list(HANDLED_TYPES), limit=100)
+    return sorted(events.auto_paging_iter(), key=lambda e: (e["created"], e["id"]))
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Plan
+# ─────────────────────────────────────────────────────────────────────────────
+
+class Plan:
+    def __init__(self):
+        self.actions = {}       # guild_id -> [SetTier / PaymentFailed / Cancel], oldest first
+        self.watermarks = {}    # guild_id -> (shard, created, event_id) of the newest event applied
+        self.coins = []         # (event, user_id, guild_id, coins, session_id)
+        self.grants = []        # (grant_key, guild_id, amount)
+        self.conflicts = []     # (guild_id, kept subscription, other active subscription)
+        self.failed = {}        # event_id -> error; left unmarked for the next run
+        self.ignored = Counter()
+
+    def apply(self, action):
+        self.actions.setdefault(int(action.guild_id), []).append(action)
+
+    def grant(self, grant_key, guild_id, tier):
+        # ⛔ Elite gets no coin bonus
+        if bonus_amounts.get(tier):
+            self.grants.append((grant_key, int(guild_id), bonus_amounts[tier]))
+
+
+def plan_event(plan: Plan, event, seen_watermarks: dict):
+    """
+    Fold one event into the plan: what stripe_events.decide() returns for it,
+    ordered against the guild's watermark (`seen_watermarks`: shard -> created
+    in event_watermarks before the run), as process_stripe_event_in_order would.
+    """
+    try:
+        _plan_event(plan, event, seen_watermarks)
+    except Exception as e:  # e.g. a Subscription.retrieve for a cancelled subscription failing
+        plan.failed[event["id"]] = str(e)
+
+
+def _plan_event(plan: Plan, event, seen_watermarks: dict):
+    shard, ordered = stripe_shard(event)
+    t = UNORDERED
+    if ordered and EVENT_ORDERING:
+        guild_id = int(shard.split(":", 1)[1])
+        applied = plan.watermarks.get(guild_id)
+        t = turn(shard, event["created"], event["id"], applied[1] if applied else seen_watermarks.get(shard, 0))
+
+    action = decide(event, t)
+    if isinstance(action, CoinPack):
+        plan.coins.append((event, *action))
+        return
+    if not isinstance(action, (SetTier, PaymentFailed, Cancel)):  # None, or Invalid
+        plan.ignored[event["type"]] += 1
+        return
+
+    plan.apply(action)
+    if isinstance(action, SetTier):
+        plan.grant(action.grant_key, action.guild_id, action.tier)
+    if t.previous is not None and not t.stale:  # event_order.advance
+        plan.watermarks[int(action.guild_id)] = (t.shard, t.created, t.event_id)
+
+
+def plan_subscriptions(plan: Plan, subs: list):
+    """Write every currently active subscription over whatever the events said."""
+    seen = {}
+    for sub in subs:
+        guild_id = to_int_or_none(sub["guild_id"])
+        tier = tier_map.get(sub["price_id"])
+        if sub["status"] not in ACTIVE_STATUSES or not (guild_id and tier):
+            continue
+        if guild_id in seen:  # listed newest first: the first one is the upgrade
+            plan.conflicts.append((guild_id, seen[guild_id], sub["id"]))
+            continue
+        seen[guild_id] = sub["id"]
+        plan.apply(SetTier(guild_id, tier, renews_at(sub["current_period_end"]), sub["id"], None, True, False))
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Database
+# ─────────────────────────────────────────────────────────────────────────────
+
+def already_applied(event_ids) -> set:
+    """Events a backfill or the inbox has applied or queued (a `failed` inbox row is fair game)."""
+    seen = set()
+    with get_db_conn() as conn, conn.cursor() as cur:
+        for chunk in _chunks(list(event_ids), 10000):
+            cur.execute("SELECT event_id FROM backfill_events WHERE event_id = ANY(%s)", (chunk,))
+            seen.update(r[0] for r in cur.fetchall())
+            if inbox.INBOX_ENABLED:
+                cur.execute("""
+                    SELECT event_id FROM webhook_inbox
+                     WHERE event_id = ANY(%s) AND status <> 'failed'
+                """, (chunk,))
+                seen.update(r[0] for r in cur.fetchall())
+    return seen
+
+
+def seen_watermarks(shards) -> dict:
+    """shard -> created, for the shards the webhook has applied events to."""
+    marks = {}
+    with get_db_conn() as conn, conn.cursor() as cur:
+        for chunk in _chunks(list(shards), 10000):
+            cur.execute("SELECT shard, created FROM event_watermarks WHERE shard = ANY(%s)", (chunk,))
+            marks.update(cur.fetchall())
+    return marks
+
+
+def credited_sessions(session_ids) -> set:
+    """Checkout sessions already credited: in coin_purchase_credits, or (older credits) in coin_ledger."""
+    session_ids = list(session_ids)
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("SELECT stripe_session_id FROM coin_purchase_credits WHERE stripe_session_id = ANY(%s)",
+                    (session_ids,))
+        credited = {r[0] for r in cur.fetchall()}
+        if coin_ledger.COIN_LEDGER_ENABLED:
+            cur.execute("""
+                SELECT DISTINCT ref FROM coin_ledger
+                 WHERE reason = 'coin_purchase' AND ref = ANY(%s)
+            """, (session_ids,))
+            credited.update(r[0] for r in cur.fetchall())
+    return credited
+
+
+def current_rows(guild_ids) -> dict:
+    rows = {}
+    with get_db_conn() as conn, conn.cursor() as cur:
+        for chunk in _chunks(list(guild_ids), 10000):
+            cur.execute("""
+                SELECT guild_id, tier, renews_at, subscription_id, payment_failed
+                  FROM veil_subscriptions
+                 WHERE guild_id = ANY(%s)
+            """, (chunk,))
+            rows.update((r[0], r[1:]) for r in cur.fetchall())
+    return rows
+
+
+_KINDS = {SetTier: "upsert", PaymentFailed: "payment_failed", Cancel: "canceled"}
+
+
+def diff(plan: Plan) -> list:
+    """[(guild_id, kind, current row or None, target row)] for the guilds that would change."""
+    current = current_rows(plan.actions)
+    changes = []
+    for guild_id, actions in sorted(plan.actions.items()):
+        cur = current.get(guild_id)
+        target = tuple(cur) if cur is not None else None
+        for action in actions:
+            target = next_row(target, action)
+        if target is not None and (cur is None or tuple(cur) != target):
+            changes.append((guild_id, _KINDS[type(actions[-1])], cur, target))
+    return changes
+
+
+def write_subscriptions(changes, watermarks: dict):
+    """
+    Upsert the target rows (failures / cancellations only ever reach guilds that
+    have one) and move the guilds' watermarks in the same transaction, a chunk
+    of guilds at a time.
+    """
+    rows = {guild_id: target for guild_id, _, _, target in changes}
+    for chunk in _chunks(sorted(set(rows) | set(watermarks))):
+        upserts = [(guild_id, *rows[guild_id]) for guild_id in chunk if guild_id in rows]
+        marks = [watermarks[guild_id] for guild_id in chunk if guild_id in watermarks]
+        with get_db_conn() as conn, conn.cursor() as cur:
+            if upserts:
+                _upsert_subscriptions(cur, upserts)
+            if marks:
+                # event_order.ADVANCE, a row per guild
+                execute_values(cur, """
+                    INSERT INTO event_watermarks AS w (shard, created, event_id)
+                    VALUES %s
+                    ON CONFLICT (shard) DO UPDATE
+                        SET created = EXCLUDED.created,
+                            event_id = EXCLUDED.event_id,
+                            updated_at = NOW()
+                      WHERE w.created <= EXCLUDED.created
+                """, marks, page_size=len(marks))
+
+
+def _upsert_subscriptions(cur, rows):
+    execute_values(cur, """
+        INSERT INTO veil_subscriptions (guild_id, tier, renews_at, subscription_id, payment_failed, subscribed_at)
+        VALUES %s
+        ON CONFLICT (guild_id) DO UPDATE
+        SET tier = EXCLUDED.tier,
+            subscribed_at = NOW(),
+            renews_at = EXCLUDED.renews_at,
+            subscription_id = EXCLUDED.subscription_id,
+            payment_failed = EXCLUDED.payment_failed
+    """, rows, template="(%s, %s, %s, %s, %s, NOW())", page_size=len(rows))
+
+
+def _mark_done(cur, events):
+    if not inbox.INBOX_ENABLED:
+        execute_values(cur, """
+            INSERT INTO backfill_events (event_id, event_type)
+            VALUES %s
+            ON CONFLICT (event_id) DO NOTHING
+        """, [(e["id"], e["type"]) for e in events], page_size=len(events) or 1)
+        return
+    execute_values(cur, """
+        INSERT INTO webhook_inbox (event_id, source, event_type, payload, status, processed_at)
+        VALUES %s
+        ON CONFLICT (event_id) DO UPDATE
+           SET status = 'done', processed_at = NOW(), last_error = NULL
+    """, [(e["id"], "stripe", e["type"], json.dumps(e)) for e in events],
+        template="(%s, %s, %s, %s::jsonb, 'done', NOW())", page_size=len(events) or 1)
+
+
+def credit_coins(credits):
+    """
+    Credit coin packs and mark their events done in the same transaction, a
+    chunk at a time. A session the webhook credits meanwhile has its
+    coin_purchase_credits row already and is skipped.
+    """
+    for chunk in _chunks(credits):
+        with get_db_conn() as conn, conn.cursor() as cur:
+            claimed = {r[0] for r in execute_values(cur, """
+                INSERT INTO coin_purchase_credits (stripe_session_id, user_id, guild_id, coins)
+                VALUES %s
+                ON CONFLICT (stripe_session_id) DO NOTHING
+             RETURNING stripe_session_id
+            """, [(s, u, g, c) for _, u, g, c, s in chunk], page_size=len(chunk), fetch=True)}
+            events = [e for e, *_ in chunk]
+            fresh = []
+            for c in chunk:
+                if c[4] in claimed:  # once per session, even if two events carry it
+                    claimed.discard(c[4])
+                    fresh.append(c)
+            chunk = fresh
+            if coin_ledger.COIN_LEDGER_ENABLED:
+                execute_values(cur, """
+                    INSERT INTO coin_ledger (user_id, guild_id, delta, reason, ref)
+                    VALUES %s
+                """, [(u, g, c, s) for _, u, g, c, s in chunk],
+                    template="(%s, %s, %s, 'coin_purchase', %s)", page_size=len(chunk))
+            else:
+                # one row per member: ON CONFLICT cannot touch the same row twice in a statement
+                totals = Counter()
+                for _, u, g, c, _ in chunk:
+                    totals[(u, g)] += c
+                execute_values(cur, """
+                    INSERT INTO veil_users (user_id, guild_id, coins)
+                    VALUES %s
+                    ON CONFLICT (user_id, guild_id) DO UPDATE
+                       SET coins = COALESCE(veil_users.coins, 0) + EXCLUDED.coins
+                """, [(u, g, c) for (u, g), c in sorted(totals.items())], page_size=len(totals) or 1)
+            _mark_done(cur, events)
+
+
+def mark_done(events):
+    for chunk in _chunks(events):
+        with get_db_conn() as conn, conn.cursor() as cur:
+            _mark_done(cur, chunk)
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Run
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _fmt_row(row):
+    if row is None:
+        return "(none)"
+    tier, renews_at, subscription_id, failed = row
+    return (f"{tier} sub={subscription_id or '-'} renews={renews_at:%Y-%m-%d}" if renews_at
+            else f"{tier} sub={subscription_id or '-'}") + (" payment_failed" if failed else "")
+
+
+def run(since: int, until: int, dry_run=False, credit_unverified=False, notify=True) -> dict:
+    started = time.monotonic()
+    ensure_schema()
+    if inbox.INBOX_ENABLED:
+        inbox.ensure_schema()
+    if EVENT_ORDERING:
+        event_order.ensure_schema()
+    bonus_engine.ensure_schema()
+    if coin_ledger.COIN_LEDGER_ENABLED:
+        coin_ledger.ensure_schema()
+
+    subs = fetch_subscriptions()
+    events = fetch_events(since, until)
+    fetched = time.monotonic()
+    seen = already_applied(e["id"] for e in events)
+    fresh = [e for e in events if e["id"] not in seen]
+
+    # invoices carry their subscription's snapshot, as they do for the webhook
+    for event in fresh:
+        observe_event(event)
+    # cancelled subscriptions are not listed, but their deletion events carry them
+    for event in fresh:
+        obj = event["data"]["object"]
+        if event["type"] == "customer.subscription.deleted" and subscription_cache.get(obj.get("id")) is None:
+            subscription_cache.put(snapshot_from_subscription(obj))
+    marks = {}
+    if EVENT_ORDERING:
+        marks = seen_watermarks({shard for shard, ordered in map(stripe_shard, fresh) if ordered})
+
+    plan = Plan()
+    for event in fresh:
+        plan_event(plan, event, marks)
+    plan_subscriptions(plan, subs)
+    changes = diff(plan)
+
+    # which coin packs are provably unpaid
+    credited = credited_sessions(s for *_, s in plan.coins)
+    verifiable = inbox.INBOX_ENABLED or coin_ledger.COIN_LEDGER_ENABLED
+    coins = [c for c in plan.coins if c[4] not in credited]
+    unverified = [] if verifiable or credit_unverified else coins
+    if unverified:
+        coins = []
+    coin_events = {c[0]["id"] for c in coins} | {c[0]["id"] for c in unverified}
+
+    print(f"[backfill] {len(events)} event(s) in range, {len(seen)} already applied, "
+          f"{len(subs)} subscription(s) listed, {fetched - started:.1f}s from Stripe")
+    for guild_id, kind, current, target in changes:
+        print(f"  guild {guild_id}: {_fmt_row(current)} -> {_fmt_row(target)}  ({kind})")
+    for event, user_id, guild_id, amount, session_id in coins:
+        print(f"  coins: +{amount} to user {user_id} in guild {guild_id} (session {session_id})")
+    for event, user_id, guild_id, amount, session_id in unverified:
+        print(f"  ⚠️ coins not credited, cannot tell if already paid: +{amount} to user {user_id} "
+              f"in guild {guild_id} (session {session_id}) -- rerun with --credit-coins to credit")
+    for guild_id, kept, other in plan.conflicts:
+        print(f"  ⚠️ guild {guild_id}: {other} is still active next to {kept}; not cancelled")
+    for event_id, error in plan.failed.items():
+        print(f"  ❌ {event_id} not applied: {error}")
+
+    report = {
+        "events": len(events), "skipped": len(seen), "subscriptions": len(subs),
+        "guild_changes": len(changes), "coin_credits": len(coins), "coins_unverified": len(unverified),
+        "watermarks": len(plan.watermarks), "grants": 0, "conflicts": len(plan.conflicts), "failed": len(plan.failed), "ignored": dict(plan.ignored),
+    }
+    if dry_run:
+        print(f"[backfill] dry run: {len(changes)} guild(s), {len(coins)} coin pack(s), "
+              f"up to {len(plan.grants)} bonus grant(s) would be applied")
+        return dict(report, seconds=round(time.monotonic() - started, 2))
+
+    write_subscriptions(changes, plan.watermarks)
+    credit_coins(coins)
+    mark_done([e for e in fresh if e["id"] not in coin_events and e["id"] not in plan.failed])
+    new_grants = bonus_engine.create_grants(plan.grants) if plan.grants else []
+    for grant_key in new_grants:
+        bonus_engine.run_grant(grant_key)
+    report["grants"] = len(new_grants)
+
+    if notify:
+        for guild_id, kind, current, (tier, *_) in changes:
+            if kind == "upsert" and (current is None or current[0] != tier):
+                relay_line(upgrade_line(guild_id, tier))
+        for _, user_id, guild_id, amount, session_id in coins:
+            relay_line(coin_topup_line(session_id, user_id, guild_id, amount))
+
+    elapsed = time.monotonic() - started
+    print(f"[backfill] applied {len(changes)} guild change(s), {len(coins)} coin pack(s), "
+          f"{len(new_grants)} bonus grant(s) in {elapsed:.1f}s ({elapsed - (fetched - started):.1f}s in Postgres)")
+    return dict(report, seconds=round(elapsed, 2))
+
+
+def _timestamp(value: str) -> int:
+    if value.isdigit():
+        return int(value)
+    dt = datetime.fromisoformat(value)
+    return int((dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)).timestamp())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="replay missed Stripe events and reconcile veil_subscriptions")
+    parser.add_argument("--since", required=True, help="ISO date/time or unix timestamp (inclusive)")
+    parser.add_argument("--until", help="ISO date/time or unix timestamp (exclusive, default now)")
+    parser.add_argument("--dry-run", action="store_true", help="print the diff, write nothing")
+    parser.add_argument("--credit-coins", action="store_true",
+                        help="credit coin packs even when neither WEBHOOK_INBOX nor COIN_LEDGER can prove them unpaid")
+    parser.add_argument("--no-notify", action="store_true", help="do not post upgrade / COIN_TOPUP lines")
+    args = parser.parse_args()
+    if not stripe.api_key:
+        sys.exit("STRIPE_SECRET_KEY is not set")
+    run(_timestamp(args.since), _timestamp(args.until) if args.until else int(time.time()),
+        dry_run=args.dry_run, credit_unverified=args.credit_coins, notify=not args.no_notify)
@@ -0,0 +1,65 @@
+"""
+Sync (Flask, gthread workers) vs async (aiohttp + asyncpg) entry point: requests
+per second and memory per worker, same scenarios and worker count, each run
+against a freshly seeded database and the local stand-ins from loadtest.py.
+
+    BENCH_DATABASE_URL=postgresql://localhost/veil_bench python benchmarks/bench_async.py \
+        --events 500 --concurrency 64 --upstream-latency 50
+
+--upstream-latency delays every stand-in response (Stripe, Discord), which is
+where the async worker's advantage shows: a sync worker holds a thread for each
+in-flight Stripe call, an async one only a coroutine.
+"""
+import argparse
+
+from loadtest import SCENARIOS, append_json, run_load
+
+DEFAULT_SCENARIOS = ["topgg.vote", "checkout.coins", "invoice.payment_failed", "checkout.subscription"]
+
+MODES = {
+    "sync": {"app_spec": "stripe_webhook:app"},
+    "async": {"app_spec": "stripe_webhook_async:app", "worker_class": "aiohttp.GunicornWebWorker"},
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="sync vs async entry point")
+    parser.add_argument("--events", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=4, help="threads per sync worker")
+    parser.add_argument("--upstream-latency", type=float, default=50.0, help="stand-in response delay, ms")
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS))
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE")
+    parser.add_argument("--json", metavar="PATH")
+    args = parser.parse_args()
+    scenarios = args.scenario or DEFAULT_SCENARIOS
+
+    reports = {}
+    for mode, spec in MODES.items():
+        reports[mode] = run_load(scenarios, args.events, args.concurrency, args.workers, args.threads,
+                                 upstream_latency_ms=args.upstream_latency, extra_env=args.env, **spec)
+
+    header = f"{'scenario':<26}" + "".join(f"{m + ' ev/s':>12}{m + ' p95':>11}" for m in MODES)
+    print(header)
+    print("-" * len(header))
+    for name in scenarios:
+        row = f"{name:<26}"
+        for mode in MODES:
+            r = reports[mode]["results"][name]
+            row += f"{r['rps']:>12}{r['p95_ms']:>11}"
+        print(row)
+    print()
+    for mode in MODES:
+        print(f"{mode:<6} workers: {reports[mode]['memory']}")
+
+    if args.json:
+        append_json(args.json, {"bench": "async", "workers": args.workers, "threads": args.threads,
+                                "concurrency": args.concurrency, "upstream_latency_ms": args.upstream_latency,
+                                "env": args.env,
+                                "modes": {m: {"results": r["results"], "memory": r["memory"]}
+                                          for m, r in reports.items()}})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+backfill.py against the local Stripe stand-in: a downtime's worth of events
+(subscription checkouts, renewals, failed payments, cancellations, coin packs)
+replayed into an empty scratch schema, then checked against the state the
+events imply and rerun to confirm nothing is applied twice.
+
+    BENCH_DATABASE_URL=postgresql://localhost/veil_bench python benchmarks/bench_backfill.py \
+        --guilds 4000 --renewals 3 --coin-packs 6000
+
+Reports the dry run, the real run and the rerun (time, rows written, Stripe
+list pages), and exits 1 if the database does not match.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+from common import scratch_schema
+from standins import COIN_PRICES, TIER_PRICES, StandInServer, subscription_object
+
+STANDIN = StandInServer().start()
+os.environ.setdefault("STRIPE_SECRET_KEY", "sk_test_bench")
+os.environ["STRIPE_API_BASE"] = STANDIN.base_url
+
+import backfill  # noqa: E402
+import db_pool  # noqa: E402
+
+DAY = 86400
+
+
+def checkout_event(n, created, session):
+    return {"id": f"evt_bf_{n}", "object": "event", "type": "checkout.session.completed",
+            "created": created, "data": {"object": session}}
+
+
+def build_fixtures(guilds: int, renewals: int, coin_packs: int, seed: int = 7):
+    """Events, listed subscriptions, and the veil_subscriptions rows / coin total they should produce."""
+    rng = random.Random(seed)
+    start = int(time.time()) - 7 * DAY
+    events, subs, expected = [], [], {}
+    n = 0
+    for guild_id in range(1, guilds + 1):
+        tier = rng.choice(list(TIER_PRICES))
+        sub_id = f"sub_bench_{guild_id}_{tier}"
+        t = start + rng.randrange(DAY)
+        n += 1
+        events.append(checkout_event(n, t, {
+            "id": f"cs_bf_sub_{guild_id}", "object": "checkout.session", "mode": "subscription",
+            "subscription": sub_id, "client_reference_id": str(guild_id),
+            "metadata": {"guild_id": str(guild_id), "price_id": TIER_PRICES[tier]},
+        }))
+        sub = subscription_object(sub_id, guild_id, tier)
+        for r in range(renewals):
+            t += DAY
+            n += 1
+            events.append({"id": f"evt_bf_{n}", "object": "event", "type": "invoice.payment_succeeded", "created": t,
+                           "data": {"object": {"id": f"in_bf_{guild_id}_{r}", "object": "invoice", "subscription": sub_id,
+                                               "lines": {"data": [{"price": {"id": TIER_PRICES[tier]},
+                                                                   "metadata": {"guild_id": str(guild_id)},
+                                                                   "period": {"end": sub["current_period_end"]}}]}}}})
+        fate = rng.random()
+        if fate < 0.1:
+            n += 1
+            events.append({"id": f"evt_bf_{n}", "object": "event", "type": "customer.subscription.deleted",
+                           "created": t + 60, "data": {"object": dict(sub, status="canceled")}})
+            expected[guild_id] = ("free", None)
+        elif fate < 0.2:
+            n += 1
+            events.append({"id": f"evt_bf_{n}", "object": "event", "type": "invoice.payment_failed", "created": t + 60,
+                           "data": {"object": {"id": f"in_bf_{guild_id}_failed", "object": "invoice",
+                                               "subscription": sub_id}}})
+            subs.append(dict(sub, status="past_due"))
+            expected[guild_id] = ("free", sub_id)
+        else:
+            subs.append(sub)
+            expected[guild_id] = (tier, sub_id)
+
+    coins_total = 0
+    for i in range(coin_packs):
+        coins = rng.choice(list(COIN_PRICES))
+        coins_total += coins
+        n += 1
+        events.append(checkout_event(n, start + rng.randrange(7 * DAY), {
+            "id": f"cs_bf_coins_{i}", "object": "checkout.session", "mode": "payment",
+            "client_reference_id": str(rng.randrange(1, 1000)),
+            # guilds without a subscription, so tier bonuses do not mix into the coin total
+            "metadata": {"guild_id": str(guilds + rng.randrange(1, 100)), "price_id": COIN_PRICES[coins]},
+        }))
+    return events, subs, expected, coins_total
+
+
+def check(expected: dict, coins_total: int) -> list:
+    problems = []
+    with db_pool.get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("SELECT guild_id, tier, subscription_id FROM veil_subscriptions")
+        actual = {g: (t, s) for g, t, s in cur.fetchall()}
+        cur.execute("SELECT COALESCE(SUM(coins), 0) FROM veil_users")
+        coins = cur.fetchone()[0]
+    wrong = [g for g, want in expected.items() if actual.get(g) != want]
+    if wrong:
+        problems.append(f"{len(wrong)} guild(s) differ, e.g. {wrong[0]}: {actual.get(wrong[0])} != {expected[wrong[0]]}")
+    if coins != coins_total:
+        problems.append(f"coins credited {coins} != {coins_total}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="backfill.py against the Stripe stand-in")
+    parser.add_argument("--guilds", type=int, default=4000)
+    parser.add_argument("--renewals", type=int, default=3, help="invoice.payment_succeeded events per guild")
+    parser.add_argument("--coin-packs", type=int, default=6000)
+    args = parser.parse_args()
+
+    events, subs, expected, coins_total = build_fixtures(args.guilds, args.renewals, args.coin_packs)
+    STANDIN.events, STANDIN.subscriptions = events, subs
+    since, until = min(e["created"] for e in events), int(time.time()) + 1
+    print(f"{len(events)} events, {len(subs)} listed subscriptions, {args.guilds} guilds")
+
+    with scratch_schema(maxconn=4):
+        results = {}
+        for name, kwargs in (("dry run", {"dry_run": True}), ("apply", {}), ("rerun", {})):
+            STANDIN.requests.clear()
+            report = backfill.run(since, until, credit_unverified=True, notify=False, **kwargs)
+            results[name] = dict(report, stripe_requests=dict(STANDIN.requests))
+        problems = check(expected, coins_total)
+
+    print()
+    print(f"{'run':<10}{'seconds':>9}{'skipped':>9}{'guilds':>8}{'coins':>8}{'grants':>8}  stripe requests")
+    for name, r in results.items():
+        print(f"{name:<10}{r['seconds']:>9}{r['skipped']:>9}{r['guild_changes']:>8}{r['coin_credits']:>8}"
+              f"{r['grants']:>8}  {r['stripe_requests']}")
+    print()
+    if problems:
+        print("❌ " + "; ".join(problems))
+        sys.exit(1)
+    print("✅ database matches the events; the rerun applied nothing")
+
+
+if __name__ == "__main__":
+    main()
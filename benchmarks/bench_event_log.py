@@ -0,0 +1,118 @@
+"""
+Per-request logging cost: the print() calls a subscription checkout used to
+make (session info, the subscription write, the bonus, the support notice)
+against one event_log record carrying the same information.
+
+    python benchmarks/bench_event_log.py [--requests 20000] [--threads 8]
+
+stdout is a pipe drained by another process, written line by line as under
+gunicorn with PYTHONUNBUFFERED. Reports, per mode, the time a handler thread
+spends logging per request and the wall time until everything is written
+(event_log: until its listener has drained the queue).
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import event_log  # noqa: E402
+
+GUILD_ID, USER_ID, TIER = 123456789012345678, 234567890123456789, "premium"
+SESSION_ID, SUBSCRIPTION_ID, PRICE_ID = "cs_test_a1b2c3", "sub_1Pq2r3", "price_1RuT1sADYgCtNnMoWMzdQ7YI"
+
+
+def with_prints(i: int):
+    print("🧾 Stripe Session Info:")
+    print("  mode:", "subscription")
+    print("  client_reference_id (user_id):", USER_ID)
+    print("  guild_id:", GUILD_ID)
+    print("  price_id:", PRICE_ID)
+    print("  subscription_tier:", TIER)
+    print("  subscription_id:", SUBSCRIPTION_ID)
+    print("  stripe_session_id:", SESSION_ID)
+    print(f"✅ Updated subscription: guild_id={GUILD_ID}, tier={TIER}, renews_at=2026-11-16 05:16:28+00:00")
+    print(f"💰 Bonus coins granted: +1000 to all users in guild {GUILD_ID} (checkout:{SESSION_ID})")
+    print(f"📢 Support server notification queued for guild {GUILD_ID} upgrade.")
+
+
+def with_event_log(i: int):
+    with event_log.event("stripe", "checkout.session.completed", event_id=f"evt_{i}"):
+        event_log.bind(session_id=SESSION_ID, guild_id=GUILD_ID, user_id=USER_ID, mode="subscription",
+                       price_id=PRICE_ID, tier=TIER, subscription_id=SUBSCRIPTION_ID)
+        event_log.note(f"✅ Updated subscription: guild_id={GUILD_ID}, tier={TIER}, renews_at=2026-11-16 05:16:28+00:00")
+        event_log.note(f"💰 Bonus coins granted: +1000 to all users in guild {GUILD_ID} (checkout:{SESSION_ID})")
+        event_log.note(f"📢 Support server notification queued for guild {GUILD_ID} upgrade.")
+
+
+def configure(sample: float = 1.0, stdout: bool = True, path: str = None):
+    """Restart event_log's pipeline with other settings (they are read from the env at import)."""
+    event_log.shutdown()
+    event_log.EVENT_LOG_SAMPLE, event_log.EVENT_LOG_STDOUT, event_log.EVENT_LOG_FILE = sample, stdout, path
+    event_log._ensure_started()
+
+
+def run(handler, requests: int, threads: int):
+    """(caller µs per request, wall seconds until written)."""
+    def batch(chunk):
+        start = time.perf_counter()
+        for i in chunk:
+            handler(i)
+        return time.perf_counter() - start
+
+    chunks = [range(t, requests, threads) for t in range(threads)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        busy = sum(pool.map(batch, chunks))
+    event_log.shutdown()  # drain
+    sys.stdout.flush()
+    return busy / requests * 1e6, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="print() vs event_log per request")
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--threads", type=int, default=8, help="handler threads (gunicorn --threads)")
+    args = parser.parse_args()
+
+    # stdout -> a pipe into another process, flushed per line
+    saved = os.dup(1)
+    report = os.fdopen(os.dup(1), "w")
+    sink = subprocess.Popen([sys.executable, "-c", "import sys\nfor _ in sys.stdin.buffer: pass"],
+                            stdin=subprocess.PIPE)
+    os.dup2(sink.stdin.fileno(), 1)
+    sys.stdout = open(1, "w", buffering=1, encoding="utf-8", closefd=False)
+
+    tmp = tempfile.mkdtemp(prefix="veil_bench_event_log_")
+    modes = [
+        ("print x11", with_prints, None),
+        ("event_log", with_event_log, {}),
+        ("event_log 10%", with_event_log, {"sample": 0.1}),
+        ("event_log file", with_event_log, {"stdout": False, "path": os.path.join(tmp, "events-{pid}.jsonl")}),
+    ]
+    rows = []
+    for name, handler, settings in modes:
+        if settings is not None:
+            configure(**settings)
+        before = dict(event_log._stats)
+        us, seconds = run(handler, args.requests, args.threads)
+        dropped = event_log._stats["dropped"] - before["dropped"]
+        rows.append((name, us, seconds, dropped))
+
+    sys.stdout.close()
+    os.dup2(saved, 1)  # let go of the pipe so the sink sees EOF
+    sink.stdin.close()
+    sink.wait()
+
+    print(f"{args.requests} requests on {args.threads} threads", file=report)
+    print(f"{'mode':<16}{'µs/request':>12}{'wall s':>9}{'dropped':>9}", file=report)
+    for name, us, seconds, dropped in rows:
+        print(f"{name:<16}{us:>12.1f}{seconds:>9.2f}{dropped:>9}", file=report)
+
+
+if __name__ == "__main__":
+    main()
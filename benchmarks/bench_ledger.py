@@ -0,0 +1,104 @@
+"""
+Concurrent-credit throughput, direct veil_users updates vs. COIN_LEDGER mode.
+
+Two scenarios, each run in both modes:
+- single user:  T threads buying coin packs for the same (user, guild)
+- single guild: T threads crediting random members of one guild while a
+                guild-wide bonus grant is being applied
+
+After each run the ledger is compacted and the resulting coin total is
+checked against what was credited.
+
+    BENCH_DATABASE_URL=postgresql://localhost/veil_bench python benchmarks/bench_ledger.py [threads] [credits_per_thread] [members]
+"""
+import random
+import sys
+import threading
+import time
+
+from common import scratch_schema
+
+import bonus_engine
+import coin_ledger
+import db_pool
+from credits import credit_coin_purchase
+
+GUILD_ID = 1
+
+
+def reset(members: int):
+    with db_pool.get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("TRUNCATE veil_users, coin_ledger, bonus_grants, coin_purchase_credits")
+        cur.execute("INSERT INTO veil_users (user_id, guild_id, coins) "
+                    "SELECT g, %s, 0 FROM generate_series(1, %s) g", (GUILD_ID, members))
+
+
+def total_coins() -> int:
+    with db_pool.get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("SELECT COALESCE(SUM(coins), 0) FROM veil_users")
+        return cur.fetchone()[0]
+
+
+def run_threads(threads: int, per_thread: int, pick_user):
+    def work(seed):
+        rng = random.Random(seed)
+        for i in range(per_thread):
+            with db_pool.get_db_conn() as conn, conn.cursor() as cur:
+                credit_coin_purchase(cur, pick_user(rng), GUILD_ID, 10, f"cs_{seed}_{i}")
+
+    workers = [threading.Thread(target=work, args=(t,)) for t in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return time.perf_counter() - start
+
+
+def scenario(name, threads, per_thread, members, pick_user, with_bonus):
+    reset(members)
+    bonus_thread = None
+    bonus_time = [0.0]
+    if with_bonus:
+        bonus_engine.create_grant("bench", GUILD_ID, 100)
+
+        def bonus():
+            start = time.perf_counter()
+            bonus_engine.run_grant("bench")
+            bonus_time[0] = time.perf_counter() - start
+
+        bonus_thread = threading.Thread(target=bonus)
+        bonus_thread.start()
+
+    elapsed = run_threads(threads, per_thread, pick_user)
+    if bonus_thread:
+        bonus_thread.join()
+    coin_ledger.compact_all()
+
+    credits = threads * per_thread
+    expected = credits * 10 + (members * 100 if with_bonus else 0)
+    actual = total_coins()
+    mode = "ledger" if coin_ledger.COIN_LEDGER_ENABLED else "direct"
+    extra = f"  bonus {bonus_time[0]:.2f}s" if with_bonus else ""
+    print(f"{mode:<7} {name:<13} {credits / elapsed:9.0f} credits/s{extra}  "
+          f"{'consistent' if actual == expected else f'MISMATCH {actual} != {expected}'}")
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    per_thread = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    members = int(sys.argv[3]) if len(sys.argv) > 3 else 20000
+    bonus_engine.BONUS_BATCH_PAUSE = 0
+
+    with scratch_schema(maxconn=threads + 2):
+        coin_ledger.ensure_schema()
+        bonus_engine.ensure_schema()
+        for enabled in (False, True):
+            coin_ledger.COIN_LEDGER_ENABLED = enabled
+            scenario("single user", threads, per_thread, members, lambda rng: 1, with_bonus=False)
+            scenario("single guild", threads, per_thread, members,
+                     lambda rng: rng.randint(1, members), with_bonus=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Commit throughput with the entitlement NOTIFY triggers: none, the old ones
+(every write to veil_subscriptions / veil_users notifies) and the current
+ones (only writes that change a column the cache reads).
+
+Every NOTIFYing commit takes one database-wide lock on the notification
+queue, so concurrent writers that notify commit one at a time. Three
+workloads of one-row transactions from T threads:
+
+- subscription touch:  UPDATE veil_subscriptions SET subscribed_at = NOW()  (nothing the cache reads)
+- vote timestamp:      UPDATE veil_users SET topgg_last_vote_at = NOW()     (nothing the cache reads)
+- coin credit:         UPDATE veil_users SET coins = coins + 1              (notifies in both modes)
+
+    BENCH_DATABASE_URL=postgresql://localhost/veil_bench python benchmarks/bench_notify.py [threads] [seconds]
+"""
+import os
+import random
+import select
+import sys
+import threading
+import time
+
+import psycopg2
+
+from common import bench_database_url, scratch_schema
+
+import db_pool
+import entitlements
+
+GUILDS = 500
+MEMBERS = 5000
+
+# the triggers as first shipped: every write queues a notification
+EVERY_WRITE_SQL = """
+    CREATE TRIGGER veil_subscriptions_notify AFTER INSERT OR UPDATE OR DELETE ON veil_subscriptions
+        FOR EACH ROW EXECUTE FUNCTION veil_notify_tier();
+    CREATE TRIGGER veil_users_notify_update AFTER UPDATE ON veil_users
+        REFERENCING NEW TABLE AS changed FOR EACH STATEMENT EXECUTE FUNCTION veil_notify_balances();
+"""
+
+WORKLOADS = {
+    "subscription touch": ("UPDATE veil_subscriptions SET subscribed_at = NOW() WHERE guild_id = %(g)s", GUILDS),
+    "vote timestamp": ("UPDATE veil_users SET topgg_last_vote_at = NOW() WHERE user_id = %(u)s AND guild_id = 1", MEMBERS),
+    "coin credit": ("UPDATE veil_users SET coins = coins + 1 WHERE user_id = %(u)s AND guild_id = 1", MEMBERS),
+}
+
+
+def set_triggers(mode: str):
+    with db_pool.get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT tgname, tgrelid::regclass::text FROM pg_trigger
+             WHERE tgrelid IN (to_regclass('veil_subscriptions'), to_regclass('veil_users')) AND NOT tgisinternal
+        """)
+        for name, table in cur.fetchall():
+            cur.execute(f"DROP TRIGGER {name} ON {table}")
+        if mode == "every write":
+            cur.execute(EVERY_WRITE_SQL)
+    if mode == "changed columns":
+        entitlements.ensure_schema()
+
+
+def seed():
+    with db_pool.get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("INSERT INTO veil_subscriptions (guild_id, tier, subscribed_at, subscription_id) "
+                    "SELECT g, 'basic', NOW(), 'sub_' || g FROM generate_series(1, %s) g", (GUILDS,))
+        cur.execute("INSERT INTO veil_users (user_id, guild_id, coins) "
+                    "SELECT u, 1, 0 FROM generate_series(1, %s) u", (MEMBERS,))
+    # the "changed columns" functions are used by the "every write" triggers too
+    entitlements.ensure_schema()
+
+
+class Listener(threading.Thread):
+    """Counts notifications on the entitlements channel, as a worker's listener would receive them."""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.count = 0
+        self.stopped = False
+
+    def run(self):
+        conn = psycopg2.connect(bench_database_url(), sslmode=os.getenv("DB_SSLMODE", "prefer"))
+        conn.autocommit = True
+        conn.cursor().execute(f"LISTEN {entitlements.CHANNEL}")
+        while not self.stopped:
+            if select.select([conn], [], [], 0.2) != ([], [], []):
+                conn.poll()
+                self.count += len(conn.notifies)
+                conn.notifies.clear()
+        conn.close()
+
+
+def run(sql: str, rows: int, threads: int, seconds: float) -> float:
+    commits = [0] * threads
+    deadline = time.monotonic() + seconds
+
+    def work(i):
+        rng = random.Random(i)
+        while time.monotonic() < deadline:
+            key = rng.randrange(1, rows + 1)
+            with db_pool.get_db_conn() as conn, conn.cursor() as cur:
+                cur.execute(sql, {"g": key, "u": key})
+            commits[i] += 1
+
+    workers = [threading.Thread(target=work, args=(i,)) for i in range(threads)]
+    start = time.monotonic()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return sum(commits) / (time.monotonic() - start)
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    results = {}
+    with scratch_schema(maxconn=threads + 1):
+        seed()
+        for mode in ("no triggers", "every write", "changed columns"):
+            set_triggers(mode)
+            for name, (sql, rows) in WORKLOADS.items():
+                listener = Listener()
+                listener.start()
+                time.sleep(0.3)  # LISTEN in place
+                rate = run(sql, rows, threads, seconds)
+                time.sleep(0.3)
+                listener.stopped = True
+                listener.join()
+                results[(mode, name)] = (rate, listener.count)
+                print(f"… {mode:<16} {name:<20} {rate:8.0f} commits/s", flush=True)
+
+    print()
+    print(f"{threads} threads, {seconds:g}s per run")
+    print(f"{'workload':<22}" + "".join(f"{m + ' c/s':>22}{'notifies':>10}"
+                                        for m in ("no triggers", "every write", "changed columns")))
+    for name in WORKLOADS:
+        print(f"{name:<22}" + "".join(f"{results[(m, name)][0]:>22.0f}{results[(m, name)][1]:>10}"
+                                      for m in ("no triggers", "every write", "changed columns")))
+
+
+if __name__ == "__main__":
+    main()
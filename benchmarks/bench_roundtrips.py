@@ -0,0 +1,108 @@
+"""
+Round trips per event for the vote and coin-purchase credit paths, before
+(statement-per-step, as the handlers used to do it) and after (credits.py).
+
+Needs a scratch Postgres; everything is created in a throwaway schema:
+
+    BENCH_DATABASE_URL=postgresql://localhost/veil_bench python benchmarks/bench_roundtrips.py [events]
+"""
+import sys
+import time
+
+from common import scratch_schema
+
+import db_pool
+from credits import credit_coin_purchase, credit_topgg_vote
+
+
+# ── the old per-step statements, kept here only for comparison ──────────────
+def legacy_topgg_vote(user_id, coins):
+    with db_pool.get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT id, guild_id, interaction_token, application_id
+              FROM topgg_vote_sessions
+             WHERE user_id = %s AND used = FALSE
+          ORDER BY created_at DESC
+             LIMIT 1
+        """, (user_id,))
+        session_id, guild_id, _, _ = cur.fetchone()
+        cur.execute("""
+            INSERT INTO veil_users (user_id, guild_id, coins) VALUES (%s, %s, 0)
+            ON CONFLICT (user_id, guild_id) DO NOTHING
+        """, (user_id, guild_id))
+        cur.execute("""
+            UPDATE veil_users SET coins = COALESCE(coins, 0) + %s, topgg_last_vote_at = NOW()
+             WHERE user_id = %s AND guild_id = %s
+         RETURNING coins
+        """, (coins, user_id, guild_id))
+        cur.fetchone()
+        cur.execute("""
+            INSERT INTO vote_events (provider, user_id, guild_id, voted_at, nonce)
+            VALUES (%s, %s, %s, NOW(), %s) ON CONFLICT (nonce) DO NOTHING
+        """, ("topgg", user_id, guild_id, str(session_id)))
+        cur.execute("UPDATE topgg_vote_sessions SET used = TRUE WHERE id = %s AND used = FALSE", (session_id,))
+
+
+def legacy_coin_purchase(user_id, guild_id, coins, stripe_session_id):
+    with db_pool.get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO veil_users (user_id, guild_id, coins) VALUES (%s, %s, 0)
+            ON CONFLICT (user_id, guild_id) DO NOTHING
+        """, (user_id, guild_id))
+        cur.execute("""
+            UPDATE veil_users SET coins = COALESCE(coins,0) + %s
+             WHERE user_id = %s AND guild_id = %s
+         RETURNING coins
+        """, (coins, user_id, guild_id))
+        cur.fetchone()
+    with db_pool.get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT interaction_token, application_id, user_id, guild_id, coins
+              FROM coin_checkout_sessions WHERE stripe_session_id = %s
+        """, (stripe_session_id,))
+        cur.fetchone()
+
+
+def new_topgg_vote(user_id, coins):
+    with db_pool.get_db_conn() as conn, conn.cursor() as cur:
+        assert credit_topgg_vote(cur, user_id, coins) is not None
+
+
+def new_coin_purchase(user_id, guild_id, coins, stripe_session_id):
+    with db_pool.get_db_conn() as conn, conn.cursor() as cur:
+        credit_coin_purchase(cur, user_id, guild_id, coins, stripe_session_id)
+
+
+def seed(n):
+    with db_pool.get_db_conn() as conn, conn.cursor() as cur:
+        for i in range(n):
+            cur.execute("INSERT INTO topgg_vote_sessions (user_id, guild_id, interaction_token, application_id) "
+                        "VALUES (%s, 1, 'tok', 1)", (1000 + i,))
+            cur.execute("INSERT INTO coin_checkout_sessions VALUES (%s, 'tok', 1, %s, 1, 100)", (f"cs_{i}", 1000 + i))
+
+
+def measure(label, fn, n):
+    before = db_pool.pool_stats()["round_trips"]
+    start = time.perf_counter()
+    for i in range(n):
+        fn(i)
+    elapsed = time.perf_counter() - start
+    trips = db_pool.pool_stats()["round_trips"] - before
+    print(f"{label:<28} {trips / n:6.2f} round trips/event   {elapsed / n * 1000:8.3f} ms/event")
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    with scratch_schema():
+        for label, vote, coin in (("before", legacy_topgg_vote, legacy_coin_purchase),
+                                  ("after", new_topgg_vote, new_coin_purchase)):
+            with db_pool.get_db_conn() as c, c.cursor() as cur:
+                cur.execute("TRUNCATE veil_users, topgg_vote_sessions, vote_events, coin_checkout_sessions")
+            seed(n)
+            measure(f"{label}: topgg vote", lambda i: vote(1000 + i, 15), n)
+            measure(f"{label}: coin purchase", lambda i: coin(1000 + i, 1, 100, f"cs_{i}"), n)
+        print("(round trips include the COMMIT; 'after' includes one PREPARE per connection)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+A weekend Top.gg burst against the app under gunicorn, with vote_gate on and
+off.
+
+    BENCH_DATABASE_URL=postgresql://localhost/veil_bench python benchmarks/bench_vote_burst.py \
+        --voters 2000 --strangers 500 --copies 3
+
+All at once and shuffled: votes from users with a pending /vote session, votes
+from users without one, and every vote delivered --copies times (Top.gg's
+retries). Then half of the users without a session run /vote and vote again,
+which has to be credited even though their earlier votes were cached as
+"no session".
+
+Reports requests per second, DB round trips, support-channel lines and what
+the gate absorbed, and exits 1 if any voter was not credited exactly once.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+import requests
+
+from loadtest import TOPGG_AUTH, database, gunicorn_app, scrape
+from standins import StandInServer
+from stress_ordering import wait_for_inbox
+
+from webhook_common import TOPGG_VOTE_COINS  # the repo root is on sys.path via loadtest
+
+VOTER_BASE = 500_000      # users with a session
+STRANGER_BASE = 600_000   # users without one
+VOTE_GUILD = 3
+
+
+def send_votes(base: str, users: list, concurrency: int) -> dict:
+    counts = {"ok": 0, "failed": 0, "absorbed": 0}
+    session = requests.Session()
+
+    def send(user_id):
+        r = session.post(base + "/topgg-webhook", timeout=60, headers={"Authorization": TOPGG_AUTH},
+                         json={"user": str(user_id), "bot": "1", "type": "upvote", "isWeekend": True})
+        return r.status_code == 200, r.status_code == 200 and "absorbed" in r.json()
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        for ok, absorbed in pool.map(send, users):
+            counts["ok" if ok else "failed"] += 1
+            counts["absorbed"] += absorbed
+    return counts
+
+
+def add_sessions(cur, users):
+    cur.executemany("INSERT INTO topgg_vote_sessions (user_id, guild_id, interaction_token, application_id) "
+                    "VALUES (%s, %s, 'tok_' || %s, 123)", [(u, VOTE_GUILD, u) for u in users])
+
+
+def check(cur, credited: list) -> list:
+    cur.execute("SELECT user_id, coins FROM veil_users WHERE guild_id = %s", (VOTE_GUILD,))
+    coins = dict(cur.fetchall())
+    cur.execute("SELECT to_regclass('coin_ledger') IS NOT NULL")
+    if cur.fetchone()[0]:
+        cur.execute("SELECT user_id, SUM(delta) FROM coin_ledger WHERE guild_id = %s AND compacted_at IS NULL "
+                    "GROUP BY user_id", (VOTE_GUILD,))
+        for user_id, delta in cur.fetchall():
+            coins[user_id] = coins.get(user_id, 0) + delta
+    problems = []
+    wrong = [u for u in credited if coins.pop(u, 0) != TOPGG_VOTE_COINS]
+    if wrong:
+        problems.append(f"{len(wrong)} voter(s) not credited exactly once, e.g. {wrong[0]}")
+    if coins:
+        problems.append(f"{len(coins)} user(s) credited without a session")
+    return problems
+
+
+def _gauge(snapshot: dict, name: str, **labels) -> float:
+    want = set(labels.items())
+    return sum(v for (n, key), v in snapshot.items() if n == name and want <= key)
+
+
+def run_mode(name: str, extra_env: dict, args) -> dict:
+    rng = random.Random(5)
+    voters = [VOTER_BASE + i for i in range(args.voters)]
+    strangers = [STRANGER_BASE + i for i in range(args.strangers)]
+    burst = (voters + strangers) * args.copies
+    rng.shuffle(burst)
+    late = strangers[: len(strangers) // 2]
+
+    standin = StandInServer().start()
+    metrics_dir = tempfile.mkdtemp(prefix="veil_bench_metrics_")
+    try:
+        with database(1, 0) as (db_url, sslmode):
+            conn = psycopg2.connect(db_url, sslmode=sslmode)
+            conn.autocommit = True
+            cur = conn.cursor()
+            add_sessions(cur, voters)
+
+            env = dict(
+                os.environ,
+                DATABASE_URL=db_url,
+                DB_SSLMODE=sslmode,
+                TOPGG_WEBHOOK_AUTH=TOPGG_AUTH,
+                DISCORD_API_BASE=standin.base_url + "/api/v10",
+                SUPPORT_WEBHOOK=standin.base_url + "/api/webhooks/1/support",
+                METRICS_DIR=metrics_dir,
+                METRICS_FLUSH_INTERVAL="0.5",
+                DELIVERY_SPOOL_DIR=os.path.join(metrics_dir, "spool"),
+                **extra_env,
+            )
+            env.update(kv.split("=", 1) for kv in args.env)
+
+            with gunicorn_app(env, args.workers, args.threads, args.app, args.worker_class) as (base, log_path, _):
+                time.sleep(1.0)  # the listeners connect
+                start = time.perf_counter()
+                counts = send_votes(base, burst, args.concurrency)
+                wait_for_inbox(db_url, sslmode)
+                seconds = time.perf_counter() - start
+
+                add_sessions(cur, late)  # /vote, after which their next vote counts
+                time.sleep(0.2)
+                late_counts = send_votes(base, late, args.concurrency)
+                wait_for_inbox(db_url, sslmode)
+                time.sleep(1.0)  # one metrics flush
+                snapshot = scrape(base)
+            problems = check(cur, voters + late)
+            conn.close()
+    finally:
+        standin.stop()
+    return {
+        "mode": name,
+        "requests": len(burst),
+        "seconds": round(seconds, 2),
+        "req_s": round(len(burst) / seconds, 1) if seconds else 0.0,
+        "failed": counts["failed"] + late_counts["failed"],
+        "absorbed": counts["absorbed"],
+        "round_trips": int(_gauge(snapshot, "veil_event_db_round_trips_total", source="topgg")),
+        "lines": int(_gauge(snapshot, "veil_support_relay_lines")),
+        "batches": int(_gauge(snapshot, "veil_vote_gate_batches")),
+        "avg_batch": round(_gauge(snapshot, "veil_vote_gate_batched_votes")
+                           / max(1, _gauge(snapshot, "veil_vote_gate_batches")), 1),
+        "problems": problems,
+        "log": log_path,
+    }
+
+
+MODES = {
+    "gate": {"TOPGG_VOTE_GATE": "1"},
+    "no-gate": {"TOPGG_VOTE_GATE": "0", "TOPGG_BATCH_WINDOW": "0"},
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="a Top.gg vote burst with retries, vote_gate on vs off")
+    parser.add_argument("--voters", type=int, default=2000, help="users with a pending /vote session")
+    parser.add_argument("--strangers", type=int, default=500, help="users without one")
+    parser.add_argument("--copies", type=int, default=3, help="deliveries of every vote")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn worker processes")
+    parser.add_argument("--threads", type=int, default=16, help="gunicorn threads per worker")
+    parser.add_argument("--mode", action="append", choices=list(MODES), help="repeatable; default both")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra app env")
+    parser.add_argument("--app", default="stripe_webhook:app", help="gunicorn app spec")
+    parser.add_argument("--worker-class", help="gunicorn worker class, e.g. aiohttp.GunicornWebWorker")
+    args = parser.parse_args()
+
+    rows = [run_mode(name, MODES[name], args) for name in (args.mode or list(MODES))]
+
+    print()
+    print(f"{'mode':<9}{'requests':>9}{'seconds':>9}{'req/s':>8}{'failed':>8}{'absorbed':>10}"
+          f"{'db trips':>10}{'lines':>7}{'batches':>9}{'avg':>6}  result")
+    for r in rows:
+        result = "; ".join(r["problems"]) or "every voter credited once"
+        print(f"{r['mode']:<9}{r['requests']:>9}{r['seconds']:>9}{r['req_s']:>8}{r['failed']:>8}{r['absorbed']:>10}"
+              f"{r['round_trips']:>10}{r['lines']:>7}{r['batches']:>9}{r['avg_batch']:>6}  {result}")
+    print()
+    bad = [r for r in rows if r["problems"] or r["failed"]]
+    if bad:
+        print("❌ see", bad[0]["log"])
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""
+Shared helpers for the benchmark scripts: a throwaway Postgres schema with the
+tables the handlers use, wired into db_pool's process-wide pool.
+"""
+import os
+import sys
+import uuid
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_pool  # noqa: E402
+import schema  # noqa: E402
+
+BENCH_SCHEMA_SQL = schema.base_schema_sql()
+
+
+def bench_database_url() -> str:
+    # never DATABASE_URL: scratch_schema creates and drops schemas in this database
+    url = os.getenv("BENCH_DATABASE_URL")
+    if not url:
+        sys.exit("set BENCH_DATABASE_URL to a scratch database")
+    return url
+
+
+@contextmanager
+def scratch_schema(maxconn: int = 2):
+    """Create a throwaway schema with the handler tables and point db_pool at it."""
+    url = bench_database_url()
+    sslmode = os.getenv("DB_SSLMODE", "prefer")
+    schema = f"bench_{uuid.uuid4().hex[:8]}"
+
+    admin = db_pool.ConnectionPool(url, maxconn=1, sslmode=sslmode)
+    conn = admin.getconn()
+    conn.autocommit = True
+    conn.cursor().execute(f"CREATE SCHEMA {schema}")
+    try:
+        db_pool._pool = db_pool.ConnectionPool(url, maxconn=maxconn, sslmode=sslmode,
+                                               options=f"-c search_path={schema}")
+        with db_pool.get_db_conn() as c, c.cursor() as cur:
+            cur.execute(BENCH_SCHEMA_SQL)
+        yield schema
+    finally:
+        db_pool._pool.closeall()
+        conn.cursor().execute(f"DROP SCHEMA {schema} CASCADE")
+        admin.putconn(conn)
+        admin.closeall()
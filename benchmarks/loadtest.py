@@ -0,0 +1,426 @@
+"""
+Offline load test: the real app under gunicorn, driven with correctly signed
+Stripe events and authenticated Top.gg votes, against local stand-ins for the
+Stripe API, Discord and Postgres. Nothing leaves the machine.
+
+    # throwaway cluster from initdb/pg_ctl (PG_BIN=/usr/lib/postgresql/16/bin if not on PATH)
+    python benchmarks/loadtest.py --events 500 --concurrency 32
+
+    # or a scratch schema in an existing database
+    BENCH_DATABASE_URL=postgresql://localhost/veil_bench python benchmarks/loadtest.py
+
+    # compare modes; extra app settings are passed through
+    python benchmarks/loadtest.py --env WEBHOOK_INBOX=1 --env COIN_LEDGER=1 --json results.jsonl
+
+Each scenario is run on its own and reported with client-side throughput and
+p50/p95/p99 latency, plus what the app measured (from /metrics): handler time
+and DB round trips per event. Round trips are those made on the handler's
+thread; background work (bonus batches, inbox claims, compaction) is not
+attributed to an event. --json appends one line per run so numbers can be
+tracked across commits.
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+
+import psycopg2
+import requests
+
+from common import BENCH_SCHEMA_SQL
+from schema import MODULE_SCHEMAS
+from standins import COIN_PRICES, TIER_PRICES, StandInServer, free_port, local_postgres, subscription_object
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WEBHOOK_SECRET = "whsec_bench"
+TOPGG_AUTH = "bench-topgg-auth"
+
+VOTE_GUILD = 1
+COIN_GUILD = 2
+SUB_GUILD_BASE = 100_000
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Payloads
+# ─────────────────────────────────────────────────────────────────────────────
+
+def sign_stripe(payload: bytes, secret: str = WEBHOOK_SECRET) -> str:
+    """Stripe-Signature header: t=<unix>,v1=HMAC-SHA256(secret, "<t>.<payload>")."""
+    t = int(time.time())
+    mac = hmac.new(secret.encode(), f"{t}.".encode() + payload, hashlib.sha256).hexdigest()
+    return f"t={t},v1={mac}"
+
+
+def stripe_event(event_type: str, obj: dict) -> dict:
+    return {
+        "id": f"evt_bench_{uuid.uuid4().hex}",
+        "object": "event",
+        "api_version": "2024-06-20",
+        "created": int(time.time()),
+        "livemode": False,
+        "type": event_type,
+        "data": {"object": obj},
+    }
+
+
+def sub_id(guild_id: int, tier: str) -> str:
+    return f"sub_bench_{guild_id}_{tier}"
+
+
+def invoice(i: int, guild_id: int, tier: str, with_lines: bool) -> dict:
+    obj = {"id": f"in_bench_{uuid.uuid4().hex[:12]}", "object": "invoice", "subscription": sub_id(guild_id, tier)}
+    if with_lines:
+        obj["lines"] = {"object": "list", "data": [{
+            "price": {"id": TIER_PRICES[tier]},
+            "metadata": {"guild_id": str(guild_id)},
+            "period": {"end": int(time.time()) + 30 * 86400},
+        }]}
+    return obj
+
+
+def _topgg_vote(i):
+    return "topgg", {"user": str(i + 1), "bot": "1", "type": "upvote", "isWeekend": False}
+
+
+def _topgg_no_session(i):
+    return "topgg", {"user": str(900_000 + i), "bot": "1", "type": "upvote", "isWeekend": False}
+
+
+def _checkout_coins(i):
+    coins = 250
+    return "stripe", stripe_event("checkout.session.completed", {
+        "id": f"cs_bench_{i}", "object": "checkout.session", "mode": "payment",
+        "client_reference_id": str(i + 1),
+        "metadata": {"guild_id": str(COIN_GUILD), "price_id": COIN_PRICES[coins], "coins": str(coins)},
+    })
+
+
+def _checkout_subscription(i):
+    guild_id = SUB_GUILD_BASE + i
+    return "stripe", stripe_event("checkout.session.completed", {
+        "id": f"cs_bench_sub_{i}", "object": "checkout.session", "mode": "subscription",
+        "client_reference_id": "1",
+        "subscription": sub_id(guild_id, "premium"),
+        "metadata": {"guild_id": str(guild_id), "price_id": TIER_PRICES["premium"]},
+    })
+
+
+def _subscription_created(i):
+    guild_id = SUB_GUILD_BASE + i
+    return "stripe", stripe_event("customer.subscription.created",
+                                  subscription_object(sub_id(guild_id, "premium"), guild_id, "premium"))
+
+
+def _invoice_succeeded(i):
+    return "stripe", stripe_event("invoice.payment_succeeded", invoice(i, SUB_GUILD_BASE + i, "basic", True))
+
+
+def _invoice_failed(i):
+    return "stripe", stripe_event("invoice.payment_failed", invoice(i, SUB_GUILD_BASE + i, "basic", False))
+
+
+def _subscription_deleted(i):
+    guild_id = SUB_GUILD_BASE + i
+    obj = {"id": sub_id(guild_id, "basic"), "object": "subscription", "metadata": {"guild_id": str(guild_id)}}
+    return "stripe", stripe_event("customer.subscription.deleted", obj)
+
+
+# scenario -> (payload factory, (source, event_type) as the app labels it)
+SCENARIOS = {
+    "topgg.vote":                  (_topgg_vote, ("topgg", "upvote")),
+    "topgg.vote_no_session":       (_topgg_no_session, ("topgg", "upvote")),
+    "checkout.coins":              (_checkout_coins, ("stripe", "checkout.session.completed")),
+    "subscription.created":        (_subscription_created, ("stripe", "customer.subscription.created")),
+    "checkout.subscription":       (_checkout_subscription, ("stripe", "checkout.session.completed")),
+    "invoice.payment_succeeded":   (_invoice_succeeded, ("stripe", "invoice.payment_succeeded")),
+    "invoice.payment_failed":      (_invoice_failed, ("stripe", "invoice.payment_failed")),
+    "subscription.deleted":        (_subscription_deleted, ("stripe", "customer.subscription.deleted")),
+}
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Database
+# ─────────────────────────────────────────────────────────────────────────────
+
+SEED_SQL = """
+    INSERT INTO topgg_vote_sessions (user_id, guild_id, interaction_token, application_id)
+    SELECT g, %(vote_guild)s, 'tok_' || g, 123 FROM generate_series(1, %(n)s) g;
+
+    INSERT INTO coin_checkout_sessions (stripe_session_id, interaction_token, application_id, user_id, guild_id, coins)
+    SELECT 'cs_bench_' || (g - 1), 'tok_' || g, 123, g, %(coin_guild)s, 250 FROM generate_series(1, %(n)s) g;
+
+    INSERT INTO veil_users (user_id, guild_id, coins)
+    SELECT m, %(sub_base)s + g, 0 FROM generate_series(0, %(n)s - 1) g, generate_series(1, %(members)s) m;
+"""
+
+
+@contextmanager
+def database(events: int, members: int):
+    """Yield (app DATABASE_URL, sslmode) for a freshly created and seeded schema."""
+    sslmode = os.getenv("DB_SSLMODE", "prefer")
+    with ExitStack() as stack:
+        url = os.getenv("BENCH_DATABASE_URL") or stack.enter_context(local_postgres())
+        schema = f"bench_{uuid.uuid4().hex[:8]}"
+        admin = psycopg2.connect(url, sslmode=sslmode)
+        admin.autocommit = True
+        with admin.cursor() as cur:
+            cur.execute(f"CREATE SCHEMA {schema}")
+            cur.execute(f"SET search_path = {schema}")
+            cur.execute(BENCH_SCHEMA_SQL)
+            # the rest of what `schema.py migrate` sets up on a deployed database (notify triggers included)
+            for sql in MODULE_SCHEMAS:
+                cur.execute(sql)
+            cur.execute(SEED_SQL, {"n": events, "members": members, "vote_guild": VOTE_GUILD,
+                                   "coin_guild": COIN_GUILD, "sub_base": SUB_GUILD_BASE})
+        sep = "&" if "?" in url else "?"
+        try:
+            yield f"{url}{sep}options=-csearch_path%3D{schema}", sslmode
+        finally:
+            with admin.cursor() as cur:
+                cur.execute(f"DROP SCHEMA {schema} CASCADE")
+            admin.close()
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# App under gunicorn
+# ─────────────────────────────────────────────────────────────────────────────
+
+@contextmanager
+def gunicorn_app(env: dict, workers: int, threads: int, app_spec="stripe_webhook:app", worker_class=None):
+    port = free_port()
+    log_path = os.path.join(env["METRICS_DIR"], "app.log")
+    log = open(log_path, "w")
+    cmd = [sys.executable, "-m", "gunicorn", app_spec, "-w", str(workers), "--threads", str(threads),
+           "-b", f"127.0.0.1:{port}", "--log-level", "warning"]
+    if worker_class:
+        cmd += ["-k", worker_class]
+    proc = subprocess.Popen(cmd, cwd=REPO_ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + 30
+        # readiness probe only: each worker starts its background work itself
+        # (gunicorn.conf.py post_worker_init), no request needed for that
+        while True:
+            try:
+                if requests.get(base + "/", timeout=1).ok:
+                    break
+            except requests.RequestException:
+                pass
+            if proc.poll() is not None or time.monotonic() > deadline:
+                raise SystemExit(f"app did not start; see {log_path}")
+            time.sleep(0.2)
+        yield base, log_path, proc.pid
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        log.close()
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Metrics
+# ─────────────────────────────────────────────────────────────────────────────
+
+def scrape(base: str) -> dict:
+    """Prometheus text -> {(name, frozenset(labels)): value}, summed over outcomes."""
+    out = defaultdict(float)
+    for line in requests.get(base + "/metrics", timeout=5).text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        head, value = line.rsplit(" ", 1)
+        name, _, labels = head.partition("{")
+        pairs = [p.split("=", 1) for p in labels.rstrip("}").split(",") if p] if labels else []
+        key = frozenset((k, v.strip('"')) for k, v in pairs if k != "outcome")
+        out[(name, key)] += float(value)
+    return out
+
+
+def worker_memory(master_pid: int) -> dict:
+    """Resident and peak memory (MiB) of each gunicorn worker, from /proc (Linux)."""
+    try:
+        with open(f"/proc/{master_pid}/task/{master_pid}/children") as f:
+            children = f.read().split()
+    except OSError:
+        return {}
+    rss, peak = [], []
+    for pid in children:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                status = dict(line.split(":", 1) for line in f if ":" in line)
+        except OSError:
+            continue
+        rss.append(int(status["VmRSS"].split()[0]) / 1024)
+        peak.append(int(status["VmHWM"].split()[0]) / 1024)
+    if not rss:
+        return {}
+    return {"workers": len(rss), "rss_mib_avg": round(sum(rss) / len(rss), 1), "peak_mib_max": round(max(peak), 1)}
+
+
+def event_totals(snapshot: dict, source: str, event_type: str):
+    key = frozenset({("source", source), ("event_type", event_type)})
+    return (snapshot.get(("veil_event_seconds_count", key), 0.0),
+            snapshot.get(("veil_event_seconds_sum", key), 0.0),
+            snapshot.get(("veil_event_db_round_trips_total", key), 0.0))
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Driver
+# ─────────────────────────────────────────────────────────────────────────────
+
+def percentile(sorted_values, p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(p * len(sorted_values)) - 1)]
+
+
+def run_scenario(base: str, factory, events: int, concurrency: int):
+    local = threading.local()
+
+    def send(i):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        kind, body = factory(i)
+        data = json.dumps(body).encode()
+        if kind == "stripe":
+            url, headers = base + "/stripe-webhook", {"Stripe-Signature": sign_stripe(data)}
+        else:
+            url, headers = base + "/topgg-webhook", {"Authorization": TOPGG_AUTH}
+        headers["Content-Type"] = "application/json"
+        start = time.perf_counter()
+        try:
+            ok = session.post(url, data=data, headers=headers, timeout=30).status_code == 200
+        except requests.RequestException:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(send, range(events)))
+    elapsed = time.perf_counter() - start
+    latencies = sorted(r[0] for r in results)
+    return {
+        "events": events,
+        "errors": sum(1 for r in results if not r[1]),
+        "rps": round(events / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def wait_for_handlers(base: str, before: dict, source: str, event_type: str, expected: int, timeout=30.0):
+    """Wait until the app has finished `expected` more events of this type (inbox mode is async)."""
+    deadline = time.monotonic() + timeout
+    while True:
+        time.sleep(1.0)  # > METRICS_FLUSH_INTERVAL below, so every worker's snapshot is fresh
+        after = scrape(base)
+        done = event_totals(after, source, event_type)[0] - event_totals(before, source, event_type)[0]
+        if done >= expected or time.monotonic() > deadline:
+            return after
+
+
+def run_load(scenarios, events=200, concurrency=16, workers=2, threads=4, members=50,
+             upstream_latency_ms=0.0, extra_env=(), app_spec="stripe_webhook:app", worker_class=None) -> dict:
+    """Start stand-ins, a seeded database and the app, run the scenarios; returns the report."""
+    standin = StandInServer(latency=upstream_latency_ms / 1000).start()
+    metrics_dir = tempfile.mkdtemp(prefix="veil_bench_metrics_")
+    results = {}
+    try:
+        with database(events, members) as (db_url, sslmode):
+            env = dict(
+                os.environ,
+                DATABASE_URL=db_url,
+                DB_SSLMODE=sslmode,
+                STRIPE_SECRET_KEY="sk_test_bench",
+                STRIPE_WEBHOOK_SECRET=WEBHOOK_SECRET,
+                STRIPE_API_BASE=standin.base_url,
+                TOPGG_WEBHOOK_AUTH=TOPGG_AUTH,
+                DISCORD_API_BASE=standin.base_url + "/api/v10",
+                SUPPORT_WEBHOOK=standin.base_url + "/api/webhooks/1/support",
+                METRICS_DIR=metrics_dir,
+                METRICS_FLUSH_INTERVAL="0.5",
+                DELIVERY_SPOOL_DIR=os.path.join(metrics_dir, "spool"),
+            )
+            env.update(kv.split("=", 1) for kv in extra_env)
+
+            with gunicorn_app(env, workers, threads, app_spec, worker_class) as (base, log_path, master_pid):
+                for name in scenarios:
+                    factory, (source, event_type) = SCENARIOS[name]
+                    before = scrape(base)
+                    row = run_scenario(base, factory, events, concurrency)
+                    after = wait_for_handlers(base, before, source, event_type, events - row["errors"])
+                    n0, s0, rt0 = event_totals(before, source, event_type)
+                    n1, s1, rt1 = event_totals(after, source, event_type)
+                    handled = n1 - n0
+                    row["handler_ms"] = round((s1 - s0) / handled * 1000, 2) if handled else None
+                    row["db_round_trips"] = round((rt1 - rt0) / handled, 2) if handled else None
+                    results[name] = row
+                    print(f"… {name}: {row['rps']} ev/s", file=sys.stderr)
+                memory = worker_memory(master_pid)
+    finally:
+        standin.stop()
+    return {"results": results, "memory": memory, "standin": dict(standin.requests), "log": log_path}
+
+
+def print_results(results: dict):
+    header = f"{'scenario':<28}{'events':>7}{'err':>5}{'ev/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}" \
+             f"{'handler ms':>12}{'db rt/ev':>10}"
+    print(header)
+    print("-" * len(header))
+    for name, r in results.items():
+        print(f"{name:<28}{r['events']:>7}{r['errors']:>5}{r['rps']:>9}{r['p50_ms']:>9}{r['p95_ms']:>9}"
+              f"{r['p99_ms']:>9}{str(r['handler_ms']):>12}{str(r['db_round_trips']):>10}")
+
+
+def append_json(path: str, record: dict):
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                            capture_output=True, text=True).stdout.strip()
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(dict(at=int(time.time()), commit=commit, **record)) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--events", type=int, default=200, help="events per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn worker processes")
+    parser.add_argument("--threads", type=int, default=4, help="gunicorn threads per worker")
+    parser.add_argument("--members", type=int, default=50, help="members per subscribing guild (bonus size)")
+    parser.add_argument("--upstream-latency", type=float, default=0.0, help="stand-in response delay, ms")
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS), help="repeatable; default all")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra app env")
+    parser.add_argument("--app", default="stripe_webhook:app", help="gunicorn app spec")
+    parser.add_argument("--worker-class", help="gunicorn worker class, e.g. aiohttp.GunicornWebWorker")
+    parser.add_argument("--json", metavar="PATH", help="append the results as one JSON line")
+    args = parser.parse_args()
+
+    report = run_load(args.scenario or list(SCENARIOS), args.events, args.concurrency, args.workers, args.threads,
+                      args.members, args.upstream_latency, args.env, args.app, args.worker_class)
+    print_results(report["results"])
+    print()
+    print("worker memory:", report["memory"])
+    print("stand-in requests:", report["standin"])
+    print("app log:", report["log"])
+
+    if args.json:
+        append_json(args.json, {"app": args.app, "workers": args.workers, "threads": args.threads,
+                                "concurrency": args.concurrency, "env": args.env,
+                                "results": report["results"], "memory": report["memory"]})
+
+
+if __name__ == "__main__":
+    main()
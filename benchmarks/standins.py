@@ -0,0 +1,187 @@
+"""
+Local stand-ins for the services the webhook talks to, for offline load tests.
+
+- StandInServer: one small HTTP server that answers like the Stripe API
+  (subscriptions, and paginated event / subscription lists from fixtures) and
+  Discord (interaction PATCHes, webhook posts). Point STRIPE_API_BASE /
+  DISCORD_API_BASE / SUPPORT_WEBHOOK at it.
+- local_postgres(): a throwaway Postgres cluster from initdb / pg_ctl
+  (PG_BIN selects the binaries, otherwise they are looked up on PATH).
+
+Subscription ids encode what the stand-in should return:
+sub_bench_<guild_id>_<tier>.
+"""
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+TIER_PRICES = {
+    "basic": "price_1RuT1sADYgCtNnMoWMzdQ7YI",
+    "premium": "price_1RuT34ADYgCtNnModSx70nr1",
+    "elite": "price_1RuT3ZADYgCtNnMopSZon3vt",
+}
+COIN_PRICES = {
+    100: "price_1RuT5IADYgCtNnMorF0zsMRK",
+    250: "price_1RuT5dADYgCtNnMoNY5O0cuc",
+    500: "price_1RuT5yADYgCtNnMoWTUR4XMC",
+    1000: "price_1RuT6KADYgCtNnMoKwM3iw9H",
+}
+
+_SUB_RE = re.compile(r"^/v1/subscriptions/(sub_bench_(\d+)_(\w+))$")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def subscription_object(sub_id: str, guild_id: int, tier: str, status="active") -> dict:
+    period_end = int(time.time()) + 30 * 86400
+    return {
+        "id": sub_id,
+        "object": "subscription",
+        "status": status,
+        "metadata": {"guild_id": str(guild_id)},
+        "current_period_end": period_end,
+        "items": {"object": "list", "data": [{
+            "id": f"si_{sub_id}",
+            "object": "subscription_item",
+            "price": {"id": TIER_PRICES.get(tier, tier), "object": "price"},
+            "current_period_end": period_end,
+        }]},
+    }
+
+
+def _list_page(objects, url: str, query: dict) -> dict:
+    """One page of a Stripe list (newest first), honouring limit / starting_after / created / types."""
+    q = {k: v[-1] for k, v in query.items()}
+    types = [v[-1] for k, v in query.items() if k.startswith("types[")]
+    rows = [o for o in objects
+            if (not types or o.get("type") in types)
+            and ("created[gte]" not in q or o["created"] >= int(q["created[gte]"]))
+            and ("created[lt]" not in q or o["created"] < int(q["created[lt]"]))]
+    rows.sort(key=lambda o: (o.get("created", 0), o["id"]), reverse=True)
+    if q.get("starting_after"):
+        ids = [o["id"] for o in rows]
+        rows = rows[ids.index(q["starting_after"]) + 1:] if q["starting_after"] in ids else []
+    limit = int(q.get("limit", 10))
+    return {"object": "list", "url": url, "has_more": len(rows) > limit, "data": rows[:limit]}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status: int, body=None):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        if server.latency:
+            time.sleep(server.latency)
+
+        path, _, query = self.path.partition("?")
+        if path.startswith("/v1/"):
+            kind = f"stripe {self.command} {path.split('/')[2]}"
+            if self.command == "GET" and path in ("/v1/events", "/v1/subscriptions"):
+                server.count(kind + " list")
+                objects = server.events if path == "/v1/events" else server.subscriptions
+                return self._reply(200, _list_page(objects, path, parse_qs(query)))
+            m = _SUB_RE.match(path)
+            if m and self.command in ("GET", "DELETE"):
+                status = "canceled" if self.command == "DELETE" else "active"
+                body = subscription_object(m.group(1), int(m.group(2)), m.group(3), status)
+                server.count(kind)
+                return self._reply(200, body)
+            server.count(kind + " (unknown)")
+            return self._reply(404, {"error": {"type": "invalid_request_error", "message": f"no stand-in for {path}"}})
+
+        if "/webhooks/" in path:
+            kind = "discord interaction_patch" if path.endswith("/messages/@original") else "discord webhook_post"
+            server.count(kind)
+            return self._reply(200, {"id": "1"}) if self.command == "PATCH" else self._reply(204)
+
+        server.count("unknown")
+        self._reply(404, {"message": "not found"})
+
+    do_GET = do_POST = do_PATCH = do_DELETE = _handle
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=None, latency=0.0, events=(), subscriptions=()):
+        super().__init__(("127.0.0.1", port or free_port()), _Handler)
+        self.latency = latency
+        self.events = list(events)                # served by GET /v1/events
+        self.subscriptions = list(subscriptions)  # served by GET /v1/subscriptions
+        self.requests = Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, kind: str):
+        with self._lock:
+            self.requests[kind] += 1
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="standin", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def _pg_tool(name: str) -> str:
+    pg_bin = os.getenv("PG_BIN")
+    path = os.path.join(pg_bin, name) if pg_bin else shutil.which(name)
+    if not path or not os.path.exists(path):
+        raise SystemExit(f"{name} not found; set PG_BIN or BENCH_DATABASE_URL")
+    return path
+
+
+@contextmanager
+def local_postgres():
+    """
+    Start a throwaway Postgres cluster (no fsync, trust auth, localhost only)
+    and yield its URL. Must not run as root -- initdb refuses.
+    """
+    data = tempfile.mkdtemp(prefix="veil_bench_pg_")
+    port = free_port()
+    log = os.path.join(data, "server.log")
+    subprocess.run([_pg_tool("initdb"), "-D", os.path.join(data, "db"), "-U", "postgres",
+                    "-A", "trust", "--no-sync"], check=True, stdout=subprocess.DEVNULL)
+    subprocess.run([_pg_tool("pg_ctl"), "-D", os.path.join(data, "db"), "-l", log, "-w", "start", "-o",
+                    f"-p {port} -k {data} -c listen_addresses=127.0.0.1 -c fsync=off "
+                    f"-c synchronous_commit=off -c full_page_writes=off -c max_connections=200"],
+                   check=True, stdout=subprocess.DEVNULL)
+    try:
+        yield f"postgresql://postgres@127.0.0.1:{port}/postgres"
+    finally:
+        subprocess.run([_pg_tool("pg_ctl"), "-D", os.path.join(data, "db"), "-m", "fast", "-w", "stop"],
+                       stdout=subprocess.DEVNULL)
+        shutil.rmtree(data, ignore_errors=True)
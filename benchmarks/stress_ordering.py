@@ -0,0 +1,286 @@
+"""
+Concurrent, out-of-order Stripe events for the same guilds, delivered to the app
+under gunicorn (several workers, several threads each), with EVENT_ORDERING on
+and off.
+
+    BENCH_DATABASE_URL=postgresql://localhost/veil_bench python benchmarks/stress_ordering.py \
+        --guilds 200 --workers 4 --threads 8
+
+Every guild starts on a basic subscription and then gets, all in flight at once
+and shuffled: the checkout that upgrades it to premium (which cancels the basic
+subscription), the basic subscription's deletion that follows, the premium
+subscription's first invoice and, for a third of the guilds, the premium
+subscription's cancellation. One user buys coin packs at the same time. A 500
+is retried, as Stripe would.
+
+The final rows are checked against applying the same events one by one in
+`created` order. Exits 1 if a mode with ordering on leaves any guild (or the
+coin balance) different.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+import requests
+
+from loadtest import WEBHOOK_SECRET, database, gunicorn_app, scrape, sign_stripe
+from standins import COIN_PRICES, TIER_PRICES, StandInServer
+
+import event_order  # the repo root is on sys.path via loadtest
+
+GUILD_BASE = 300_000
+COIN_USER, COIN_GUILD, COIN_PACK = 777, 2, 250
+
+
+def sub_id(guild_id: int, tier: str) -> str:
+    return f"sub_bench_{guild_id}_{tier}"
+
+
+def _event(n: int, event_type: str, created: int, obj: dict) -> dict:
+    return {"id": f"evt_stress_{n}", "object": "event", "api_version": "2024-06-20", "created": created,
+            "livemode": False, "type": event_type, "data": {"object": obj}}
+
+
+def _subscription(guild_id: int, tier: str, created: int) -> dict:
+    return {"id": sub_id(guild_id, tier), "object": "subscription", "status": "canceled", "created": created,
+            "metadata": {"guild_id": str(guild_id)}}
+
+
+def build_fixtures(guilds: int, coin_packs: int, seed: int = 11):
+    """
+    Per-guild (guild_id, basic subscription, last event on it, shuffled events),
+    the rows applying the events in `created` order leaves, and the coin packs.
+    """
+    rng = random.Random(seed)
+    t0 = int(time.time()) - 3600
+    groups, expected = [], {}
+    n = 0
+    for i in range(guilds):
+        guild_id = GUILD_BASE + i
+        t = t0 + i
+        old, new = sub_id(guild_id, "basic"), sub_id(guild_id, "premium")
+        group = [
+            _event(n + 1, "checkout.session.completed", t, {
+                "id": f"cs_stress_{guild_id}", "object": "checkout.session", "mode": "subscription",
+                "client_reference_id": "1", "subscription": new,
+                "metadata": {"guild_id": str(guild_id), "price_id": TIER_PRICES["premium"]},
+            }),
+            _event(n + 2, "customer.subscription.deleted", t + 1, _subscription(guild_id, "basic", t - 86400)),
+            _event(n + 3, "invoice.payment_succeeded", t + 2, {
+                "id": f"in_stress_{guild_id}", "object": "invoice", "subscription": new,
+                "lines": {"object": "list", "data": [{
+                    "price": {"id": TIER_PRICES["premium"]},
+                    "metadata": {"guild_id": str(guild_id)},
+                    "period": {"end": t + 30 * 86400},
+                }]},
+            }),
+        ]
+        n += 3
+        if i % 3 == 0:
+            n += 1
+            group.append(_event(n, "customer.subscription.deleted", t + 3, _subscription(guild_id, "premium", t)))
+            expected[guild_id] = ("free", None)
+        else:
+            expected[guild_id] = ("premium", new)
+        rng.shuffle(group)
+        groups.append((guild_id, old, t - 3600, group))
+
+    coins = []
+    for i in range(coin_packs):
+        n += 1
+        coins.append(_event(n, "checkout.session.completed", t0 + i, {
+            "id": f"cs_stress_coins_{i}", "object": "checkout.session", "mode": "payment",
+            "client_reference_id": str(COIN_USER),
+            "metadata": {"guild_id": str(COIN_GUILD), "price_id": COIN_PRICES[COIN_PACK]},
+        }))
+    return groups, expected, coins
+
+
+def send_all(base: str, events: list, concurrency: int, retries: int = 20) -> dict:
+    """POST every event, retrying a 500 after a short pause. Returns status counts."""
+    counts = {"ok": 0, "retried": 0, "failed": 0}
+    session = requests.Session()
+
+    def send(event):
+        payload = json.dumps(event).encode()
+        for attempt in range(retries):
+            r = session.post(base + "/stripe-webhook", data=payload, timeout=60,
+                             headers={"Stripe-Signature": sign_stripe(payload), "Content-Type": "application/json"})
+            if r.status_code == 200:
+                return attempt
+            time.sleep(0.05 * (attempt + 1))
+        return None
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        for attempts in pool.map(send, events):
+            if attempts is None:
+                counts["failed"] += 1
+            else:
+                counts["ok"] += 1
+                counts["retried"] += attempts
+    return counts
+
+
+def wait_for_inbox(db_url: str, sslmode: str, timeout: float = 120.0):
+    """With WEBHOOK_INBOX=1 the 200s come before processing; wait for the inbox to drain."""
+    conn = psycopg2.connect(db_url, sslmode=sslmode)
+    conn.autocommit = True
+    deadline = time.monotonic() + timeout
+    try:
+        with conn.cursor() as cur:
+            while time.monotonic() < deadline:
+                cur.execute("SELECT to_regclass('webhook_inbox') IS NOT NULL")
+                if not cur.fetchone()[0]:
+                    return
+                cur.execute("SELECT count(*) FROM webhook_inbox WHERE status IN ('pending', 'processing')")
+                if not cur.fetchone()[0]:
+                    return
+                time.sleep(0.2)
+    finally:
+        conn.close()
+
+
+def check(db_url: str, sslmode: str, expected: dict, coins_expected: int) -> list:
+    conn = psycopg2.connect(db_url, sslmode=sslmode)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT guild_id, tier, subscription_id FROM veil_subscriptions WHERE guild_id >= %s",
+                        (GUILD_BASE,))
+            actual = {g: (t, s) for g, t, s in cur.fetchall()}
+            cur.execute("SELECT COALESCE(SUM(coins), 0) FROM veil_users WHERE user_id = %s AND guild_id = %s",
+                        (COIN_USER, COIN_GUILD))
+            coins = cur.fetchone()[0]
+            cur.execute("SELECT to_regclass('coin_ledger') IS NOT NULL")
+            if cur.fetchone()[0]:  # COIN_LEDGER=1: add what the compactor has not folded yet
+                cur.execute("""
+                    SELECT COALESCE(SUM(delta), 0) FROM coin_ledger
+                     WHERE user_id = %s AND guild_id = %s AND compacted_at IS NULL
+                """, (COIN_USER, COIN_GUILD))
+                coins += cur.fetchone()[0]
+    finally:
+        conn.close()
+    problems = []
+    wrong = sorted(g for g, want in expected.items() if actual.get(g) != want)
+    if wrong:
+        problems.append(f"{len(wrong)} guild(s) differ, e.g. {wrong[0]}: {actual.get(wrong[0])} != {expected[wrong[0]]}")
+    if coins != coins_expected:
+        problems.append(f"coins {coins} != {coins_expected}")
+    return problems
+
+
+def _gauge(snapshot: dict, name: str) -> float:
+    return sum(v for (n, _), v in snapshot.items() if n == name)
+
+
+def run_mode(name: str, extra_env: dict, args, groups, expected, coins) -> dict:
+    standin = StandInServer(latency=args.upstream_latency / 1000).start()
+    metrics_dir = tempfile.mkdtemp(prefix="veil_bench_metrics_")
+    try:
+        with database(1, args.members) as (db_url, sslmode):
+            conn = psycopg2.connect(db_url, sslmode=sslmode)
+            with conn, conn.cursor() as cur:
+                # each guild on its basic subscription, with the watermark its last event left
+                cur.execute(event_order.SCHEMA_SQL)
+                cur.executemany("""
+                    INSERT INTO veil_subscriptions (guild_id, tier, subscribed_at, subscription_id, payment_failed)
+                    VALUES (%s, 'basic', NOW(), %s, FALSE)
+                """, [(guild_id, old) for guild_id, old, _, _ in groups])
+                cur.executemany("INSERT INTO event_watermarks (shard, created, event_id) VALUES (%s, %s, 'evt_seed')",
+                                [(f"guild:{guild_id}", last) for guild_id, _, last, _ in groups])
+            conn.close()
+
+            env = dict(
+                os.environ,
+                DATABASE_URL=db_url,
+                DB_SSLMODE=sslmode,
+                STRIPE_SECRET_KEY="sk_test_bench",
+                STRIPE_WEBHOOK_SECRET=WEBHOOK_SECRET,
+                STRIPE_API_BASE=standin.base_url,
+                DISCORD_API_BASE=standin.base_url + "/api/v10",
+                SUPPORT_WEBHOOK=standin.base_url + "/api/webhooks/1/support",
+                METRICS_DIR=metrics_dir,
+                METRICS_FLUSH_INTERVAL="0.5",
+                DELIVERY_SPOOL_DIR=os.path.join(metrics_dir, "spool"),
+                **extra_env,
+            )
+            env.update(kv.split("=", 1) for kv in args.env)
+
+            # a guild's events go out back to back, so they are in flight together;
+            # the coin packs are spread evenly between them
+            events = [e for _, _, _, group in groups for e in group]
+            total = len(events)
+            for i, event in enumerate(coins):
+                events.insert(i * total // len(coins) + i, event)
+
+            with gunicorn_app(env, args.workers, args.threads, args.app, args.worker_class) as (base, log_path, _):
+                start = time.perf_counter()
+                counts = send_all(base, events, args.concurrency)
+                wait_for_inbox(db_url, sslmode)
+                seconds = time.perf_counter() - start
+                time.sleep(1.0)  # one metrics flush
+                snapshot = scrape(base)
+            problems = check(db_url, sslmode, expected, len(coins) * COIN_PACK)
+    finally:
+        standin.stop()
+    entered = _gauge(snapshot, "veil_event_order_entered")
+    return {
+        "mode": name,
+        "events": len(events),
+        "seconds": round(seconds, 2),
+        "ev_s": round(len(events) / seconds, 1) if seconds else 0.0,
+        "retried": counts["retried"],
+        "failed": counts["failed"],
+        "stale": int(_gauge(snapshot, "veil_event_stale_total")),
+        "lock_wait_ms": round(_gauge(snapshot, "veil_event_order_lock_wait_ms_total") / entered, 2) if entered else None,
+        "cancels": standin.requests.get("stripe DELETE subscriptions", 0),
+        "problems": problems,
+        "log": log_path,
+    }
+
+
+MODES = {
+    "ordered": {"EVENT_ORDERING": "1"},
+    "unordered": {"EVENT_ORDERING": "0"},
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="concurrent same-guild Stripe events, ordering on vs off")
+    parser.add_argument("--guilds", type=int, default=200)
+    parser.add_argument("--coin-packs", type=int, default=100, help="coin packs for one user, sent alongside")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn worker processes")
+    parser.add_argument("--threads", type=int, default=8, help="gunicorn threads per worker")
+    parser.add_argument("--members", type=int, default=0, help="members per guild (bonus size)")
+    parser.add_argument("--upstream-latency", type=float, default=20.0, help="stand-in response delay, ms")
+    parser.add_argument("--mode", action="append", choices=list(MODES), help="repeatable; default both")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra app env")
+    parser.add_argument("--app", default="stripe_webhook:app", help="gunicorn app spec")
+    parser.add_argument("--worker-class", help="gunicorn worker class, e.g. aiohttp.GunicornWebWorker")
+    args = parser.parse_args()
+
+    groups, expected, coins = build_fixtures(args.guilds, args.coin_packs)
+    rows = [run_mode(name, MODES[name], args, groups, expected, coins) for name in (args.mode or list(MODES))]
+
+    print()
+    print(f"{'mode':<11}{'events':>7}{'seconds':>9}{'ev/s':>8}{'retried':>9}{'failed':>8}{'stale':>7}"
+          f"{'wait ms':>9}{'cancels':>9}  result")
+    for r in rows:
+        result = "; ".join(r["problems"]) or "matches created order"
+        print(f"{r['mode']:<11}{r['events']:>7}{r['seconds']:>9}{r['ev_s']:>8}{r['retried']:>9}{r['failed']:>8}"
+              f"{r['stale']:>7}{str(r['lock_wait_ms']):>9}{r['cancels']:>9}  {result}")
+    print()
+    bad = [r for r in rows if MODES[r["mode"]]["EVENT_ORDERING"] == "1" and (r["problems"] or r["failed"])]
+    if bad:
+        print("❌ ordering on, but the final state does not match; see", bad[0]["log"])
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
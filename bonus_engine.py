@@ -0,0 +1,312 @@
+"""
+Guild-wide bonus coins, applied in small batches.
+
+A bonus used to be one `UPDATE veil_users ... WHERE guild_id = %s`, which locks
+every member row of a big guild for the whole statement. Instead, each bonus
+is recorded as a row in `bonus_grants` keyed by what caused it (checkout
+session / invoice id), and applied in keyset-paginated batches of
+BONUS_BATCH_SIZE members, one short transaction per batch. The grant row holds
+the keyset cursor and is advanced in the same transaction as the credits, so
+an interrupted grant resumes where it stopped and is never applied twice; a
+repeated webhook finds the grant key already present and does nothing.
+"""
+import asyncio
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+from psycopg2.extras import execute_values
+
+import coin_ledger
+import event_log
+from db_pool import Prepared, get_db_conn
+
+BONUS_BATCH_SIZE = int(os.getenv("BONUS_BATCH_SIZE", "500"))
+BONUS_BATCH_PAUSE = float(os.getenv("BONUS_BATCH_PAUSE", "0.02"))  # seconds between batches, lets other writers in
+BONUS_BACKGROUND = os.getenv("BONUS_BACKGROUND", "1").lower() not in ("0", "false", "no")
+BONUS_RESUME_AFTER = int(os.getenv("BONUS_RESUME_AFTER", "60"))  # a grant untouched this long is considered abandoned
+
+SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS bonus_grants (
+        grant_key      TEXT PRIMARY KEY,
+        guild_id       BIGINT NOT NULL,
+        amount         INTEGER NOT NULL,
+        granted_at     TIMESTAMPTZ NOT NULL,           -- written to last_refill of every member
+        last_user_id   BIGINT NOT NULL DEFAULT 0,      -- keyset cursor: members up to here are done
+        users_credited INTEGER NOT NULL DEFAULT 0,
+        status         TEXT NOT NULL DEFAULT 'running', -- running | done
+        created_at     TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        updated_at     TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        completed_at   TIMESTAMPTZ
+    );
+    CREATE INDEX IF NOT EXISTS bonus_grants_running_idx
+        ON bonus_grants (created_at)
+     WHERE status = 'running';
+"""
+
+
+def ensure_schema():
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute(SCHEMA_SQL)
+
+
+CREATE_GRANT = Prepared("veil_bonus_create_grant", ("text", "bigint", "integer", "timestamptz"), """
+    INSERT INTO bonus_grants (grant_key, guild_id, amount, granted_at)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (grant_key) DO NOTHING
+ RETURNING grant_key
+""")
+
+# the grant row lock serializes runners of the same grant (e.g. two workers resuming it)
+LOCK_GRANT = Prepared("veil_bonus_lock_grant", ("text",), """
+    SELECT guild_id, amount, granted_at, last_user_id
+      FROM bonus_grants
+     WHERE grant_key = $1 AND status = 'running'
+       FOR UPDATE
+""")
+
+# $1 guild, $2 after user, $3 limit, $4 amount, $5 granted_at (ledger: $6 grant key)
+CREDIT_BATCH = Prepared("veil_bonus_credit_batch", ("bigint", "bigint", "integer", "integer", "timestamptz"), """
+    WITH batch AS (
+        SELECT user_id
+          FROM veil_users
+         WHERE guild_id = $1 AND user_id > $2
+      ORDER BY user_id
+         LIMIT $3
+           FOR UPDATE
+    ), credited AS (
+        UPDATE veil_users u
+           SET coins = COALESCE(u.coins, 0) + $4,
+               last_refill = $5
+          FROM batch
+         WHERE u.guild_id = $1 AND u.user_id = batch.user_id
+     RETURNING u.user_id
+    )
+    SELECT COUNT(*), MAX(user_id) FROM credited
+""")
+
+# ledger mode: append one entry per member, no member row locks
+LEDGER_CREDIT_BATCH = Prepared("veil_bonus_ledger_credit_batch",
+                               ("bigint", "bigint", "integer", "integer", "timestamptz", "text"), """
+    WITH credited AS (
+        INSERT INTO coin_ledger (user_id, guild_id, delta, reason, ref, created_at)
+        SELECT user_id, guild_id, $4, 'bonus', $6, $5
+          FROM veil_users
+         WHERE guild_id = $1 AND user_id > $2
+      ORDER BY user_id
+         LIMIT $3
+     RETURNING user_id
+    )
+    SELECT COUNT(*), MAX(user_id) FROM credited
+""")
+
+ADVANCE_GRANT = Prepared("veil_bonus_advance_grant", ("bigint", "integer", "boolean", "text"), """
+    UPDATE bonus_grants
+       SET last_user_id = COALESCE($1, last_user_id),
+           users_credited = users_credited + $2,
+           status = CASE WHEN $3 THEN 'done' ELSE status END,
+           completed_at = CASE WHEN $3 THEN NOW() END,
+           updated_at = NOW()
+     WHERE grant_key = $4
+""")
+
+PENDING_GRANTS = Prepared("veil_bonus_pending_grants", ("double precision",), """
+    SELECT grant_key
+      FROM bonus_grants
+     WHERE status = 'running'
+       AND updated_at < NOW() - make_interval(secs => $1)
+  ORDER BY created_at
+""")
+
+
+def _credit_batch(grant_key, guild_id, last_user_id, batch_size, amount, granted_at):
+    """The statement crediting the next batch, and its parameters."""
+    params = (guild_id, last_user_id, batch_size, amount, granted_at)
+    if coin_ledger.COIN_LEDGER_ENABLED:
+        return LEDGER_CREDIT_BATCH, params + (grant_key,)
+    return CREDIT_BATCH, params
+
+
+def create_grant(grant_key: str, guild_id, amount: int) -> bool:
+    """Record a grant. Returns False if this grant key was already recorded."""
+    with get_db_conn() as conn, conn.cursor() as cur:
+        CREATE_GRANT.execute(cur, (grant_key, guild_id, amount, datetime.now(timezone.utc)))
+        return cur.fetchone() is not None
+
+
+def create_grants(rows) -> list:
+    """Record many grants at once: rows of (grant_key, guild_id, amount). Returns the keys that were new."""
+    now = datetime.now(timezone.utc)
+    with get_db_conn() as conn, conn.cursor() as cur:
+        created = execute_values(cur, """
+            INSERT INTO bonus_grants (grant_key, guild_id, amount, granted_at)
+            VALUES %s
+            ON CONFLICT (grant_key) DO NOTHING
+         RETURNING grant_key
+        """, [(key, guild_id, amount, now) for key, guild_id, amount in rows], page_size=1000, fetch=True)
+    return [r[0] for r in created]
+
+
+def apply_batch(grant_key: str, batch_size: int = BONUS_BATCH_SIZE):
+    """
+    Credit the next batch of members for one grant.
+    Returns the number of members credited, or None once the grant is done.
+    """
+    with get_db_conn() as conn, conn.cursor() as cur:
+        row = LOCK_GRANT.execute(cur, (grant_key,)).fetchone()
+        if row is None:
+            return None
+        guild_id, amount, granted_at, last_user_id = row
+        stmt, params = _credit_batch(grant_key, guild_id, last_user_id, batch_size, amount, granted_at)
+        count, max_user = stmt.execute(cur, params).fetchone()
+        ADVANCE_GRANT.execute(cur, (max_user, count, count < batch_size, grant_key))
+    return count
+
+
+def run_grant(grant_key: str):
+    """Apply a grant to completion, batch by batch."""
+    total = 0
+    batches = 0
+    while True:
+        count = apply_batch(grant_key)
+        if count is None:
+            break
+        total += count
+        batches += 1
+        if count < BONUS_BATCH_SIZE:
+            break
+        if BONUS_BATCH_PAUSE:
+            time.sleep(BONUS_BATCH_PAUSE)
+    if batches:
+        event_log.note(f"💰 Bonus grant {grant_key}: credited {total} member(s) in {batches} batch(es)")
+    return total
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Background runner
+# ─────────────────────────────────────────────────────────────────────────────
+
+_jobs = queue.Queue()
+_runner_pid = None
+_runner_lock = threading.Lock()
+
+
+def _after_fork_in_child():
+    global _jobs, _runner_pid, _runner_lock
+    _jobs = queue.Queue()
+    _runner_pid = None
+    _runner_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _run_forever():
+    while True:
+        try:
+            grant_key = _jobs.get(timeout=BONUS_RESUME_AFTER)
+        except queue.Empty:
+            try:
+                resume_pending()
+            except Exception as e:
+                event_log.note(f"⚠️ [bonus] could not look for unfinished grants: {e}", error=True)
+            continue
+        try:
+            run_grant(grant_key)
+        except Exception as e:
+            # the cursor is committed per batch; a later resume_pending() picks it up from there
+            event_log.note(f"❌ Bonus grant {grant_key} interrupted: {e}", error=True)
+
+
+def resume_pending(min_age_seconds: int = BONUS_RESUME_AFTER):
+    """Queue grants left running by a crashed or restarted process."""
+    with get_db_conn() as conn, conn.cursor() as cur:
+        keys = [r[0] for r in PENDING_GRANTS.execute(cur, (min_age_seconds,)).fetchall()]
+    for key in keys:
+        _jobs.put(key)
+    if keys:
+        event_log.note(f"[bonus] resuming {len(keys)} unfinished grant(s)")
+    return keys
+
+
+def _ensure_runner():
+    global _runner_pid
+    if _runner_pid == os.getpid():
+        return
+    with _runner_lock:
+        if _runner_pid == os.getpid():
+            return
+        ensure_schema()
+        threading.Thread(target=_run_forever, name="bonus-runner", daemon=True).start()
+        _runner_pid = os.getpid()
+        try:
+            resume_pending()
+        except Exception as e:
+            event_log.note(f"⚠️ [bonus] could not resume pending grants: {e}", error=True)
+
+
+def grant_bonus(grant_key: str, guild_id, amount: int) -> bool:
+    """
+    Record a guild-wide bonus and start applying it. Returns False when the same
+    grant key was already recorded (webhook retry), in which case nothing happens.
+    """
+    _ensure_runner()
+    if not create_grant(grant_key, guild_id, amount):
+        event_log.note(f"[bonus] grant {grant_key} already recorded; skipping")
+        return False
+    if BONUS_BACKGROUND:
+        _jobs.put(grant_key)
+    else:
+        run_grant(grant_key)
+    return True
+
+# ─────────────────────────────────────────────────────────────────────────────
+# asyncpg (stripe_webhook_async)
+# ─────────────────────────────────────────────────────────────────────────────
+# Same statements and batches on the async app's own pool; it runs grants as
+# tasks on its event loop instead of on the runner thread.
+
+async def create_grant_async(conn, grant_key: str, guild_id, amount: int) -> bool:
+    """create_grant on an asyncpg connection."""
+    return await conn.fetchval(CREATE_GRANT.typed_sql, grant_key, guild_id, amount,
+                               datetime.now(timezone.utc)) is not None
+
+
+async def apply_batch_async(conn, grant_key: str, batch_size: int = BONUS_BATCH_SIZE):
+    """apply_batch on an asyncpg connection, in one transaction."""
+    async with conn.transaction():
+        row = await conn.fetchrow(LOCK_GRANT.typed_sql, grant_key)
+        if row is None:
+            return None
+        guild_id, amount, granted_at, last_user_id = row
+        stmt, params = _credit_batch(grant_key, guild_id, last_user_id, batch_size, amount, granted_at)
+        count, max_user = await conn.fetchrow(stmt.typed_sql, *params)
+        await conn.execute(ADVANCE_GRANT.typed_sql, max_user, count, count < batch_size, grant_key)
+    return count
+
+
+async def run_grant_async(pool, grant_key: str):
+    """run_grant on an asyncpg pool: a connection per batch, so other handlers get one in between."""
+    total = 0
+    batches = 0
+    while True:
+        async with pool.acquire() as conn:
+            count = await apply_batch_async(conn, grant_key)
+        if count is None:
+            break
+        total += count
+        batches += 1
+        if count < BONUS_BATCH_SIZE:
+            break
+        if BONUS_BATCH_PAUSE:
+            await asyncio.sleep(BONUS_BATCH_PAUSE)
+    if batches:
+        event_log.note(f"💰 Bonus grant {grant_key}: credited {total} member(s) in {batches} batch(es)")
+    return total
+
+
+async def pending_grants_async(conn, min_age_seconds: int = BONUS_RESUME_AFTER) -> list:
+    """Grants left running by a crashed or restarted process (resume_pending's query)."""
+    return [r[0] for r in await conn.fetch(PENDING_GRANTS.typed_sql, min_age_seconds)]
@@ -0,0 +1,249 @@
+"""
+Append-only coin ledger (COIN_LEDGER=1).
+
+In ledger mode, credits (votes, coin packs, tier bonuses) are INSERTed into
+`coin_ledger` instead of read-modify-writing `veil_users.coins`, so concurrent
+credits for one user or one guild no longer queue on the same row locks. A
+compactor folds pending entries into `veil_users` every COIN_LEDGER_COMPACT_INTERVAL
+seconds (FOR UPDATE SKIP LOCKED, so every worker process can run one), and a
+balance lookup is the compacted value plus whatever is still pending.
+
+    python coin_ledger.py compact      # fold everything pending now
+    python coin_ledger.py check        # consistency report, exit 1 on problems
+"""
+import os
+import sys
+import threading
+import time
+
+import event_log
+from db_pool import get_db_conn
+
+COIN_LEDGER_ENABLED = os.getenv("COIN_LEDGER", "0").lower() in ("1", "true", "yes")
+COIN_LEDGER_COMPACT_INTERVAL = float(os.getenv("COIN_LEDGER_COMPACT_INTERVAL", "5"))
+COIN_LEDGER_COMPACT_BATCH = int(os.getenv("COIN_LEDGER_COMPACT_BATCH", "5000"))
+
+SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS coin_ledger (
+        id           BIGSERIAL PRIMARY KEY,
+        user_id      BIGINT NOT NULL,
+        guild_id     BIGINT NOT NULL,
+        delta        INTEGER NOT NULL,
+        reason       TEXT NOT NULL,      -- topgg_vote | coin_purchase | bonus
+        ref          TEXT,               -- vote session id / stripe session id / bonus grant key
+        created_at   TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        compacted_at TIMESTAMPTZ
+    );
+    CREATE INDEX IF NOT EXISTS coin_ledger_pending_user_idx
+        ON coin_ledger (user_id, guild_id)
+     WHERE compacted_at IS NULL;
+    CREATE INDEX IF NOT EXISTS coin_ledger_pending_id_idx
+        ON coin_ledger (id)
+     WHERE compacted_at IS NULL;
+"""
+
+
+def ensure_schema():
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute(SCHEMA_SQL)
+
+
+def compact_once(limit: int = COIN_LEDGER_COMPACT_BATCH):
+    """Fold up to `limit` pending entries into veil_users. Returns (entries, users) touched."""
+    with get_db_conn() as conn, conn.cursor() as cur:
+        # folding changes no balance, so the entitlement cache need not hear about it
+        cur.execute("""
+            SET LOCAL veil.balance_unchanged = 'on';
+            WITH moved AS (
+                UPDATE coin_ledger
+                   SET compacted_at = NOW()
+                 WHERE id IN (
+                        SELECT id
+                          FROM coin_ledger
+                         WHERE compacted_at IS NULL
+                      ORDER BY id
+                         LIMIT %s
+                           FOR UPDATE SKIP LOCKED
+                       )
+             RETURNING user_id, guild_id, delta, reason, created_at
+            ), agg AS (
+                SELECT user_id, guild_id,
+                       SUM(delta) AS delta,
+                       MAX(created_at) FILTER (WHERE reason = 'topgg_vote') AS last_vote,
+                       MAX(created_at) FILTER (WHERE reason = 'bonus') AS last_bonus
+                  FROM moved
+              GROUP BY user_id, guild_id
+            ), folded AS (
+                INSERT INTO veil_users (user_id, guild_id, coins, topgg_last_vote_at, last_refill)
+                SELECT user_id, guild_id, delta, last_vote, last_bonus
+                  FROM agg
+              ORDER BY user_id, guild_id
+                ON CONFLICT (user_id, guild_id) DO UPDATE
+                   SET coins = COALESCE(veil_users.coins, 0) + EXCLUDED.coins,
+                       topgg_last_vote_at = GREATEST(veil_users.topgg_last_vote_at, EXCLUDED.topgg_last_vote_at),
+                       last_refill = GREATEST(veil_users.last_refill, EXCLUDED.last_refill)
+             RETURNING 1
+            )
+            SELECT (SELECT COUNT(*) FROM moved), (SELECT COUNT(*) FROM folded)
+        """, (limit,))
+        return cur.fetchone()
+
+
+def compact_all(limit: int = COIN_LEDGER_COMPACT_BATCH):
+    entries = users = 0
+    while True:
+        e, u = compact_once(limit)
+        entries += e
+        users += u
+        if e < limit:
+            return entries, users
+
+
+def get_balance(user_id, guild_id, cur=None) -> int:
+    """Compacted balance plus pending ledger entries."""
+    sql = """
+        SELECT COALESCE((SELECT coins FROM veil_users WHERE user_id = %(u)s AND guild_id = %(g)s), 0)
+             + COALESCE((SELECT SUM(delta) FROM coin_ledger
+                          WHERE user_id = %(u)s AND guild_id = %(g)s AND compacted_at IS NULL), 0)
+    """
+    if cur is not None:
+        cur.execute(sql, {"u": user_id, "g": guild_id})
+        return cur.fetchone()[0]
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute(sql, {"u": user_id, "g": guild_id})
+        return cur.fetchone()[0]
+
+
+def check(stale_after_seconds: int = 300) -> dict:
+    """
+    Consistency report:
+    - pending entries and the age of the oldest one (compactor falling behind / not running)
+    - compacted entries whose user row does not exist (fold lost)
+    - the same ref credited more than once to the same user (double credit)
+    - users whose balance including pending entries is negative
+    """
+    report = {}
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT COUNT(*), COALESCE(EXTRACT(EPOCH FROM NOW() - MIN(created_at)), 0)
+              FROM coin_ledger
+             WHERE compacted_at IS NULL
+        """)
+        pending, oldest = cur.fetchone()
+        report["pending_entries"] = pending
+        report["oldest_pending_seconds"] = round(float(oldest), 1)
+        report["compactor_behind"] = float(oldest) > stale_after_seconds
+
+        cur.execute("""
+            SELECT COUNT(*)
+              FROM coin_ledger l
+             WHERE l.compacted_at IS NOT NULL
+               AND NOT EXISTS (SELECT 1 FROM veil_users u WHERE u.user_id = l.user_id AND u.guild_id = l.guild_id)
+        """)
+        report["orphaned_entries"] = cur.fetchone()[0]
+
+        cur.execute("""
+            SELECT reason, ref, user_id, guild_id, COUNT(*)
+              FROM coin_ledger
+             WHERE ref IS NOT NULL
+          GROUP BY reason, ref, user_id, guild_id
+            HAVING COUNT(*) > 1
+             LIMIT 50
+        """)
+        report["duplicate_refs"] = [
+            {"reason": r, "ref": ref, "user_id": u, "guild_id": g, "count": n} for r, ref, u, g, n in cur.fetchall()
+        ]
+
+        cur.execute("""
+            SELECT u.user_id, u.guild_id, COALESCE(u.coins, 0) + COALESCE(p.pending, 0)
+              FROM veil_users u
+              LEFT JOIN (
+                    SELECT user_id, guild_id, SUM(delta) AS pending
+                      FROM coin_ledger
+                     WHERE compacted_at IS NULL
+                  GROUP BY user_id, guild_id
+                   ) p USING (user_id, guild_id)
+             WHERE COALESCE(u.coins, 0) + COALESCE(p.pending, 0) < 0
+             LIMIT 50
+        """)
+        report["negative_balances"] = [{"user_id": u, "guild_id": g, "balance": b} for u, g, b in cur.fetchall()]
+
+    report["ok"] = not (report["compactor_behind"] or report["orphaned_entries"]
+                        or report["duplicate_refs"] or report["negative_balances"])
+    return report
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Background compactor
+# ─────────────────────────────────────────────────────────────────────────────
+
+_compactor_pid = None
+_compactor_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {"runs": 0, "entries": 0, "users": 0, "errors": 0, "last_run_ms": 0.0}
+
+
+def _compact_forever():
+    while True:
+        time.sleep(COIN_LEDGER_COMPACT_INTERVAL)
+        start = time.monotonic()
+        try:
+            entries, users = compact_all()
+        except Exception as e:
+            with _stats_lock:
+                _stats["errors"] += 1
+            event_log.note(f"❌ [ledger] compaction failed: {e}", error=True)
+            continue
+        with _stats_lock:
+            _stats["runs"] += 1
+            _stats["entries"] += entries
+            _stats["users"] += users
+            _stats["last_run_ms"] = round((time.monotonic() - start) * 1000, 1)
+
+
+def ensure_compactor() -> bool:
+    """Start this process's compactor once (ledger mode only). False if the schema could not be ensured."""
+    global _compactor_pid
+    if not COIN_LEDGER_ENABLED or _compactor_pid == os.getpid():
+        return True
+    with _compactor_lock:
+        if _compactor_pid == os.getpid():
+            return True
+        try:
+            ensure_schema()
+        except Exception as e:
+            event_log.note(f"❌ [ledger] could not ensure schema: {e}", error=True)
+            return False
+        threading.Thread(target=_compact_forever, name="ledger-compactor", daemon=True).start()
+        _compactor_pid = os.getpid()
+        return True
+
+
+def ledger_stats() -> dict:
+    with _stats_lock:
+        out = dict(_stats)
+    return dict(out, enabled=COIN_LEDGER_ENABLED, running=_compactor_pid == os.getpid())
+
+
+def _after_fork_in_child():
+    global _compactor_lock, _stats_lock
+    _compactor_lock = threading.Lock()
+    _stats_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+if __name__ == "__main__":
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "check"
+    if cmd == "compact":
+        ensure_schema()
+        entries, users = compact_all()
+        print(f"compacted {entries} entrie(s) into {users} user row(s)")
+    elif cmd == "check":
+        result = check()
+        for key, value in result.items():
+            print(f"{key}: {value}")
+        sys.exit(0 if result["ok"] else 1)
+    else:
+        sys.exit(f"usage: {sys.argv[0]} compact|check")
@@ -0,0 +1,257 @@
+"""
+Coin credit statements for the vote and coin-purchase paths.
+
+Each flow is a single server-side statement (data-modifying CTEs), prepared
+once per pooled connection, that returns everything the handler needs --
+the new balance and the interaction to patch -- in one fetch.
+
+With COIN_LEDGER=1 the same flows append to coin_ledger instead of updating
+veil_users.coins, and report compacted + pending + this credit as the balance.
+"""
+import coin_ledger
+from db_pool import Prepared
+
+TOPGG_VOTE_CREDIT = Prepared("veil_topgg_vote_credit", ("bigint", "integer"), """
+    WITH sess AS (
+        UPDATE topgg_vote_sessions
+           SET used = TRUE
+         WHERE id = (
+                SELECT id
+                  FROM topgg_vote_sessions
+                 WHERE user_id = $1 AND used = FALSE
+              ORDER BY created_at DESC
+                 LIMIT 1
+                   FOR UPDATE
+               )
+           AND used = FALSE
+     RETURNING id, guild_id, interaction_token, application_id
+    ), credit AS (
+        INSERT INTO veil_users (user_id, guild_id, coins, topgg_last_vote_at)
+        SELECT $1, guild_id, $2, NOW() FROM sess
+        ON CONFLICT (user_id, guild_id) DO UPDATE
+           SET coins = COALESCE(veil_users.coins, 0) + EXCLUDED.coins,
+               topgg_last_vote_at = NOW()
+     RETURNING coins
+    ), vote AS (
+        INSERT INTO vote_events (provider, user_id, guild_id, voted_at, nonce)
+        SELECT 'topgg', $1, guild_id, NOW(), id::text FROM sess
+        ON CONFLICT DO NOTHING  -- (nonce) unpartitioned, (nonce, voted_at) per partition
+    )
+    SELECT sess.id, sess.guild_id, sess.interaction_token, sess.application_id, credit.coins
+      FROM sess
+      LEFT JOIN credit ON TRUE
+""")
+
+# Several users' votes in one statement (vote_gate's micro-batches): the newest
+# unused session of each, one row per user that had one. $1 holds distinct users.
+TOPGG_VOTE_CREDIT_BATCH = Prepared("veil_topgg_vote_credit_batch", ("bigint[]", "integer"), """
+    WITH pick AS (
+        SELECT s.id
+          FROM unnest($1) AS v(user_id)
+         CROSS JOIN LATERAL (
+                SELECT id
+                  FROM topgg_vote_sessions
+                 WHERE user_id = v.user_id AND used = FALSE
+              ORDER BY created_at DESC
+                 LIMIT 1
+                   FOR UPDATE
+               ) s
+    ), sess AS (
+        UPDATE topgg_vote_sessions t
+           SET used = TRUE
+          FROM pick
+         WHERE t.id = pick.id
+           AND t.used = FALSE
+     RETURNING t.id, t.user_id, t.guild_id, t.interaction_token, t.application_id
+    ), credit AS (
+        INSERT INTO veil_users (user_id, guild_id, coins, topgg_last_vote_at)
+        SELECT user_id, guild_id, $2, NOW() FROM sess
+        ON CONFLICT (user_id, guild_id) DO UPDATE
+           SET coins = COALESCE(veil_users.coins, 0) + EXCLUDED.coins,
+               topgg_last_vote_at = NOW()
+     RETURNING user_id, guild_id, coins
+    ), vote AS (
+        INSERT INTO vote_events (provider, user_id, guild_id, voted_at, nonce)
+        SELECT 'topgg', user_id, guild_id, NOW(), id::text FROM sess
+        ON CONFLICT DO NOTHING
+    )
+    SELECT sess.user_id, sess.id, sess.guild_id, sess.interaction_token, sess.application_id, credit.coins
+      FROM sess
+      LEFT JOIN credit ON credit.user_id = sess.user_id AND credit.guild_id = sess.guild_id
+""")
+
+# A coin pack is credited once per checkout session: the coin_purchase_credits
+# row is the claim, and a session that already has one (a Stripe retry, or an
+# inbox event reclaimed after its credit committed) credits nothing.
+
+COIN_PURCHASE_CREDIT = Prepared("veil_coin_purchase_credit", ("bigint", "bigint", "integer", "text"), """
+    WITH claim AS (
+        INSERT INTO coin_purchase_credits (stripe_session_id, user_id, guild_id, coins)
+        VALUES ($4, $1, $2, $3)
+        ON CONFLICT (stripe_session_id) DO NOTHING
+     RETURNING stripe_session_id
+    ), credit AS (
+        INSERT INTO veil_users (user_id, guild_id, coins)
+        SELECT $1, $2, $3 FROM claim
+        ON CONFLICT (user_id, guild_id) DO UPDATE
+           SET coins = COALESCE(veil_users.coins, 0) + EXCLUDED.coins
+     RETURNING coins
+    )
+    SELECT credit.coins, s.stripe_session_id IS NOT NULL,
+           s.interaction_token, s.application_id, s.user_id, s.guild_id, s.coins
+      FROM credit
+      LEFT JOIN coin_checkout_sessions s ON s.stripe_session_id = $4
+""")
+
+# ── ledger mode ──────────────────────────────────────────────────────────────
+# The ledger row written by the CTE is not visible to the same statement's
+# snapshot, so the new balance adds the credited amount explicitly.
+
+_LEDGER_BALANCE = """
+    COALESCE((SELECT coins FROM veil_users u WHERE u.user_id = {user} AND u.guild_id = {guild}), 0)
+  + COALESCE((SELECT SUM(delta) FROM coin_ledger l
+               WHERE l.user_id = {user} AND l.guild_id = {guild} AND l.compacted_at IS NULL), 0)
+"""
+
+LEDGER_TOPGG_VOTE_CREDIT = Prepared("veil_ledger_topgg_vote_credit", ("bigint", "integer"), """
+    WITH sess AS (
+        UPDATE topgg_vote_sessions
+           SET used = TRUE
+         WHERE id = (
+                SELECT id
+                  FROM topgg_vote_sessions
+                 WHERE user_id = $1 AND used = FALSE
+              ORDER BY created_at DESC
+                 LIMIT 1
+                   FOR UPDATE
+               )
+           AND used = FALSE
+     RETURNING id, guild_id, interaction_token, application_id
+    ), entry AS (
+        INSERT INTO coin_ledger (user_id, guild_id, delta, reason, ref)
+        SELECT $1, guild_id, $2, 'topgg_vote', id::text FROM sess
+    ), vote AS (
+        INSERT INTO vote_events (provider, user_id, guild_id, voted_at, nonce)
+        SELECT 'topgg', $1, guild_id, NOW(), id::text FROM sess
+        ON CONFLICT DO NOTHING  -- (nonce) unpartitioned, (nonce, voted_at) per partition
+    )
+    SELECT sess.id, sess.guild_id, sess.interaction_token, sess.application_id,
+           """ + _LEDGER_BALANCE.format(user="$1", guild="sess.guild_id") + """ + $2
+      FROM sess
+""")
+
+LEDGER_TOPGG_VOTE_CREDIT_BATCH = Prepared("veil_ledger_topgg_vote_credit_batch", ("bigint[]", "integer"), """
+    WITH pick AS (
+        SELECT s.id
+          FROM unnest($1) AS v(user_id)
+         CROSS JOIN LATERAL (
+                SELECT id
+                  FROM topgg_vote_sessions
+                 WHERE user_id = v.user_id AND used = FALSE
+              ORDER BY created_at DESC
+                 LIMIT 1
+                   FOR UPDATE
+               ) s
+    ), sess AS (
+        UPDATE topgg_vote_sessions t
+           SET used = TRUE
+          FROM pick
+         WHERE t.id = pick.id
+           AND t.used = FALSE
+     RETURNING t.id, t.user_id, t.guild_id, t.interaction_token, t.application_id
+    ), entry AS (
+        INSERT INTO coin_ledger (user_id, guild_id, delta, reason, ref)
+        SELECT user_id, guild_id, $2, 'topgg_vote', id::text FROM sess
+    ), vote AS (
+        INSERT INTO vote_events (provider, user_id, guild_id, voted_at, nonce)
+        SELECT 'topgg', user_id, guild_id, NOW(), id::text FROM sess
+        ON CONFLICT DO NOTHING
+    )
+    SELECT sess.user_id, sess.id, sess.guild_id, sess.interaction_token, sess.application_id,
+           """ + _LEDGER_BALANCE.format(user="sess.user_id", guild="sess.guild_id") + """ + $2
+      FROM sess
+""")
+
+LEDGER_COIN_PURCHASE_CREDIT = Prepared("veil_ledger_coin_purchase_credit", ("bigint", "bigint", "integer", "text"), """
+    WITH claim AS (
+        INSERT INTO coin_purchase_credits (stripe_session_id, user_id, guild_id, coins)
+        VALUES ($4, $1, $2, $3)
+        ON CONFLICT (stripe_session_id) DO NOTHING
+     RETURNING stripe_session_id
+    ), entry AS (
+        INSERT INTO coin_ledger (user_id, guild_id, delta, reason, ref)
+        SELECT $1, $2, $3, 'coin_purchase', $4 FROM claim
+    )
+    SELECT """ + _LEDGER_BALANCE.format(user="$1", guild="$2") + """ + $3,
+           s.stripe_session_id IS NOT NULL,
+           s.interaction_token, s.application_id, s.user_id, s.guild_id, s.coins
+      FROM claim
+      LEFT JOIN coin_checkout_sessions s ON s.stripe_session_id = $4
+""")
+
+
+def credit_topgg_vote(cur, user_id: int, coins: int):
+    """
+    Consume the user's newest unused /vote session, credit the coins, record the
+    vote and mark the session used -- one round trip.
+
+    Returns (session_id, guild_id, interaction_token, application_id, new_balance)
+    or None when the user has no pending session.
+    """
+    stmt = LEDGER_TOPGG_VOTE_CREDIT if coin_ledger.COIN_LEDGER_ENABLED else TOPGG_VOTE_CREDIT
+    stmt.execute(cur, (user_id, coins))
+    return cur.fetchone()
+
+
+def credit_topgg_votes(cur, user_ids, coins: int) -> dict:
+    """
+    credit_topgg_vote for several distinct users in one statement (and one
+    transaction). Returns {user_id: credit_topgg_vote's row} for the users that
+    had a pending session.
+    """
+    stmt = LEDGER_TOPGG_VOTE_CREDIT_BATCH if coin_ledger.COIN_LEDGER_ENABLED else TOPGG_VOTE_CREDIT_BATCH
+    stmt.execute(cur, (sorted(user_ids), coins))  # sorted: sessions are locked in the same order everywhere
+    return {row[0]: tuple(row[1:]) for row in cur.fetchall()}
+
+
+def credit_coin_purchase(cur, user_id: int, guild_id: int, coins: int, stripe_session_id: str):
+    """
+    Credit a coin pack and look up its checkout session -- one round trip.
+
+    Returns (new_balance, session_row) where session_row is
+    (interaction_token, application_id, user_id, guild_id, coins) or None;
+    (None, None) when the session was credited before.
+    """
+    stmt = LEDGER_COIN_PURCHASE_CREDIT if coin_ledger.COIN_LEDGER_ENABLED else COIN_PURCHASE_CREDIT
+    stmt.execute(cur, (user_id, guild_id, coins, stripe_session_id))
+    return _purchase_result(cur.fetchone())
+
+
+def _purchase_result(row):
+    if row is None:
+        return None, None
+    new_balance, found, *sess = row
+    return new_balance, (tuple(sess) if found else None)
+
+
+# ── asyncpg (stripe_webhook_async) ───────────────────────────────────────────
+# Same statements; asyncpg prepares and caches them per connection itself.
+
+async def credit_topgg_vote_async(conn, user_id: int, coins: int):
+    """credit_topgg_vote on an asyncpg connection."""
+    stmt = LEDGER_TOPGG_VOTE_CREDIT if coin_ledger.COIN_LEDGER_ENABLED else TOPGG_VOTE_CREDIT
+    row = await conn.fetchrow(stmt.typed_sql, user_id, coins)
+    return tuple(row) if row is not None else None
+
+
+async def credit_topgg_votes_async(conn, user_ids, coins: int) -> dict:
+    """credit_topgg_votes on an asyncpg connection."""
+    stmt = LEDGER_TOPGG_VOTE_CREDIT_BATCH if coin_ledger.COIN_LEDGER_ENABLED else TOPGG_VOTE_CREDIT_BATCH
+    rows = await conn.fetch(stmt.typed_sql, sorted(user_ids), coins)
+    return {row[0]: tuple(row[1:]) for row in rows}
+
+
+async def credit_coin_purchase_async(conn, user_id: int, guild_id: int, coins: int, stripe_session_id: str):
+    """credit_coin_purchase on an asyncpg connection."""
+    stmt = LEDGER_COIN_PURCHASE_CREDIT if coin_ledger.COIN_LEDGER_ENABLED else COIN_PURCHASE_CREDIT
+    return _purchase_result(await conn.fetchrow(stmt.typed_sql, user_id, guild_id, coins, stripe_session_id))
@@ -0,0 +1,401 @@
+"""
+Process-wide Postgres connection pool.
+
+Every handler used to open a brand new TLS connection per call. This keeps a
+small set of connections per worker process instead:
+
+- created lazily and rebuilt after fork, so it is safe under gunicorn with or
+  without --preload (connections are never shared between processes)
+- checked on checkout (closed / too old / idle too long / ping if quiet)
+- capped at DB_POOL_MAX; callers wait up to DB_POOL_TIMEOUT for a free slot
+- reports in-use, idle, waiting and checkout latency via pool_stats()
+"""
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()  # so CLI entry points that import this first see .env too
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+DB_SSLMODE = os.getenv("DB_SSLMODE", "require")
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "5"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))       # seconds to wait for a free connection
+DB_POOL_MAX_AGE = float(os.getenv("DB_POOL_MAX_AGE", "1800"))     # recycle connections older than this
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))    # drop connections idle longer than this
+DB_POOL_PING_AFTER = float(os.getenv("DB_POOL_PING_AFTER", "30")) # SELECT 1 before reuse if idle longer than this
+# Server-side prepared statements; turn off behind a transaction-mode pgbouncer.
+DB_PREPARE = os.getenv("DB_PREPARE", "1").lower() not in ("0", "false", "no")
+
+
+class PoolTimeout(Exception):
+    """No connection became free within DB_POOL_TIMEOUT."""
+
+
+_thread_counts = threading.local()
+
+
+def thread_round_trips() -> int:
+    """Round trips made by the calling thread so far (for per-event accounting)."""
+    return getattr(_thread_counts, "n", 0)
+
+
+def _count_round_trip(conn):
+    conn.round_trips += 1
+    _thread_counts.n = getattr(_thread_counts, "n", 0) + 1
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """Cursor that counts statements sent to the server (one round trip each)."""
+
+    def execute(self, query, vars=None):
+        _count_round_trip(self.connection)
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            metrics.observe("veil_db_statement_seconds", time.perf_counter() - start,
+                            statement=metrics.statement_label(query))
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """
+    psycopg2 connection that remembers when it was opened and last returned,
+    which statements it has prepared, and how many round trips it made.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        now = time.monotonic()
+        self.created_at = now
+        self.last_used = now
+        self.prepared = set()
+        self.prepare_generation = 0
+        self.round_trips = 0
+        self.cursor_factory = CountingCursor
+
+    def commit(self):
+        if self.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            _count_round_trip(self)
+        super().commit()
+
+    def rollback(self):
+        if not self.closed and self.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            _count_round_trip(self)
+        super().rollback()
+
+
+class Prepared:
+    """
+    A statement prepared once per connection and then run with EXECUTE.
+
+    `sql` uses $1..$n placeholders. The first use on a connection sends
+    PREPARE and EXECUTE in the same round trip.
+    """
+
+    def __init__(self, name: str, argtypes, sql: str):
+        self.name = name
+        self.argtypes = tuple(argtypes)
+        self.sql = sql
+        self._args = ", ".join(["%s"] * len(self.argtypes))
+        self._prepare = f"({', '.join(self.argtypes)}) AS {sql.replace('%', '%%')}"
+        # DB_PREPARE=0: same statement, sent as a plain parameterized query
+        self._plain = re.sub(r"\$(\d+)", lambda m: f"%(p{m.group(1)})s", sql.replace("%", "%%"))
+        # for drivers that prepare $n statements themselves (asyncpg): every
+        # parameter cast to its declared type, as PREPARE would have typed it
+        self.typed_sql = re.sub(r"\$(\d+)", lambda m: f"${m.group(1)}::{self.argtypes[int(m.group(1)) - 1]}", sql)
+
+    def execute(self, cur, params):
+        params = tuple(params)
+        if not DB_PREPARE:
+            cur.execute(self._plain, {f"p{i}": v for i, v in enumerate(params, 1)})
+            return cur
+        conn = cur.connection
+        # After a failed first use we cannot tell whether the PREPARE survived the
+        # rollback, so later attempts on that connection use a fresh name.
+        name = f"{self.name}_{conn.prepare_generation}"
+        if name in conn.prepared:
+            cur.execute(f"EXECUTE {name} ({self._args})", params)
+            return cur
+        try:
+            cur.execute(f"PREPARE {name} {self._prepare}; EXECUTE {name} ({self._args})", params)
+        except Exception:
+            conn.prepare_generation += 1
+            raise
+        conn.prepared.add(name)
+        return cur
+
+
+class ConnectionPool:
+    def __init__(self, dsn, maxconn=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT,
+                 max_age=DB_POOL_MAX_AGE, max_idle=DB_POOL_MAX_IDLE,
+                 ping_after=DB_POOL_PING_AFTER, **connect_kwargs):
+        self.dsn = dsn
+        self.maxconn = max(1, maxconn)
+        self.timeout = timeout
+        self.max_age = max_age
+        self.max_idle = max_idle
+        self.ping_after = ping_after
+        self.connect_kwargs = connect_kwargs
+        self.pid = os.getpid()
+
+        self._cond = threading.Condition()
+        self._idle = []      # stack of PooledConnection, most recently used last
+        self._size = 0       # open connections (idle + in use) plus slots being connected
+        self._in_use = 0
+        self._waiting = 0
+
+        self._checkouts = 0
+        self._round_trips = 0
+        self._timeouts = 0
+        self._opened = 0
+        self._recycled = 0
+        self._failed_checks = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    # ── connection lifecycle ────────────────────────────────────────────────
+    def _connect(self):
+        return psycopg2.connect(self.dsn, connection_factory=PooledConnection, **self.connect_kwargs)
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _usable(self, conn, now):
+        if conn.closed:
+            return False
+        if self.max_age and now - conn.created_at > self.max_age:
+            return False
+        if self.max_idle and now - conn.last_used > self.max_idle:
+            return False
+        if self.ping_after and now - conn.last_used > self.ping_after:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                conn.rollback()
+            except Exception:
+                with self._cond:
+                    self._failed_checks += 1
+                return False
+        return True
+
+    def _reap_idle(self, now):
+        """Close idle connections past max age / max idle. Caller holds the lock."""
+        keep = []
+        for conn in self._idle:
+            stale = conn.closed or (self.max_age and now - conn.created_at > self.max_age) \
+                or (self.max_idle and now - conn.last_used > self.max_idle)
+            if stale:
+                self._close(conn)
+                self._size -= 1
+                self._recycled += 1
+            else:
+                keep.append(conn)
+        if len(keep) != len(self._idle):
+            self._idle = keep
+            self._cond.notify_all()
+
+    # ── checkout / return ──────────────────────────────────────────────────
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        with self._cond:
+            self._reap_idle(start)
+            while True:
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    conn = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(f"no free DB connection after {self.timeout:.1f}s "
+                                      f"(max={self.maxconn}, waiting={self._waiting})")
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._in_use += 1
+
+        # health-check / connect outside the lock; the slot is already ours
+        recycled = opened = 0
+        try:
+            if conn is not None and not self._usable(conn, time.monotonic()):
+                self._close(conn)
+                recycled = 1
+                conn = None
+            if conn is None:
+                conn = self._connect()
+                opened = 1
+        except BaseException:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        waited = time.monotonic() - start
+        with self._cond:
+            self._recycled += recycled
+            self._opened += opened
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return conn
+
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed:
+            status = conn.info.transaction_status
+            if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except Exception:
+                    discard = True
+        with self._cond:
+            self._in_use -= 1
+            self._round_trips += conn.round_trips
+            conn.round_trips = 0
+            if discard or conn.closed:
+                self._close(conn)
+                self._size -= 1
+                self._recycled += 1
+            else:
+                conn.last_used = time.monotonic()
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            for conn in self._idle:
+                self._close(conn)
+            self._size -= len(self._idle)
+            self._idle = []
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "max": self.maxconn,
+                "open": self._size,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "waiting": self._waiting,
+                "checkouts": self._checkouts,
+                "round_trips": self._round_trips,
+                "timeouts": self._timeouts,
+                "opened": self._opened,
+                "recycled": self._recycled,
+                "failed_checks": self._failed_checks,
+                "checkout_wait_avg_ms": round(self._wait_total / self._checkouts * 1000, 3) if self._checkouts else 0.0,
+                "checkout_wait_max_ms": round(self._wait_max * 1000, 3),
+            }
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Process-wide pool
+# ─────────────────────────────────────────────────────────────────────────────
+
+_pool = None
+_pool_lock = threading.Lock()
+# Connections inherited from a parent process. They belong to the parent's
+# sessions, so we must never close them here (closing sends a Terminate to the
+# server); we just keep them referenced so they are not finalized either.
+_inherited = []
+
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    pool = _pool
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = ConnectionPool(DATABASE_URL, sslmode=DB_SSLMODE)
+        return _pool
+
+
+def _after_fork_in_child():
+    global _pool, _pool_lock
+    _pool_lock = threading.Lock()
+    if _pool is not None:
+        _inherited.extend(_pool._idle)
+        _pool = None
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+_pinned = threading.local()
+
+
+@contextmanager
+def pinned(conn):
+    """
+    Make get_db_conn() on this thread hand out `conn` -- already checked out by
+    the caller, e.g. the session holding an event's shard lock -- for the block.
+    """
+    _pinned.conn = conn
+    try:
+        yield conn
+    finally:
+        _pinned.conn = None
+
+
+@contextmanager
+def get_db_conn():
+    """
+    Borrow a pooled connection for one transaction.
+
+    Commits when the block exits normally, rolls back on error, and always
+    returns the connection to the pool (same semantics as `with psycopg2_conn:`).
+    Inside pinned() the pinned connection is used and kept by its owner.
+    """
+    conn = getattr(_pinned, "conn", None)
+    if conn is not None:
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+            raise
+        return
+
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+        raise
+    finally:
+        pool.putconn(conn)
+
+
+def pool_stats() -> dict:
+    pool = _pool
+    if pool is None or pool.pid != os.getpid():
+        return {"max": DB_POOL_MAX, "open": 0, "idle": 0, "in_use": 0, "waiting": 0}
+    return pool.stats()
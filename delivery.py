@@ -0,0 +1,317 @@
+"""
+Background delivery of outbound HTTP calls (Discord PATCHes, support-webhook posts).
+
+Handlers call deliver() and return immediately; a small pool of worker threads
+per process sends the request. Failed deliveries are retried with jittered
+exponential backoff; once retries are exhausted (or the queue is full, or the
+process is shutting down) the job is appended to a dead-letter spool on local
+disk, which is replayed the next time a worker process starts.
+
+Interaction PATCHes are only useful while the interaction token is: Discord
+expires it 15 minutes after the interaction. One queued longer than
+DELIVERY_INTERACTION_TTL seconds is dropped (counted as `expired`) instead of
+being spooled, and replay skips any that expired while on disk.
+"""
+import atexit
+import glob
+import heapq
+import json
+import os
+import queue
+import random
+import threading
+import time
+
+import requests
+
+import event_log
+from discord_http import RateLimited, get_client
+
+DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", "4"))
+DELIVERY_QUEUE_MAX = int(os.getenv("DELIVERY_QUEUE_MAX", "1000"))
+DELIVERY_MAX_ATTEMPTS = int(os.getenv("DELIVERY_MAX_ATTEMPTS", "5"))
+DELIVERY_BACKOFF_BASE = float(os.getenv("DELIVERY_BACKOFF_BASE", "0.5"))  # seconds, doubled per attempt
+DELIVERY_BACKOFF_MAX = float(os.getenv("DELIVERY_BACKOFF_MAX", "30"))
+DELIVERY_DRAIN_TIMEOUT = float(os.getenv("DELIVERY_DRAIN_TIMEOUT", "5"))  # seconds to finish in-flight work on exit
+DELIVERY_SPOOL_DIR = os.getenv("DELIVERY_SPOOL_DIR", "delivery_spool")
+# interaction tokens live 15 minutes from the interaction, which came before the enqueue
+DELIVERY_INTERACTION_TTL = float(os.getenv("DELIVERY_INTERACTION_TTL", "840"))
+
+
+class RetryableError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def retry_delay(attempt: int, retry_after=None) -> float:
+    if retry_after is not None:
+        return min(DELIVERY_BACKOFF_MAX, float(retry_after)) + random.uniform(0, 0.25)
+    delay = min(DELIVERY_BACKOFF_MAX, DELIVERY_BACKOFF_BASE * (2 ** (attempt - 1)))
+    return delay * random.uniform(0.5, 1.5)
+
+
+def expired(job: dict) -> bool:
+    """An interaction PATCH whose token has run out; Discord would only reject it."""
+    return (job.get("label") == "interaction_patch"
+            and time.time() - job.get("enqueued_at", 0) > DELIVERY_INTERACTION_TTL)
+
+
+def send_job(job: dict):
+    """
+    Perform one HTTP attempt through the shared Discord client.
+    Raises RetryableError for rate limits, 5xx and network errors.
+    """
+    try:
+        r = get_client().request(job["method"], job["url"], json=job.get("json"), timeout=job.get("timeout", 5))
+    except RateLimited as e:
+        raise RetryableError(str(e), e.retry_after)
+    except requests.RequestException as e:
+        raise RetryableError(str(e))
+    if r.status_code >= 500:
+        raise RetryableError(f"{r.status_code} {r.text[:200]}")
+    r.raise_for_status()
+    return r
+
+
+class DeliveryQueue:
+    def __init__(self, workers=DELIVERY_WORKERS, maxsize=DELIVERY_QUEUE_MAX, spool_dir=DELIVERY_SPOOL_DIR, sender=send_job):
+        self.pid = os.getpid()
+        self.spool_dir = spool_dir
+        self.sender = sender
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._delayed = []          # heap of (due_monotonic, seq, job)
+        self._delayed_cond = threading.Condition()
+        self._seq = 0
+        self._stopping = False
+        self._threads = []
+        self._lock = threading.Lock()
+        self._in_flight = 0
+
+        self._enqueued = 0
+        self._delivered = 0
+        self._retried = 0
+        self._failed = 0
+        self._spooled = 0
+        self._replayed = 0
+        self._expired = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+        for i in range(max(1, workers)):
+            t = threading.Thread(target=self._work, name=f"delivery-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        t = threading.Thread(target=self._schedule, name="delivery-retry", daemon=True)
+        t.start()
+        self._threads.append(t)
+
+    # ── public ──────────────────────────────────────────────────────────────
+    def put(self, job: dict):
+        job.setdefault("attempts", 0)
+        job.setdefault("enqueued_at", time.time())
+        if self._stopping:
+            self._spool(job, "shutting down")
+            return
+        try:
+            self._queue.put_nowait(job)
+            with self._lock:
+                self._enqueued += 1
+        except queue.Full:
+            self._spool(job, "queue full")
+
+    def stats(self) -> dict:
+        with self._lock:
+            done = self._delivered
+            return {
+                "depth": self._queue.qsize(),
+                "delayed": len(self._delayed),
+                "in_flight": self._in_flight,
+                "enqueued": self._enqueued,
+                "delivered": self._delivered,
+                "retried": self._retried,
+                "failed": self._failed,
+                "spooled": self._spooled,
+                "replayed": self._replayed,
+                "expired": self._expired,
+                "latency_avg_ms": round(self._latency_total / done * 1000, 1) if done else 0.0,
+                "latency_max_ms": round(self._latency_max * 1000, 1),
+            }
+
+    def replay_spool(self):
+        """Re-enqueue dead letters left by previous processes. Each file is claimed by rename."""
+        for path in sorted(glob.glob(os.path.join(self.spool_dir, "dead-*.jsonl"))):
+            claimed = f"{path}.replay-{self.pid}"
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue  # another worker got it first
+            count = stale = 0
+            with open(claimed, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        job = json.loads(line)
+                    except ValueError:
+                        continue
+                    if expired(job):
+                        stale += 1
+                        continue
+                    job["attempts"] = 0
+                    self.put(job)
+                    count += 1
+            os.remove(claimed)
+            with self._lock:
+                self._replayed += count
+                self._expired += stale
+            event_log.note(f"[delivery] replayed {count} dead-lettered job(s) from {os.path.basename(path)}"
+                           + (f", dropped {stale} expired interaction PATCH(es)" if stale else ""))
+
+    def shutdown(self, timeout=DELIVERY_DRAIN_TIMEOUT):
+        """Give queued work a short chance to go out, then spool whatever is left."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                busy = self._in_flight
+            if self._queue.empty() and not busy:
+                break
+            time.sleep(0.05)
+        self._stopping = True
+        with self._delayed_cond:
+            leftovers = [job for _, _, job in self._delayed]
+            self._delayed = []
+            self._delayed_cond.notify_all()
+        while True:
+            try:
+                leftovers.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        for job in leftovers:
+            self._spool(job, "shutdown")
+
+    # ── internals ──────────────────────────────────────────────────────────
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            with self._lock:
+                self._in_flight += 1
+            job["attempts"] += 1
+            try:
+                self.sender(job)
+            except RetryableError as e:
+                self._retry(job, e, e.retry_after)
+            except requests.HTTPError as e:
+                # 4xx other than 429: the request itself is bad (e.g. expired interaction token)
+                with self._lock:
+                    self._failed += 1
+                event_log.note(f"[delivery] ❌ {job.get('label')} {job['method']} gave up: {e}", error=True)
+            except Exception as e:
+                self._retry(job, e, None)
+            else:
+                latency = time.time() - job["enqueued_at"]
+                with self._lock:
+                    self._delivered += 1
+                    self._latency_total += latency
+                    self._latency_max = max(self._latency_max, latency)
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+
+    def _retry(self, job, err, retry_after):
+        if job["attempts"] >= DELIVERY_MAX_ATTEMPTS or self._stopping:
+            self._spool(job, f"{job['attempts']} attempt(s), last error: {err}")
+            return
+        delay = retry_delay(job["attempts"], retry_after)
+        with self._lock:
+            self._retried += 1
+        with self._delayed_cond:
+            self._seq += 1
+            heapq.heappush(self._delayed, (time.monotonic() + delay, self._seq, job))
+            self._delayed_cond.notify()
+
+    def _schedule(self):
+        while True:
+            with self._delayed_cond:
+                while not self._delayed and not self._stopping:
+                    self._delayed_cond.wait()
+                if self._stopping:
+                    return
+                due, _, job = self._delayed[0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self._delayed_cond.wait(wait)
+                    continue
+                heapq.heappop(self._delayed)
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                self._spool(job, "queue full on retry")
+
+    def _spool(self, job, reason):
+        if expired(job):
+            with self._lock:
+                self._expired += 1
+            event_log.note(f"[delivery] dropped expired {job.get('label')} {job['method']} ({reason})")
+            return
+        job = dict(job, dead_reason=reason)
+        try:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            path = os.path.join(self.spool_dir, f"dead-{self.pid}.jsonl")
+            with self._lock, open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(job) + "\n")
+                self._spooled += 1
+            event_log.note(f"[delivery] ⚠️ spooled {job.get('label')} {job['method']} ({reason})", error=True)
+        except Exception as e:
+            event_log.note(f"[delivery] ❌ could not spool {job.get('label')} job ({reason}): {e}", error=True)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Process-wide queue
+# ─────────────────────────────────────────────────────────────────────────────
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue() -> DeliveryQueue:
+    global _queue
+    q = _queue
+    if q is not None and q.pid == os.getpid():
+        return q
+    with _queue_lock:
+        if _queue is None or _queue.pid != os.getpid():
+            _queue = DeliveryQueue()
+            _queue.replay_spool()
+        return _queue
+
+
+def _after_fork_in_child():
+    global _queue, _queue_lock
+    # worker threads do not survive fork; the child builds its own queue on first use
+    _queue = None
+    _queue_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def deliver(method: str, url: str, json_body=None, timeout: float = 5, label: str = ""):
+    """Queue an outbound HTTP request and return immediately."""
+    if not url:
+        return
+    get_queue().put({"method": method, "url": url, "json": json_body, "timeout": timeout, "label": label})
+
+
+def delivery_stats() -> dict:
+    q = _queue
+    if q is None or q.pid != os.getpid():
+        return {"depth": 0, "delayed": 0, "in_flight": 0}
+    return q.stats()
+
+
+@atexit.register
+def _shutdown():
+    q = _queue
+    if q is not None and q.pid == os.getpid():
+        q.shutdown()
@@ -0,0 +1,189 @@
+"""
+Shared HTTP client for Discord (interaction PATCHes and the support webhook).
+
+One keep-alive requests.Session per process instead of a new TCP/TLS
+connection per call, plus client-side rate limiting: the X-RateLimit-* headers
+of every response are tracked per route bucket (and the global limit), and a
+request that would hit an exhausted bucket waits for the reset -- or, if the
+wait is longer than the caller allows, raises RateLimited so the delivery
+queue can requeue it instead of burning a 429.
+"""
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+DISCORD_HTTP_POOL = int(os.getenv("DISCORD_HTTP_POOL", "10"))          # keep-alive connections per host
+DISCORD_MAX_WAIT = float(os.getenv("DISCORD_MAX_WAIT", "2"))           # wait in-line up to this, else requeue
+USER_AGENT = "VeilBot-Webhook (requests)"
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after: float, is_global: bool = False, route: str = ""):
+        super().__init__(f"rate limited on {route or 'global'}; retry after {retry_after:.2f}s")
+        self.retry_after = retry_after
+        self.is_global = is_global
+
+
+def route_key(method: str, url: str) -> str:
+    """Discord buckets are per route + major parameter; the webhook id/token is in the path."""
+    return f"{method.upper()} {urlsplit(url).path}"
+
+
+class DiscordClient:
+    def __init__(self, pool_size=DISCORD_HTTP_POOL, max_wait=DISCORD_MAX_WAIT):
+        self.max_wait = max_wait
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["User-Agent"] = USER_AGENT
+
+        self._lock = threading.Lock()
+        self._route_bucket = {}   # route key -> bucket id from X-RateLimit-Bucket
+        self._buckets = {}        # bucket id -> [remaining, reset_at (monotonic)]
+        self._global_until = 0.0
+
+        self._stats = {
+            "requests": 0, "2xx": 0, "4xx": 0, "5xx": 0, "other": 0, "errors": 0,
+            "rate_limited": 0, "global_rate_limited": 0,
+            "waits": 0, "wait_seconds": 0.0, "requeued": 0,
+            "latency_total": 0.0, "latency_max": 0.0,
+        }
+
+    # ── rate-limit bookkeeping ──────────────────────────────────────────────
+    def _reserve(self, route: str) -> float:
+        """Seconds to wait before sending on this route; takes one slot from its bucket."""
+        now = time.monotonic()
+        with self._lock:
+            wait = max(0.0, self._global_until - now)
+            bucket = self._buckets.get(self._route_bucket.get(route))
+            if bucket is not None:
+                remaining, reset_at = bucket
+                if reset_at <= now:
+                    bucket[0] = None  # window passed; unknown until the next response
+                elif remaining is not None and remaining <= 0:
+                    wait = max(wait, reset_at - now)
+                elif remaining is not None:
+                    bucket[0] = remaining - 1
+            return wait
+
+    def _observe(self, route: str, r: requests.Response):
+        h = r.headers
+        bucket_id = h.get("X-RateLimit-Bucket")
+        now = time.monotonic()
+        with self._lock:
+            if bucket_id:
+                self._route_bucket[route] = bucket_id
+                try:
+                    remaining = int(h.get("X-RateLimit-Remaining"))
+                    reset_after = float(h.get("X-RateLimit-Reset-After"))
+                except (TypeError, ValueError):
+                    pass
+                else:
+                    self._buckets[bucket_id] = [remaining, now + reset_after]
+
+            if r.status_code == 429:
+                retry_after = _retry_after(r)
+                is_global = h.get("X-RateLimit-Global", "").lower() == "true" or h.get("X-RateLimit-Scope") == "global"
+                self._stats["rate_limited"] += 1
+                if is_global:
+                    self._stats["global_rate_limited"] += 1
+                    self._global_until = max(self._global_until, now + retry_after)
+                elif bucket_id:
+                    self._buckets[bucket_id] = [0, now + retry_after]
+                return retry_after, is_global
+        return None, False
+
+    # ── public ──────────────────────────────────────────────────────────────
+    def request(self, method: str, url: str, json=None, timeout: float = 5, max_wait=None) -> requests.Response:
+        """
+        Send one request. Waits for the route's bucket if needed (up to max_wait),
+        raises RateLimited if it would have to wait longer or got a 429.
+        """
+        route = route_key(method, url)
+        max_wait = self.max_wait if max_wait is None else max_wait
+        wait = self._reserve(route)
+        if wait > 0:
+            if wait > max_wait:
+                with self._lock:
+                    self._stats["requeued"] += 1
+                raise RateLimited(wait, route=route)
+            with self._lock:
+                self._stats["waits"] += 1
+                self._stats["wait_seconds"] += wait
+            time.sleep(wait)
+
+        start = time.monotonic()
+        try:
+            r = self.session.request(method, url, json=json, timeout=timeout)
+        except requests.RequestException:
+            with self._lock:
+                self._stats["errors"] += 1
+            metrics.observe("veil_outbound_http_seconds", time.monotonic() - start, method=method, status="error")
+            raise
+        latency = time.monotonic() - start
+        metrics.observe("veil_outbound_http_seconds", latency, method=method, status=f"{r.status_code // 100}xx")
+
+        retry_after, is_global = self._observe(route, r)
+        with self._lock:
+            self._stats["requests"] += 1
+            self._stats[{2: "2xx", 4: "4xx", 5: "5xx"}.get(r.status_code // 100, "other")] += 1
+            self._stats["latency_total"] += latency
+            self._stats["latency_max"] = max(self._stats["latency_max"], latency)
+        if retry_after is not None:
+            raise RateLimited(retry_after, is_global, route)
+        return r
+
+    def stats(self) -> dict:
+        with self._lock:
+            s = dict(self._stats)
+            s["buckets"] = len(self._buckets)
+            s["global_blocked_for"] = round(max(0.0, self._global_until - time.monotonic()), 3)
+        s["latency_avg_ms"] = round(s.pop("latency_total") / s["requests"] * 1000, 1) if s["requests"] else 0.0
+        s["latency_max_ms"] = round(s.pop("latency_max") * 1000, 1)
+        s["wait_seconds"] = round(s["wait_seconds"], 3)
+        return s
+
+
+def _retry_after(r: requests.Response) -> float:
+    try:
+        return float(r.json()["retry_after"])
+    except Exception:
+        pass
+    try:
+        return float(r.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return 1.0
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Process-wide client
+# ─────────────────────────────────────────────────────────────────────────────
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> DiscordClient:
+    """One client per process (sockets are not shared across fork)."""
+    global _client, _client_pid
+    if _client is not None and _client_pid == os.getpid():
+        return _client
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = DiscordClient()
+            _client_pid = os.getpid()
+        return _client
+
+
+def discord_stats() -> dict:
+    if _client is None or _client_pid != os.getpid():
+        return {"requests": 0}
+    return _client.stats()
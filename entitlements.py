@@ -0,0 +1,432 @@
+"""
+Read side for the bot: guild tier and user balance, served from a per-process
+TTL + LRU cache.
+
+    GET /guild/<guild_id>/tier
+    GET /user/<user_id>/<guild_id>/balance
+
+Every write that changes what the cache serves -- a guild's tier, renews_at or
+payment_failed, a member's coins, a coin_ledger entry -- fires a trigger that
+queues a NOTIFY on the `veil_entitlements` channel in the writing transaction,
+so it is delivered exactly when that transaction commits, whether the writer
+is a webhook handler, a bonus batch or the bot itself. Writes that leave those
+columns alone queue nothing: every NOTIFYing commit takes one database-wide
+lock on the notification queue, so they would serialize for no reason. Each
+worker process runs one listener thread that drops the matching cache entries:
+
+    t:<guild>           tier of a guild
+    b:<user>:<guild>    balance of one member
+    g:<guild>           every cached balance in a guild (bulk writes such as bonuses)
+    v:<user>            a /vote session was created (vote_gate's no-session cache)
+
+A read that raced an invalidation is not cached, and while the listener is
+disconnected (startup, a dropped connection) reads bypass the cache entirely;
+ENTITLEMENT_CACHE_TTL bounds staleness if a notification is ever lost anyway.
+Set ENTITLEMENT_CACHE=0 to always read from Postgres.
+
+The triggers are installed by `python schema.py migrate`, not by the app: a
+CREATE TRIGGER locks its table against writes. Until they are in place the
+listener keeps checking (with backoff) and the cache stays off.
+"""
+import os
+import select
+import threading
+import time
+from collections import OrderedDict
+
+import psycopg2
+
+import coin_ledger
+import event_log
+from db_pool import DATABASE_URL, DB_SSLMODE, Prepared, get_db_conn
+from event_order import lock_key
+
+ENTITLEMENT_CACHE_ENABLED = os.getenv("ENTITLEMENT_CACHE", "1").lower() not in ("0", "false", "no")
+ENTITLEMENT_CACHE_TTL = float(os.getenv("ENTITLEMENT_CACHE_TTL", "300"))
+ENTITLEMENT_CACHE_MAX = int(os.getenv("ENTITLEMENT_CACHE_MAX", "20000"))
+# LISTEN needs a session; point this past a transaction-mode pgbouncer if there is one
+ENTITLEMENT_LISTEN_URL = os.getenv("ENTITLEMENT_LISTEN_URL") or DATABASE_URL
+ENTITLEMENT_RETRY_MAX = float(os.getenv("ENTITLEMENT_RETRY_MAX", "60"))  # seconds between listener retries, at most
+
+CHANNEL = "veil_entitlements"
+
+SCHEMA_SQL = """
+    CREATE OR REPLACE FUNCTION veil_notify_tier() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM pg_notify('veil_entitlements', 't:' || COALESCE(NEW.guild_id, OLD.guild_id));
+        RETURN NULL;
+    END $$;
+
+    CREATE OR REPLACE FUNCTION veil_notify_balances() RETURNS trigger LANGUAGE plpgsql AS $$
+    DECLARE r RECORD;
+    BEGIN
+        -- set by writers that move coins around without changing any balance (ledger compaction)
+        IF current_setting('veil.balance_unchanged', true) = 'on' THEN
+            RETURN NULL;
+        END IF;
+        -- a statement touching many members (a bonus batch) invalidates per guild
+        IF (SELECT COUNT(*) FROM changed) > 50 THEN
+            FOR r IN SELECT DISTINCT guild_id FROM changed LOOP
+                PERFORM pg_notify('veil_entitlements', 'g:' || r.guild_id);
+            END LOOP;
+        ELSE
+            FOR r IN SELECT DISTINCT user_id, guild_id FROM changed LOOP
+                PERFORM pg_notify('veil_entitlements', 'b:' || r.user_id || ':' || r.guild_id);
+            END LOOP;
+        END IF;
+        RETURN NULL;
+    END $$;
+
+    -- UPDATE: only the members whose coins changed (a vote timestamp or a refill
+    -- date alone changes no balance)
+    CREATE OR REPLACE FUNCTION veil_notify_balance_updates() RETURNS trigger LANGUAGE plpgsql AS $$
+    DECLARE r RECORD;
+    BEGIN
+        IF current_setting('veil.balance_unchanged', true) = 'on' THEN
+            RETURN NULL;
+        END IF;
+        IF (SELECT COUNT(*) FROM changed) > 50 THEN
+            FOR r IN SELECT DISTINCT c.guild_id FROM changed c JOIN before b USING (user_id, guild_id)
+                      WHERE c.coins IS DISTINCT FROM b.coins LOOP
+                PERFORM pg_notify('veil_entitlements', 'g:' || r.guild_id);
+            END LOOP;
+        ELSE
+            FOR r IN SELECT DISTINCT c.user_id, c.guild_id FROM changed c JOIN before b USING (user_id, guild_id)
+                      WHERE c.coins IS DISTINCT FROM b.coins LOOP
+                PERFORM pg_notify('veil_entitlements', 'b:' || r.user_id || ':' || r.guild_id);
+            END LOOP;
+        END IF;
+        RETURN NULL;
+    END $$;
+
+    CREATE OR REPLACE FUNCTION veil_notify_vote_session() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM pg_notify('veil_entitlements', 'v:' || NEW.user_id);
+        RETURN NULL;
+    END $$;
+
+    -- created only when missing: CREATE TRIGGER locks the table against writes
+    -- (trigger names are per table, so the check is too: one database, several schemas)
+    DO $$
+    BEGIN
+        -- replaced by the two below, which skip updates the cache cannot see
+        IF EXISTS (SELECT 1 FROM pg_trigger
+                    WHERE tgrelid = to_regclass('veil_subscriptions') AND tgname = 'veil_subscriptions_notify') THEN
+            DROP TRIGGER veil_subscriptions_notify ON veil_subscriptions;
+        END IF;
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger
+                        WHERE tgrelid = to_regclass('veil_subscriptions') AND tgname = 'veil_subscriptions_notify_write') THEN
+            CREATE TRIGGER veil_subscriptions_notify_write AFTER INSERT OR DELETE ON veil_subscriptions
+                FOR EACH ROW EXECUTE FUNCTION veil_notify_tier();
+        END IF;
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger
+                        WHERE tgrelid = to_regclass('veil_subscriptions') AND tgname = 'veil_subscriptions_notify_update') THEN
+            -- the columns GUILD_TIER reads
+            CREATE TRIGGER veil_subscriptions_notify_update
+                AFTER UPDATE OF tier, renews_at, payment_failed ON veil_subscriptions
+                FOR EACH ROW
+                WHEN (OLD.tier IS DISTINCT FROM NEW.tier
+                      OR OLD.renews_at IS DISTINCT FROM NEW.renews_at
+                      OR OLD.payment_failed IS DISTINCT FROM NEW.payment_failed)
+                EXECUTE FUNCTION veil_notify_tier();
+        END IF;
+        -- transition tables allow one event per trigger, and no column list
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger
+                        WHERE tgrelid = to_regclass('veil_users') AND tgname = 'veil_users_notify_insert') THEN
+            CREATE TRIGGER veil_users_notify_insert AFTER INSERT ON veil_users
+                REFERENCING NEW TABLE AS changed FOR EACH STATEMENT EXECUTE FUNCTION veil_notify_balances();
+        END IF;
+        IF EXISTS (SELECT 1 FROM pg_trigger
+                    WHERE tgrelid = to_regclass('veil_users') AND tgname = 'veil_users_notify_update'
+                      AND tgfoid <> 'veil_notify_balance_updates'::regproc) THEN
+            DROP TRIGGER veil_users_notify_update ON veil_users;
+        END IF;
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger
+                        WHERE tgrelid = to_regclass('veil_users') AND tgname = 'veil_users_notify_update') THEN
+            CREATE TRIGGER veil_users_notify_update AFTER UPDATE ON veil_users
+                REFERENCING OLD TABLE AS before NEW TABLE AS changed
+                FOR EACH STATEMENT EXECUTE FUNCTION veil_notify_balance_updates();
+        END IF;
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger
+                        WHERE tgrelid = to_regclass('veil_users') AND tgname = 'veil_users_notify_delete') THEN
+            CREATE TRIGGER veil_users_notify_delete AFTER DELETE ON veil_users
+                REFERENCING OLD TABLE AS changed FOR EACH STATEMENT EXECUTE FUNCTION veil_notify_balances();
+        END IF;
+        IF to_regclass('coin_ledger') IS NOT NULL
+           AND NOT EXISTS (SELECT 1 FROM pg_trigger
+                        WHERE tgrelid = to_regclass('coin_ledger') AND tgname = 'coin_ledger_notify_insert') THEN
+            CREATE TRIGGER coin_ledger_notify_insert AFTER INSERT ON coin_ledger
+                REFERENCING NEW TABLE AS changed FOR EACH STATEMENT EXECUTE FUNCTION veil_notify_balances();
+        END IF;
+        IF to_regclass('topgg_vote_sessions') IS NOT NULL
+           AND NOT EXISTS (SELECT 1 FROM pg_trigger
+                        WHERE tgrelid = to_regclass('topgg_vote_sessions') AND tgname = 'topgg_vote_sessions_notify_insert') THEN
+            CREATE TRIGGER topgg_vote_sessions_notify_insert AFTER INSERT ON topgg_vote_sessions
+                FOR EACH ROW EXECUTE FUNCTION veil_notify_vote_session();
+        END IF;
+    END $$;
+"""
+
+
+# what the listener needs before the caches can go live: (table, trigger)
+TRIGGERS = (
+    ("veil_subscriptions", "veil_subscriptions_notify_write"),
+    ("veil_subscriptions", "veil_subscriptions_notify_update"),
+    ("veil_users", "veil_users_notify_insert"),
+    ("veil_users", "veil_users_notify_update"),
+    ("veil_users", "veil_users_notify_delete"),
+    ("topgg_vote_sessions", "topgg_vote_sessions_notify_insert"),
+)
+LEDGER_TRIGGER = ("coin_ledger", "coin_ledger_notify_insert")
+
+SCHEMA_LOCK = lock_key("schema:entitlements")
+
+
+def ensure_schema():
+    """Install the notify functions and triggers (schema.py migrate runs the same, under the same lock)."""
+    with get_db_conn() as conn, conn.cursor() as cur:
+        # CREATE OR REPLACE FUNCTION side by side fails with "tuple concurrently updated"
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK,))
+        cur.execute(SCHEMA_SQL)
+
+
+def missing_triggers(cur) -> list:
+    triggers = TRIGGERS + ((LEDGER_TRIGGER,) if coin_ledger.COIN_LEDGER_ENABLED else ())
+    cur.execute("""
+        SELECT t.tbl || '.' || t.name
+          FROM unnest(%s::text[], %s::text[]) AS t(tbl, name)
+         WHERE NOT EXISTS (SELECT 1 FROM pg_trigger
+                            WHERE tgrelid = to_regclass(t.tbl) AND tgname = t.name AND NOT tgisinternal)
+    """, ([t for t, _ in triggers], [n for _, n in triggers]))
+    return [r[0] for r in cur.fetchall()]
+
+
+MISSING = object()
+
+
+class EntitlementCache:
+    def __init__(self, ttl=ENTITLEMENT_CACHE_TTL, maxsize=ENTITLEMENT_CACHE_MAX, enabled=ENTITLEMENT_CACHE_ENABLED):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.enabled = enabled
+        self.live = False            # listener connected; until then every read goes to Postgres
+        self._data = OrderedDict()   # ("tier", guild) | ("balance", user, guild) -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._generation = 0         # bumped by every invalidation
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.invalidations = 0
+        self.notifications = 0
+
+    def get(self, key):
+        """(value, generation); value is MISSING on a miss or while the cache is bypassed."""
+        if not (self.enabled and self.live):
+            with self._lock:
+                self.bypassed += 1
+            return MISSING, None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] >= now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1], self._generation
+            self.misses += 1
+            return MISSING, self._generation
+
+    def put(self, key, value, generation):
+        """Cache a value loaded after get() -- unless an invalidation arrived in between."""
+        with self._lock:
+            if generation is None or generation != self._generation or not self.live:
+                return
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def lookup(self, key, load):
+        value, generation = self.get(key)
+        if value is MISSING:
+            value = load()
+            self.put(key, value, generation)
+        return value
+
+    def apply(self, payload: str):
+        """Handle one notification payload (see the module docstring)."""
+        kind, _, rest = payload.partition(":")
+        with self._lock:
+            self._generation += 1
+            self.notifications += 1
+            if kind == "t":
+                keys = [("tier", int(rest))]
+            elif kind == "b":
+                user, _, guild = rest.partition(":")
+                keys = [("balance", int(user), int(guild))]
+            elif kind == "g":
+                guild = int(rest)
+                keys = [k for k in self._data if k[0] == "balance" and k[2] == guild]
+            else:
+                return
+            for key in keys:
+                if self._data.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "live": self.live,
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+                "bypassed": self.bypassed,
+                "notifications": self.notifications,
+                "invalidations": self.invalidations,
+            }
+
+
+entitlement_cache = EntitlementCache()
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Reads
+# ─────────────────────────────────────────────────────────────────────────────
+
+# $n statements, so the async entry point runs the same SQL (typed_sql)
+
+GUILD_TIER = Prepared("veil_guild_tier", ("bigint",), """
+    SELECT tier, renews_at, payment_failed
+      FROM veil_subscriptions
+     WHERE guild_id = $1
+""")
+
+USER_BALANCE = Prepared("veil_user_balance", ("bigint", "bigint"), """
+    SELECT COALESCE((SELECT coins FROM veil_users WHERE user_id = $1 AND guild_id = $2), 0)
+""")
+
+LEDGER_USER_BALANCE = Prepared("veil_ledger_user_balance", ("bigint", "bigint"), """
+    SELECT COALESCE((SELECT coins FROM veil_users WHERE user_id = $1 AND guild_id = $2), 0)
+         + COALESCE((SELECT SUM(delta) FROM coin_ledger
+                      WHERE user_id = $1 AND guild_id = $2 AND compacted_at IS NULL), 0)
+""")
+
+
+def balance_statement() -> Prepared:
+    return LEDGER_USER_BALANCE if coin_ledger.COIN_LEDGER_ENABLED else USER_BALANCE
+
+
+def tier_result(guild_id: int, row) -> dict:
+    tier, renews_at, payment_failed = row if row else (None, None, False)
+    return {
+        "guild_id": guild_id,
+        "tier": tier or "free",
+        "renews_at": renews_at.isoformat() if renews_at else None,
+        "payment_failed": bool(payment_failed),
+    }
+
+
+def guild_tier(guild_id: int) -> dict:
+    def load():
+        with get_db_conn() as conn, conn.cursor() as cur:
+            GUILD_TIER.execute(cur, (guild_id,))
+            return tier_result(guild_id, cur.fetchone())
+    return entitlement_cache.lookup(("tier", guild_id), load)
+
+
+def user_balance(user_id: int, guild_id: int) -> dict:
+    def load():
+        with get_db_conn() as conn, conn.cursor() as cur:
+            balance_statement().execute(cur, (user_id, guild_id))
+            return int(cur.fetchone()[0])
+    coins = entitlement_cache.lookup(("balance", user_id, guild_id), load)
+    return {"user_id": user_id, "guild_id": guild_id, "coins": coins}
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Listener
+# ─────────────────────────────────────────────────────────────────────────────
+
+_listener_pid = None
+_listener_lock = threading.Lock()
+_watchers = {}   # payload kind -> another cache fed by the same listener
+
+
+def watch(kind: str, cache):
+    """Send `<kind>:...` payloads to `cache` (apply / clear / live, like EntitlementCache)."""
+    _watchers[kind] = cache
+
+
+def _listen_forever(cache: EntitlementCache):
+    delay = 2
+    while True:
+        conn = None
+        caches = (cache, *_watchers.values())
+        try:
+            conn = psycopg2.connect(ENTITLEMENT_LISTEN_URL, sslmode=DB_SSLMODE)
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                missing = missing_triggers(cur)
+                if missing:
+                    raise RuntimeError(f"notify triggers missing ({', '.join(missing)}); "
+                                       f"run `python schema.py migrate`")
+                cur.execute(f"LISTEN {CHANNEL}")
+            # anything cached before LISTEN took effect may have missed its invalidation
+            for c in caches:
+                c.clear()
+                c.live = True
+            delay = 2
+            while True:
+                if select.select([conn], [], [], 30) == ([], [], []):
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT 1")  # notice a dead connection
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    payload = conn.notifies.pop(0).payload
+                    _watchers.get(payload.partition(":")[0], cache).apply(payload)
+        except Exception as e:
+            event_log.note(f"⚠️ [entitlements] listener down, cache off; retrying in {delay:g}s: {e}", error=True)
+        finally:
+            for c in caches:
+                c.live = False
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        time.sleep(delay)
+        delay = min(delay * 2, ENTITLEMENT_RETRY_MAX)
+
+
+def ensure_listener():
+    """Start this process's listener thread once; it turns the cache on when the triggers are in place."""
+    global _listener_pid
+    if not (ENTITLEMENT_CACHE_ENABLED or _watchers) or _listener_pid == os.getpid():
+        return
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            return
+        threading.Thread(target=_listen_forever, args=(entitlement_cache,),
+                         name="entitlement-listener", daemon=True).start()
+        _listener_pid = os.getpid()
+
+
+def _after_fork_in_child():
+    global _listener_lock
+    _listener_lock = threading.Lock()
+    entitlement_cache._lock = threading.Lock()
+    entitlement_cache.live = False
+    entitlement_cache.clear()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def entitlement_stats() -> dict:
+    return dict(entitlement_cache.stats(), listening=_listener_pid == os.getpid())
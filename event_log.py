@@ -0,0 +1,225 @@
+"""
+Structured event log: one JSON line per handled event instead of a print() per step.
+
+    with event_log.event("stripe", event["type"], event_id=event["id"]):
+        event_log.bind(guild_id=guild_id, session_id=session["id"])
+        event_log.note("Credited +500 to user 1 in guild 2")
+
+Handlers add correlation ids (bind) and what they did (note) to the record of
+the event they are running in -- a contextvar, so threads and asyncio tasks
+each see their own -- and the record is emitted once, when the event ends:
+
+    {"ts": "...", "level": "info", "pid": 12, "source": "stripe", "event_type": "checkout.session.completed",
+     "event_id": "evt_...", "session_id": "cs_...", "guild_id": 2, "user_id": 1, "outcome": "ok", "ms": 14.2,
+     "notes": ["Credited +500 to user 1 in guild 2"]}
+
+The caller only builds the dict and puts it on a bounded queue; one listener
+thread per process formats and writes it (logging's QueueHandler /
+QueueListener). When the queue is full the record is dropped and counted
+rather than blocking the request. EVENT_LOG_SAMPLE keeps that share of
+successful events; failed events and records with an error note are always
+kept. Records go to stdout (EVENT_LOG_STDOUT=0 turns that off) and, with
+EVENT_LOG_FILE set, to a size-rotated file -- one per worker process if the
+path contains {pid}, since rotation is not safe across processes.
+A note() outside any event is written as a record of its own.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from webhook_common import to_int_or_none
+
+EVENT_LOG_SAMPLE = float(os.getenv("EVENT_LOG_SAMPLE", "1"))        # share of successful events kept
+EVENT_LOG_QUEUE_MAX = int(os.getenv("EVENT_LOG_QUEUE_MAX", "10000"))
+EVENT_LOG_STDOUT = os.getenv("EVENT_LOG_STDOUT", "1").lower() not in ("0", "false", "no")
+EVENT_LOG_FILE = os.getenv("EVENT_LOG_FILE")                         # e.g. logs/events-{pid}.jsonl
+EVENT_LOG_FILE_MAX_BYTES = int(os.getenv("EVENT_LOG_FILE_MAX_BYTES", str(50 * 1024 * 1024)))
+EVENT_LOG_FILE_BACKUPS = int(os.getenv("EVENT_LOG_FILE_BACKUPS", "5"))
+
+
+class _Event:
+    __slots__ = ("fields", "notes", "error", "done")
+
+    def __init__(self, fields: dict):
+        self.fields = fields
+        self.notes = []
+        self.error = False
+        self.done = False
+
+
+_current = contextvars.ContextVar("event_log_current", default=None)
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Pipeline
+# ─────────────────────────────────────────────────────────────────────────────
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        ts = datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds")
+        return json.dumps({"ts": ts, "level": record.levelname.lower(), "pid": record.process, **record.msg},
+                          default=str, ensure_ascii=False)
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Enqueue the record as is (formatting happens on the listener) and never block."""
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _count("dropped")
+
+
+_stats_lock = threading.Lock()
+_stats = {"records": 0, "sampled_out": 0, "dropped": 0}
+
+_logger = logging.getLogger("veil.events")
+_logger.propagate = False
+_logger.setLevel(logging.INFO)
+
+_pid = None
+_listener = None
+_start_lock = threading.Lock()
+
+
+def _count(key: str):
+    with _stats_lock:
+        _stats[key] += 1
+
+
+def _sinks():
+    formatter = JsonFormatter()
+    sinks = []
+    if EVENT_LOG_STDOUT:
+        sinks.append(logging.StreamHandler(sys.stdout))
+    if EVENT_LOG_FILE:
+        path = EVENT_LOG_FILE.replace("{pid}", str(os.getpid()))
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        sinks.append(logging.handlers.RotatingFileHandler(
+            path, maxBytes=EVENT_LOG_FILE_MAX_BYTES, backupCount=EVENT_LOG_FILE_BACKUPS, encoding="utf-8"))
+    for sink in sinks:
+        sink.setFormatter(formatter)
+    return sinks
+
+
+def _ensure_started():
+    """This process's queue and listener thread (a forked worker starts its own)."""
+    global _pid, _listener
+    if _pid == os.getpid():
+        return
+    with _start_lock:
+        if _pid == os.getpid():
+            return
+        q = queue.Queue(EVENT_LOG_QUEUE_MAX)
+        for handler in list(_logger.handlers):
+            _logger.removeHandler(handler)
+        _logger.addHandler(_DroppingQueueHandler(q))
+        _listener = logging.handlers.QueueListener(q, *_sinks(), respect_handler_level=False)
+        _listener.start()
+        _pid = os.getpid()
+
+
+def _emit(fields: dict, error: bool):
+    if not error and EVENT_LOG_SAMPLE < 1 and random.random() >= EVENT_LOG_SAMPLE:
+        _count("sampled_out")
+        return
+    _ensure_started()
+    _count("records")
+    _logger.log(logging.ERROR if error else logging.INFO, {k: v for k, v in fields.items() if v is not None})
+
+# ─────────────────────────────────────────────────────────────────────────────
+# API
+# ─────────────────────────────────────────────────────────────────────────────
+
+@contextmanager
+def event(source: str, event_type: str, **fields):
+    """Collect bind() / note() calls made while handling one event; emit them as one record at the end."""
+    ev = _Event({"source": source, "event_type": event_type, **fields})
+    token = _current.set(ev)
+    start = time.perf_counter()
+    try:
+        yield ev
+    except BaseException as e:
+        ev.error = True
+        ev.fields["outcome"] = "error"
+        ev.fields["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        ev.done = True  # background tasks that copied the context now log on their own
+        ev.fields.setdefault("outcome", "ok")
+        ev.fields["ms"] = round((time.perf_counter() - start) * 1000, 3)
+        if ev.notes:
+            ev.fields["notes"] = ev.notes
+        _emit(ev.fields, ev.error)
+
+
+def bind(**fields):
+    """Add correlation ids (guild_id, session_id, subscription_id, ...) to the current event's record."""
+    ev = _current.get()
+    if ev is not None and not ev.done:
+        ev.fields.update(fields)
+
+
+def note(message: str, error: bool = False, **fields):
+    """One step of the current event; a record of its own outside an event. error=True always keeps it."""
+    ev = _current.get()
+    if ev is None or ev.done:
+        _emit(dict(fields, notes=[message]), error)
+        return
+    ev.notes.append(message)
+    ev.fields.update(fields)
+    ev.error = ev.error or error
+
+
+def correlation_ids(source: str, arg) -> dict:
+    """Ids known before a handler runs: the Stripe event id, the Top.gg voter."""
+    if source == "stripe":
+        return {"event_id": arg.get("id")}
+    if source == "topgg":
+        return {"user_id": to_int_or_none(arg.get("user"))}
+    return {}
+
+
+def event_log_stats() -> dict:
+    with _stats_lock:
+        out = dict(_stats)
+    out["queued"] = _listener.queue.qsize() if _listener is not None and _pid == os.getpid() else 0
+    out["sample"] = EVENT_LOG_SAMPLE
+    return out
+
+
+def _after_fork_in_child():
+    global _stats_lock, _start_lock
+    _stats_lock = threading.Lock()
+    _start_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+@atexit.register
+def shutdown():
+    """Write what is still queued and stop this process's listener (the next record starts a new one)."""
+    global _pid, _listener
+    with _start_lock:
+        listener, mine = _listener, _pid == os.getpid()
+        _pid = _listener = None
+    if listener is not None and mine:
+        try:
+            listener.stop()
+        except Exception:
+            pass
@@ -0,0 +1,327 @@
+"""
+Per-guild ordering for Stripe events (EVENT_ORDERING=1, the default).
+
+Stripe delivers events concurrently and out of order, and any gunicorn worker
+or inbox thread may be handling one for the same guild as another. Each event
+is mapped to a shard -- `guild:<id>` for subscription state, `user:<id>` for
+coin packs -- and handled while holding a session-level advisory lock on it,
+so events for one guild run one at a time across every process while other
+guilds keep running in parallel. Threads of one process queue for a shard in
+memory first, so a busy guild ties up at most one pool connection per process.
+
+Guild shards also keep a watermark: the newest Stripe `created` applied so far.
+An event older than that (a renewal arriving after the cancellation that
+followed it) is skipped instead of overwriting newer state; events from the
+same second are all applied. Coin packs only ever add, so user shards are
+serialized but never skipped.
+
+Taking the lock and reading the watermark is one statement (veil_shard_enter),
+and the handler's own statements reuse the lock's connection (db_pool.pinned).
+The handler moves the watermark itself, with advance() in the same transaction
+as the state change it records, so a handler that raises leaves it where it
+was; an event that writes nothing does not move it.
+
+    python event_order.py show [guild_id]     # watermarks, newest first
+"""
+import hashlib
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+import psycopg2.errors
+import psycopg2.extensions
+
+import event_log
+from db_pool import Prepared, get_db_conn, get_pool, pinned
+from subscription_cache import invoice_subscription_id, subscription_cache
+from webhook_common import checkout_details, to_int_or_none
+
+EVENT_ORDERING = os.getenv("EVENT_ORDERING", "1").lower() not in ("0", "false", "no")
+EVENT_LOCK_TIMEOUT = float(os.getenv("EVENT_LOCK_TIMEOUT", "30"))  # seconds; then the event is retried (500 / inbox)
+LOCK_WAIT = f"{max(1, round(EVENT_LOCK_TIMEOUT * 1000))}ms"        # the same, as veil_shard_enter's lock_timeout
+
+SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS event_watermarks (
+        shard      TEXT PRIMARY KEY,
+        created    BIGINT NOT NULL,        -- Stripe event.created (unix seconds) of the newest applied event
+        event_id   TEXT NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+
+    -- Lock the shard for this session and, when event_created is given, return
+    -- its watermark (0: none yet); above event_created means a newer event
+    -- already applied. The lock is held either way and the caller releases it;
+    -- holding it, the row is ours to read and write.
+    CREATE OR REPLACE FUNCTION veil_shard_enter(lock_key BIGINT, shard_name TEXT, event_created BIGINT,
+                                                stripe_event_id TEXT, wait TEXT)
+    RETURNS BIGINT LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM set_config('lock_timeout', wait, true);
+        PERFORM pg_advisory_lock(lock_key);
+        IF event_created IS NULL THEN
+            RETURN NULL;
+        END IF;
+        RETURN COALESCE((SELECT w.created FROM event_watermarks w WHERE w.shard = shard_name), 0);
+    END $$;
+"""
+
+ENTER = Prepared("veil_shard_enter", ("bigint", "text", "bigint", "text", "text"),
+                 "SELECT veil_shard_enter($1, $2, $3, $4, $5)")
+LEAVE = Prepared("veil_shard_leave", ("bigint",), "SELECT pg_advisory_unlock($1)")
+
+# Move the shard's watermark forward to an event being applied; never backward.
+ADVANCE = Prepared("veil_shard_advance", ("text", "bigint", "text"), """
+    INSERT INTO event_watermarks AS w (shard, created, event_id)
+    VALUES ($1, $2, $3)
+    ON CONFLICT (shard) DO UPDATE
+        SET created = EXCLUDED.created,
+            event_id = EXCLUDED.event_id,
+            updated_at = NOW()
+      WHERE w.created <= EXCLUDED.created
+""")
+
+
+# What in_order() found: `stale` -- a newer event for the shard already applied;
+# `previous` -- the watermark before this event (0: none; None: not ordered);
+# `shard`, `created`, `event_id` -- what advance() records once the event applies.
+Turn = namedtuple("Turn", "stale previous shard created event_id")
+UNORDERED = Turn(False, None, None, None, None)
+
+
+def turn(shard, created, event_id, previous) -> Turn:
+    if created is None or previous is None:
+        return UNORDERED
+    return Turn(previous > created, previous, shard, created, event_id)
+
+
+def advance(cur, t: Turn):
+    """
+    Record t's event as applied to its shard. Call it in the transaction that
+    applies the event's state change, so both commit or neither does.
+    """
+    if t.previous is not None and not t.stale:
+        ADVANCE.execute(cur, (t.shard, t.created, t.event_id))
+
+
+async def advance_async(conn, t: Turn):
+    """advance on an asyncpg connection (inside the state change's transaction)."""
+    if t.previous is not None and not t.stale:
+        await conn.execute(ADVANCE.typed_sql, t.shard, t.created, t.event_id)
+
+
+class ShardBusy(Exception):
+    """The shard stayed locked for EVENT_LOCK_TIMEOUT; retry the event later."""
+
+
+def ensure_schema():
+    with get_db_conn() as conn, conn.cursor() as cur:
+        # every worker runs this on start; CREATE OR REPLACE FUNCTION side by side
+        # fails with "tuple concurrently updated"
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK,))
+        cur.execute(SCHEMA_SQL)
+
+
+_ready_pid = None
+_ready_lock = threading.Lock()
+
+
+def ensure_ready() -> bool:
+    """Create the watermark table / function once per process (ordering on only). False if that failed."""
+    global _ready_pid
+    if not EVENT_ORDERING or _ready_pid == os.getpid():
+        return True
+    with _ready_lock:
+        if _ready_pid == os.getpid():
+            return True
+        try:
+            ensure_schema()
+        except Exception as e:
+            event_log.note(f"❌ [order] could not ensure schema: {e}", error=True)
+            return False
+        _ready_pid = os.getpid()
+        return True
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Shards
+# ─────────────────────────────────────────────────────────────────────────────
+
+def lock_key(shard: str) -> int:
+    """Signed 64-bit advisory lock key for a shard, the same in every process."""
+    digest = hashlib.blake2b(shard.encode(), digest_size=8, person=b"veil-shard").digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+SCHEMA_LOCK = lock_key("schema:event_order")
+
+
+def stripe_shard(event):
+    """
+    (shard, ordered) for a Stripe event: the guild whose subscription it changes
+    (ordered by `created`) or the user a coin pack credits (serialized only).
+    (None, False) when it touches neither. Call after observe_event(), so an
+    invoice's subscription comes from the snapshot it carries.
+    """
+    event_type = event["type"]
+    obj = event["data"]["object"]
+    guild_id = None
+
+    if event_type == "checkout.session.completed":
+        d = checkout_details(obj)
+        if d["mode"] == "payment" and not d["tier"]:
+            return (f"user:{d['user_id']}", False) if d["user_id"] else (None, False)
+        if d["tier"]:
+            guild_id = d["guild_id"]
+
+    elif event_type in ("invoice.payment_succeeded", "invoice.payment_failed"):
+        subscription_id = invoice_subscription_id(obj)
+        if subscription_id:
+            try:
+                guild_id = to_int_or_none(subscription_cache.fetch(subscription_id)["guild_id"])
+            except Exception:
+                guild_id = None  # the handler hits the same error and reports it
+
+    elif event_type == "customer.subscription.deleted":
+        guild_id = to_int_or_none((obj.get("metadata") or {}).get("guild_id"))
+
+    return (f"guild:{guild_id}", True) if guild_id else (None, False)
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Locking
+# ─────────────────────────────────────────────────────────────────────────────
+
+_stats_lock = threading.Lock()
+_stats = {"entered": 0, "stale": 0, "busy": 0, "queued_local": 0, "lock_wait_ms_total": 0.0, "lock_wait_ms_max": 0.0}
+
+_local = {}                       # shard -> [threading.Lock, users] (this process's queue)
+_local_guard = threading.Lock()
+
+
+def record(waited: float, t: Turn):
+    """Count one shard entry (shared with the async app)."""
+    ms = waited * 1000
+    with _stats_lock:
+        _stats["entered"] += 1
+        _stats["stale"] += t.stale
+        _stats["lock_wait_ms_total"] += ms
+        _stats["lock_wait_ms_max"] = max(_stats["lock_wait_ms_max"], ms)
+
+
+def record_busy():
+    with _stats_lock:
+        _stats["busy"] += 1
+
+
+def record_queued():
+    with _stats_lock:
+        _stats["queued_local"] += 1
+
+
+@contextmanager
+def _queued(shard: str):
+    """One thread per process per shard goes on to the advisory lock; the rest wait here."""
+    with _local_guard:
+        entry = _local.setdefault(shard, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        if not entry[0].acquire(blocking=False):
+            record_queued()
+            if not entry[0].acquire(timeout=EVENT_LOCK_TIMEOUT):
+                record_busy()
+                raise ShardBusy(f"{shard} busy for {EVENT_LOCK_TIMEOUT:g}s")
+        try:
+            yield
+        finally:
+            entry[0].release()
+    finally:
+        with _local_guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del _local[shard]
+
+
+@contextmanager
+def in_order(shard, created=None, event_id=None):
+    """
+    Hold `shard` for the block and yield a Turn; get_db_conn() inside it uses the
+    lock's connection. Raises ShardBusy after EVENT_LOCK_TIMEOUT.
+    created=None: serialize only, never stale.
+    """
+    if not (EVENT_ORDERING and shard):
+        yield UNORDERED
+        return
+
+    key = lock_key(shard)
+    with _queued(shard):
+        pool = get_pool()
+        conn = pool.getconn()
+        start = time.monotonic()
+        try:
+            # entering and leaving are one statement each, no BEGIN / COMMIT around them
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                t = turn(shard, created, event_id,
+                         ENTER.execute(cur, (key, shard, created, event_id, LOCK_WAIT)).fetchone()[0])
+            conn.autocommit = False
+        except BaseException as e:
+            # the session goes, and any lock it got before the error with it
+            pool.putconn(conn, discard=True)
+            if isinstance(e, psycopg2.errors.LockNotAvailable):
+                record_busy()
+                raise ShardBusy(f"{shard} busy for {LOCK_WAIT}") from e
+            raise
+        record(time.monotonic() - start, t)
+
+        try:
+            with pinned(conn):
+                yield t
+        finally:
+            try:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    LEAVE.execute(cur, (key,))
+                conn.autocommit = False
+                pool.putconn(conn)
+            except Exception:
+                pool.putconn(conn, discard=True)
+
+
+def event_order_stats() -> dict:
+    with _stats_lock:
+        out = dict(_stats)
+    out["lock_wait_ms_avg"] = round(out["lock_wait_ms_total"] / out["entered"], 3) if out["entered"] else 0.0
+    out["lock_wait_ms_total"] = round(out["lock_wait_ms_total"], 3)
+    out["lock_wait_ms_max"] = round(out["lock_wait_ms_max"], 3)
+    out["enabled"] = EVENT_ORDERING
+    return out
+
+
+def _after_fork_in_child():
+    global _stats_lock, _local_guard, _ready_lock
+    _stats_lock = threading.Lock()
+    _local_guard = threading.Lock()
+    _ready_lock = threading.Lock()
+    _local.clear()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+if __name__ == "__main__":
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "show"
+    if cmd == "show":
+        with get_db_conn() as conn, conn.cursor() as cur:
+            if len(sys.argv) > 2:
+                cur.execute("SELECT shard, created, event_id, updated_at FROM event_watermarks WHERE shard = %s",
+                            (f"guild:{int(sys.argv[2])}",))
+            else:
+                cur.execute("SELECT shard, created, event_id, updated_at FROM event_watermarks "
+                            "ORDER BY updated_at DESC LIMIT 50")
+            for shard, created, event_id, updated_at in cur.fetchall():
+                print(f"{shard:<28}{created:>12}  {event_id:<32}{updated_at:%Y-%m-%d %H:%M:%S}")
+    else:
+        sys.exit(f"usage: {sys.argv[0]} show [guild_id]")
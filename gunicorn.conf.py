@@ -0,0 +1,27 @@
+"""
+gunicorn settings, read from the working directory (`web: gunicorn stripe_webhook:app`).
+
+Workers are gthread workers with WEB_THREADS threads each (default 4, within
+the default DB_POOL_MAX of 5), so a worker handles concurrent requests: the
+Top.gg vote batcher (vote_gate.py) only ever batches votes that arrive while
+another is waiting in the same worker. With a single thread per worker set
+TOPGG_BATCH_WINDOW=0, or every vote waits out the window alone. Command-line
+flags (-k, --threads) override these.
+
+Each worker starts its background work (schema check, inbox workers, ledger
+compactor, entitlement listener) as soon as it has loaded the app, rather
+than on its first request.
+"""
+import importlib
+import os
+
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", "4"))
+
+
+def post_worker_init(worker):
+    # the app module is already imported by now; this only looks it up
+    module = importlib.import_module(worker.app.app_uri.split(":")[0])
+    start = getattr(module, "start_background", None)  # the aiohttp app starts its own in on_startup
+    if start is not None:
+        start()
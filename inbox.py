@@ -0,0 +1,302 @@
+"""
+Durable webhook inbox (persist-then-ack).
+
+With WEBHOOK_INBOX=1 the webhook routes only verify the request, store the raw
+event in `webhook_inbox` keyed by its id and return 200. Worker threads claim
+stored events with FOR UPDATE SKIP LOCKED (so any number of processes can share
+the table) and run the normal processing code. Failed events are retried with
+backoff; an event whose worker died mid-way is reclaimed after
+INBOX_CLAIM_TIMEOUT seconds. The async app works the same table from tasks on
+its own event loop and asyncpg pool (work_async).
+
+Stripe events are keyed by their event id. Top.gg votes carry no id, so they
+are keyed by the voter and the 12-hour window the vote arrived in (see
+topgg_event_id): a retry of a stored vote is a no-op like a Stripe retry.
+"""
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+import event_log
+from db_pool import Prepared, get_db_conn
+from webhook_common import to_int_or_none
+
+INBOX_ENABLED = os.getenv("WEBHOOK_INBOX", "0").lower() in ("1", "true", "yes")
+INBOX_WORKERS = int(os.getenv("INBOX_WORKERS", "2"))
+INBOX_BATCH = int(os.getenv("INBOX_BATCH", "5"))
+INBOX_POLL_INTERVAL = float(os.getenv("INBOX_POLL_INTERVAL", "2"))
+INBOX_MAX_ATTEMPTS = int(os.getenv("INBOX_MAX_ATTEMPTS", "8"))
+INBOX_CLAIM_TIMEOUT = int(os.getenv("INBOX_CLAIM_TIMEOUT", "300"))
+
+TOPGG_VOTE_WINDOW = 12 * 3600  # Top.gg takes one vote per user per 12 hours
+
+SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS webhook_inbox (
+        event_id     TEXT PRIMARY KEY,
+        source       TEXT NOT NULL,
+        event_type   TEXT,
+        payload      JSONB NOT NULL,
+        status       TEXT NOT NULL DEFAULT 'pending',   -- pending | processing | done | failed
+        attempts     INTEGER NOT NULL DEFAULT 0,
+        received_at  TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        available_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        claimed_at   TIMESTAMPTZ,
+        processed_at TIMESTAMPTZ,
+        last_error   TEXT
+    );
+    CREATE INDEX IF NOT EXISTS webhook_inbox_open_idx
+        ON webhook_inbox (received_at)
+     WHERE status IN ('pending', 'processing');
+"""
+
+
+def ensure_schema():
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute(SCHEMA_SQL)
+
+
+def topgg_event_id(data: dict) -> str:
+    """
+    Inbox key for a Top.gg vote: `topgg:<user>:<12-hour window>`. A user's next
+    vote is at least 12 hours later, so it always lands in a later window; only
+    a retry that straddles a window boundary is stored twice, and by then the
+    first copy has used up the /vote session. Payloads without a user (dashboard
+    tests) get a key of their own.
+    """
+    user_id = to_int_or_none(data.get("user"))
+    if not user_id:
+        return f"topgg:{uuid.uuid4()}"
+    return f"topgg:{user_id}:{int(time.time() // TOPGG_VOTE_WINDOW)}"
+
+
+STORE = Prepared("veil_inbox_store", ("text", "text", "text", "jsonb"), """
+    INSERT INTO webhook_inbox (event_id, source, event_type, payload)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (event_id) DO NOTHING
+ RETURNING event_id
+""")
+
+CLAIM = Prepared("veil_inbox_claim", ("double precision", "integer"), """
+    UPDATE webhook_inbox i
+       SET status = 'processing',
+           attempts = i.attempts + 1,
+           claimed_at = NOW()
+      FROM (
+            SELECT event_id
+              FROM webhook_inbox
+             WHERE (status = 'pending' AND available_at <= NOW())
+                OR (status = 'processing' AND claimed_at < NOW() - make_interval(secs => $1))
+          ORDER BY received_at
+             LIMIT $2
+               FOR UPDATE SKIP LOCKED
+           ) c
+     WHERE i.event_id = c.event_id
+ RETURNING i.event_id, i.source, i.payload, i.attempts
+""")
+
+MARK_DONE = Prepared("veil_inbox_mark_done", ("text",), """
+    UPDATE webhook_inbox
+       SET status = 'done', processed_at = NOW(), last_error = NULL
+     WHERE event_id = $1
+""")
+
+MARK_FAILED = Prepared("veil_inbox_mark_failed", ("text", "double precision", "text", "text"), """
+    UPDATE webhook_inbox
+       SET status = $1,
+           available_at = NOW() + make_interval(secs => $2),
+           last_error = $3
+     WHERE event_id = $4
+""")
+
+
+def store_event(source: str, event_id: str, event_type, payload) -> bool:
+    """
+    Persist one event. Returns False if it was already stored (a retry).
+    `payload` may be the raw JSON text or an already-parsed object.
+    """
+    if not isinstance(payload, str):
+        payload = json.dumps(payload)
+    with get_db_conn() as conn, conn.cursor() as cur:
+        inserted = STORE.execute(cur, (event_id, source, event_type, payload)).fetchone() is not None
+    if inserted:
+        _wake.set()
+    return inserted
+
+
+def _claim(limit: int):
+    with get_db_conn() as conn, conn.cursor() as cur:
+        return CLAIM.execute(cur, (INBOX_CLAIM_TIMEOUT, limit)).fetchall()
+
+
+def _mark_done(event_id: str):
+    with get_db_conn() as conn, conn.cursor() as cur:
+        MARK_DONE.execute(cur, (event_id,))
+
+
+def _retry(attempts: int):
+    """(status, delay) after a failed attempt: pending with backoff, or failed for good."""
+    final = attempts >= INBOX_MAX_ATTEMPTS
+    return ("failed" if final else "pending"), min(600, 2 ** attempts) * random.uniform(0.5, 1.5)
+
+
+def _mark_failed(event_id: str, attempts: int, error: str):
+    status, delay = _retry(attempts)
+    with get_db_conn() as conn, conn.cursor() as cur:
+        MARK_FAILED.execute(cur, (status, delay, error[:1000], event_id))
+    return status == "failed"
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Workers
+# ─────────────────────────────────────────────────────────────────────────────
+
+_wake = threading.Event()
+_started_pid = None
+_start_lock = threading.Lock()
+_counters = {"claimed": 0, "done": 0, "retried": 0, "failed": 0}
+_counters_lock = threading.Lock()
+
+
+def _count(name: str):
+    with _counters_lock:
+        _counters[name] += 1
+
+
+def _worker(handlers: dict):
+    while True:
+        try:
+            rows = _claim(INBOX_BATCH)
+        except Exception as e:
+            event_log.note(f"❌ [inbox] claim failed: {e}", error=True)
+            rows = []
+
+        for event_id, source, payload, attempts in rows:
+            _count("claimed")
+            handler = handlers.get(source)
+            try:
+                if handler is None:
+                    raise RuntimeError(f"no handler for source {source!r}")
+                handler(payload)
+            except Exception as e:
+                try:
+                    final = _mark_failed(event_id, attempts, str(e) or type(e).__name__)
+                except Exception as mark_err:
+                    event_log.note(f"❌ [inbox] could not record failure for {event_id}: {mark_err}", error=True)
+                    continue
+                _count("failed" if final else "retried")
+                event_log.note(f"{'❌' if final else '⚠️'} [inbox] {event_id} attempt {attempts} failed: {e}", error=True)
+            else:
+                try:
+                    _mark_done(event_id)
+                    _count("done")
+                except Exception as e:
+                    # it will be reclaimed after INBOX_CLAIM_TIMEOUT and run again; every handler is idempotent
+            # per event (coin packs by checkout session, see credits.py)
+                    event_log.note(f"❌ [inbox] could not mark {event_id} done: {e}", error=True)
+
+        if len(rows) < INBOX_BATCH:
+            _wake.wait(INBOX_POLL_INTERVAL)
+            _wake.clear()
+
+
+def start_workers(handlers: dict) -> bool:
+    """
+    Start this process's inbox workers once. `handlers` maps source -> callable(payload).
+    False if the table could not be ensured (nothing started; call again).
+    """
+    global _started_pid
+    if _started_pid == os.getpid():
+        return True
+    with _start_lock:
+        if _started_pid == os.getpid():
+            return True
+        try:
+            ensure_schema()
+        except Exception as e:
+            event_log.note(f"❌ [inbox] could not ensure schema: {e}", error=True)
+            return False
+        for i in range(max(1, INBOX_WORKERS)):
+            threading.Thread(target=_worker, args=(handlers,), name=f"inbox-{i}", daemon=True).start()
+        _started_pid = os.getpid()
+        event_log.note(f"[inbox] started {INBOX_WORKERS} worker(s) in pid {_started_pid}")
+        return True
+
+
+def inbox_stats() -> dict:
+    with _counters_lock:
+        return dict(_counters, enabled=INBOX_ENABLED, running=_started_pid == os.getpid())
+
+# ─────────────────────────────────────────────────────────────────────────────
+# asyncpg (stripe_webhook_async)
+# ─────────────────────────────────────────────────────────────────────────────
+# The same table and statements, worked by tasks on the async app's event loop
+# and its own pool; handlers are coroutine functions.
+
+_async_wake = None   # asyncio.Event of this process's async workers
+
+
+async def store_event_async(conn, source: str, event_id: str, event_type, payload) -> bool:
+    """store_event on an asyncpg connection."""
+    if not isinstance(payload, str):
+        payload = json.dumps(payload)
+    inserted = await conn.fetchval(STORE.typed_sql, event_id, source, event_type, payload) is not None
+    if inserted and _async_wake is not None:
+        _async_wake.set()
+    return inserted
+
+
+async def _run_one_async(pool, handlers: dict, event_id, source, payload, attempts):
+    _count("claimed")
+    handler = handlers.get(source)
+    try:
+        if handler is None:
+            raise RuntimeError(f"no handler for source {source!r}")
+        await handler(json.loads(payload) if isinstance(payload, str) else payload)
+    except Exception as e:
+        status, delay = _retry(attempts)
+        try:
+            async with pool.acquire() as conn:
+                await conn.execute(MARK_FAILED.typed_sql, status, delay, (str(e) or type(e).__name__)[:1000],
+                                   event_id)
+        except Exception as mark_err:
+            event_log.note(f"❌ [inbox] could not record failure for {event_id}: {mark_err}", error=True)
+            return
+        _count("failed" if status == "failed" else "retried")
+        event_log.note(f"{'❌' if status == 'failed' else '⚠️'} [inbox] {event_id} attempt {attempts} failed: {e}",
+                       error=True)
+    else:
+        try:
+            async with pool.acquire() as conn:
+                await conn.execute(MARK_DONE.typed_sql, event_id)
+            _count("done")
+        except Exception as e:
+            # it will be reclaimed after INBOX_CLAIM_TIMEOUT and run again; every handler is idempotent
+            # per event (coin packs by checkout session, see credits.py)
+            event_log.note(f"❌ [inbox] could not mark {event_id} done: {e}", error=True)
+
+
+async def work_async(pool, handlers: dict):
+    """_worker as a task: claim a batch, run its events concurrently, repeat."""
+    global _async_wake, _started_pid
+    _async_wake = asyncio.Event()
+    _started_pid = os.getpid()
+    batch = max(1, INBOX_WORKERS) * INBOX_BATCH
+    while True:
+        try:
+            async with pool.acquire() as conn:
+                rows = await conn.fetch(CLAIM.typed_sql, INBOX_CLAIM_TIMEOUT, batch)
+        except Exception as e:
+            event_log.note(f"❌ [inbox] claim failed: {e}", error=True)
+            rows = []
+        if rows:
+            await asyncio.gather(*(_run_one_async(pool, handlers, *row) for row in rows))
+        if len(rows) < batch:
+            try:
+                await asyncio.wait_for(_async_wake.wait(), INBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            _async_wake.clear()
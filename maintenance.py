@@ -0,0 +1,367 @@
+"""
+Retention and partition maintenance for the session and vote-event tables.
+
+    python maintenance.py run        # one pass: expire, purge, roll partitions
+    python maintenance.py loop       # a pass every MAINT_INTERVAL seconds (Procfile `maintenance:`)
+    python maintenance.py partition  # convert vote_events to monthly partitions (one-off)
+
+Every /vote writes a topgg_vote_sessions row and every coin checkout a
+coin_checkout_sessions row, and nothing ever removed them. A pass now
+
+  * expires unused vote sessions older than VOTE_SESSION_TTL (the interaction
+    token they carry is long dead, and a vote that late would credit whatever
+    guild the user last ran /vote in),
+  * removes used vote sessions and checkout sessions past their retention,
+  * trims vote_events past VOTE_EVENTS_RETENTION (0 = keep forever): by
+    dropping whole monthly partitions once the table is partitioned, otherwise
+    by batched deletes.
+
+Rows go in batches of MAINT_BATCH, one short transaction each (FOR UPDATE SKIP
+LOCKED, so a webhook touching the same row wins and the row waits for the next
+pass), with MAINT_PAUSE between batches. With MAINT_ARCHIVE=1 removed rows are
+moved into `<table>_archive` and expired partitions are detached and kept,
+instead of being deleted / dropped.
+
+Each batch logs the rows it reclaimed and how long it held its locks.
+"""
+import os
+import re
+import sys
+import time
+from collections import namedtuple
+from datetime import date, datetime, timezone
+
+import event_log
+import metrics
+from db_pool import get_db_conn
+
+MAINT_INTERVAL = float(os.getenv("MAINT_INTERVAL", "3600"))
+MAINT_BATCH = int(os.getenv("MAINT_BATCH", "1000"))
+MAINT_PAUSE = float(os.getenv("MAINT_PAUSE", "0.1"))                  # seconds between batches
+MAINT_LOCK_TIMEOUT = os.getenv("MAINT_LOCK_TIMEOUT", "2s")            # give up on a batch / DDL rather than queue writers
+MAINT_ARCHIVE = os.getenv("MAINT_ARCHIVE", "0").lower() in ("1", "true", "yes")
+
+DAY = 86400
+VOTE_SESSION_TTL = int(os.getenv("VOTE_SESSION_TTL", str(DAY)))                      # unused /vote sessions
+VOTE_SESSION_RETENTION = int(os.getenv("VOTE_SESSION_RETENTION", str(7 * DAY)))      # used /vote sessions
+COIN_SESSION_RETENTION = int(os.getenv("COIN_SESSION_RETENTION", str(7 * DAY)))      # coin checkout sessions
+VOTE_EVENTS_RETENTION = int(os.getenv("VOTE_EVENTS_RETENTION", "0"))                 # 0 = keep vote history
+VOTE_EVENTS_PARTITIONS_AHEAD = int(os.getenv("VOTE_EVENTS_PARTITIONS_AHEAD", "3"))   # months
+
+Rule = namedtuple("Rule", "name table key where retention")
+
+RULES = (
+    Rule("expired vote sessions", "topgg_vote_sessions", "id", "used = FALSE AND created_at", VOTE_SESSION_TTL),
+    Rule("used vote sessions", "topgg_vote_sessions", "id", "used = TRUE AND created_at", VOTE_SESSION_RETENTION),
+    Rule("coin checkout sessions", "coin_checkout_sessions", "stripe_session_id", "created_at", COIN_SESSION_RETENTION),
+    Rule("vote events", "vote_events", "id", "voted_at", VOTE_EVENTS_RETENTION),
+)
+
+
+def _is_partitioned(cur, table: str) -> bool:
+    cur.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+    row = cur.fetchone()
+    return bool(row and row[0])
+
+
+def _ensure_archive(table: str):
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {table}_archive (LIKE {table})")
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Batched retention
+# ─────────────────────────────────────────────────────────────────────────────
+
+def purge_batch(rule: Rule, limit: int = MAINT_BATCH):
+    """Remove (or archive) up to `limit` rows matching `rule`. Returns (rows, seconds locks were held)."""
+    archive = (f", archived AS (INSERT INTO {rule.table}_archive SELECT * FROM moved)"
+               if MAINT_ARCHIVE else "")
+    start = time.monotonic()
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("SET LOCAL lock_timeout = %s", (MAINT_LOCK_TIMEOUT,))
+        # for the id-keyed tables, ORDER BY walks the primary key from the oldest rows and stops at `limit`
+        cur.execute(f"""
+            WITH doomed AS (
+                SELECT {rule.key}
+                  FROM {rule.table}
+                 WHERE {rule.where} < NOW() - make_interval(secs => %s)
+              ORDER BY {rule.key}
+                 LIMIT %s
+                   FOR UPDATE SKIP LOCKED
+            ), moved AS (
+                DELETE FROM {rule.table}
+                 WHERE {rule.key} IN (SELECT {rule.key} FROM doomed)
+             RETURNING *
+            ){archive}
+            SELECT COUNT(*) FROM moved
+        """, (rule.retention, limit))
+        rows = cur.fetchone()[0]
+    return rows, time.monotonic() - start
+
+
+def purge(rule: Rule, limit: int = MAINT_BATCH) -> dict:
+    """Run `rule` to completion, one batch at a time."""
+    if MAINT_ARCHIVE:
+        _ensure_archive(rule.table)
+    total, batches, max_lock = 0, 0, 0.0
+    while True:
+        rows, held = purge_batch(rule, limit)
+        batches += 1
+        total += rows
+        max_lock = max(max_lock, held)
+        metrics.observe("veil_maintenance_batch_seconds", held, table=rule.table)
+        metrics.inc("veil_maintenance_rows_total", rows, table=rule.table)
+        if rows:
+            event_log.note(f"[maint] {rule.name}: batch {batches} {'archived' if MAINT_ARCHIVE else 'deleted'} "
+                           f"{rows} row(s), locks held {held * 1000:.1f} ms")
+        if rows < limit:
+            break
+        time.sleep(MAINT_PAUSE)
+    return {"rows": total, "batches": batches, "max_lock_ms": round(max_lock * 1000, 1)}
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# vote_events partitions
+# ─────────────────────────────────────────────────────────────────────────────
+# Monthly RANGE partitions on voted_at, named vote_events_yYYYYmMM. The
+# conversion keeps the existing rows as one partition (vote_events_legacy)
+# covering everything before the first monthly one; it ages out like the rest.
+# Months are UTC months, like the partition bounds.
+#
+# A DEFAULT partition (vote_events_default) takes votes for a month whose
+# partition does not exist yet -- maintenance stopped for longer than
+# VOTE_EVENTS_PARTITIONS_AHEAD -- instead of the insert failing and the vote
+# being lost. Creating that month's partition later moves them out of it.
+#
+# A partitioned table can only enforce uniqueness together with the partition
+# key, so the nonce constraint becomes UNIQUE (nonce, voted_at). A repeated
+# nonce is still impossible: the nonce is the vote session id, and the credit
+# statement only writes a vote while flipping that session from unused to used.
+
+_BOUND_TO_RE = re.compile(r"TO \('([^']+)'\)")
+
+DEFAULT_PARTITION = "vote_events_default"
+
+
+def _utc_today() -> date:
+    return datetime.now(timezone.utc).date()
+
+
+def _month_start(d: date, months_ahead: int = 0) -> date:
+    m = d.month - 1 + months_ahead
+    return date(d.year + m // 12, m % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"vote_events_y{month.year:04d}m{month.month:02d}"
+
+
+def _partitions(cur):
+    """[(name, upper bound or None, detach pending)] for vote_events, bounds in UTC (None for the default)."""
+    cur.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), i.inhdetachpending
+          FROM pg_inherits i
+          JOIN pg_class c ON c.oid = i.inhrelid
+         WHERE i.inhparent = 'vote_events'::regclass
+      ORDER BY c.relname
+    """)
+    result = []
+    for name, bound, pending in cur.fetchall():
+        m = _BOUND_TO_RE.search(bound or "")
+        result.append((name, date.fromisoformat(m.group(1)[:10]) if m else None, pending))
+    return result
+
+
+def convert_to_partitions():
+    """One-off: turn vote_events into a partitioned table, keeping its rows as the legacy partition.
+
+    Holds an ACCESS EXCLUSIVE lock on vote_events while it validates the
+    existing rows, so run it at a quiet time.
+    """
+    with get_db_conn() as conn, conn.cursor() as cur:
+        if _is_partitioned(cur, "vote_events"):
+            event_log.note("[maint] vote_events is already partitioned")
+            return
+        cur.execute("SET LOCAL lock_timeout = %s", (MAINT_LOCK_TIMEOUT,))
+        cur.execute("SET LOCAL TimeZone = 'UTC'")
+        cur.execute("LOCK TABLE vote_events IN ACCESS EXCLUSIVE MODE")
+        cur.execute("SELECT pg_get_serial_sequence('vote_events', 'id')")
+        seq = cur.fetchone()[0]
+        cur.execute("SELECT conname FROM pg_constraint WHERE conrelid = 'vote_events'::regclass AND contype = 'p'")
+        pkey = cur.fetchone()
+        if pkey:  # the parent's (id, voted_at) key replaces it; ATTACH builds the matching index
+            cur.execute(f"ALTER TABLE vote_events DROP CONSTRAINT {pkey[0]}")
+        boundary = _month_start(_utc_today(), 1)
+        cur.execute(f"""
+            UPDATE vote_events SET voted_at = '-infinity' WHERE voted_at IS NULL;
+            ALTER TABLE vote_events RENAME TO vote_events_legacy;
+            ALTER TABLE vote_events_legacy ALTER COLUMN voted_at SET NOT NULL;
+            CREATE TABLE vote_events (
+                id       BIGINT NOT NULL DEFAULT nextval('{seq}'),
+                provider TEXT,
+                user_id  BIGINT,
+                guild_id BIGINT,
+                voted_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                nonce    TEXT,
+                PRIMARY KEY (id, voted_at),
+                CONSTRAINT vote_events_nonce_voted_at_key UNIQUE (nonce, voted_at)
+            ) PARTITION BY RANGE (voted_at);
+            ALTER TABLE vote_events_legacy ALTER COLUMN id DROP DEFAULT;
+            ALTER SEQUENCE {seq} OWNED BY vote_events.id;
+            ALTER TABLE vote_events ATTACH PARTITION vote_events_legacy
+                FOR VALUES FROM (MINVALUE) TO ('{boundary.isoformat()} 00:00:00+00');
+            CREATE TABLE {DEFAULT_PARTITION} PARTITION OF vote_events DEFAULT;
+        """)
+    event_log.note(f"[maint] vote_events partitioned; vote_events_legacy holds everything before {boundary}")
+
+
+def _add_month(cur, month: date) -> int:
+    """
+    Create and attach the partition for `month`, moving that month's votes out
+    of the default partition first (ATTACH refuses while the default still
+    holds any). Returns the number of votes moved.
+    """
+    name = partition_name(month)
+    lower = f"'{month.isoformat()} 00:00:00+00'"
+    upper = f"'{_month_start(month, 1).isoformat()} 00:00:00+00'"
+    cur.execute(f"CREATE TABLE {name} (LIKE vote_events INCLUDING DEFAULTS)")
+    cur.execute(f"""
+        WITH moved AS (
+            DELETE FROM {DEFAULT_PARTITION}
+             WHERE voted_at >= {lower} AND voted_at < {upper}
+         RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+    """)
+    moved = cur.rowcount
+    cur.execute(f"ALTER TABLE vote_events ATTACH PARTITION {name} FOR VALUES FROM ({lower}) TO ({upper})")
+    return moved
+
+
+def ensure_partitions(months_ahead: int = VOTE_EVENTS_PARTITIONS_AHEAD) -> list:
+    """
+    Create the default partition if missing, and monthly partitions through
+    `months_ahead` UTC months from now. Returns the names created.
+    """
+    created, moved = [], {}
+    with get_db_conn() as conn, conn.cursor() as cur:
+        if not _is_partitioned(cur, "vote_events"):
+            return created
+        cur.execute("SET LOCAL lock_timeout = %s", (MAINT_LOCK_TIMEOUT,))
+        cur.execute("SET LOCAL TimeZone = 'UTC'")
+        partitions = _partitions(cur)
+        if DEFAULT_PARTITION not in (name for name, _, _ in partitions):
+            cur.execute(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF vote_events DEFAULT")
+            created.append(DEFAULT_PARTITION)
+        today = _utc_today()
+        month = max((upper for _, upper, _ in partitions if upper), default=_month_start(today))
+        last = _month_start(today, months_ahead)
+        while month <= last:
+            name = partition_name(month)
+            moved[name] = _add_month(cur, month)
+            created.append(name)
+            month = _month_start(month, 1)
+    for name in created:
+        event_log.note(f"[maint] created partition {name}"
+                       + (f", moved {moved[name]} vote(s) out of {DEFAULT_PARTITION}" if moved.get(name) else ""))
+    return created
+
+
+def drop_expired_partitions(retention: int = VOTE_EVENTS_RETENTION) -> list:
+    """
+    Detach every partition whose range ended more than `retention` seconds
+    ago, then drop it -- or keep it as a standalone table with MAINT_ARCHIVE=1.
+    Returns the names removed.
+
+    The detach is a plain one, in a transaction bounded by MAINT_LOCK_TIMEOUT:
+    Postgres refuses DETACH ... CONCURRENTLY while the table has a default
+    partition. It holds ACCESS EXCLUSIVE on vote_events only for the catalog
+    change; a partition it cannot lock in time waits for the next pass.
+    """
+    if retention <= 0:
+        return []
+    with get_db_conn() as conn, conn.cursor() as cur:
+        if not _is_partitioned(cur, "vote_events"):
+            return []
+        cur.execute("SET LOCAL TimeZone = 'UTC'")
+        cur.execute("SELECT (NOW() - make_interval(secs => %s))::date", (retention,))
+        cutoff = cur.fetchone()[0]
+        expired = [(name, pending) for name, upper, pending in _partitions(cur) if upper and upper <= cutoff]
+
+    removed = []
+    for name, pending in expired:
+        start = time.monotonic()
+        try:
+            with get_db_conn() as conn, conn.cursor() as cur:
+                cur.execute("SET LOCAL lock_timeout = %s", (MAINT_LOCK_TIMEOUT,))
+                # FINALIZE completes a concurrent detach left pending by an older run
+                cur.execute(f"ALTER TABLE vote_events DETACH PARTITION {name}{' FINALIZE' if pending else ''}")
+                if not MAINT_ARCHIVE:
+                    cur.execute(f"DROP TABLE {name}")
+        except Exception as e:
+            event_log.note(f"❌ [maint] could not remove partition {name}: {e}", error=True)
+            continue
+        held = time.monotonic() - start
+        metrics.observe("veil_maintenance_batch_seconds", held, table="vote_events")
+        event_log.note(f"[maint] vote events: {'detached' if MAINT_ARCHIVE else 'dropped'} partition {name}, "
+                       f"took {held * 1000:.1f} ms")
+        removed.append(name)
+    return removed
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Passes
+# ─────────────────────────────────────────────────────────────────────────────
+
+def run_once() -> dict:
+    """One maintenance pass. Returns {rule name: {rows, batches, max_lock_ms}} plus partition changes."""
+    with get_db_conn() as conn, conn.cursor() as cur:
+        partitioned = _is_partitioned(cur, "vote_events")
+    summary = {}
+    for rule in RULES:
+        if rule.retention <= 0 or (rule.table == "vote_events" and partitioned):
+            continue
+        try:
+            summary[rule.name] = purge(rule)
+        except Exception as e:
+            metrics.error("maintenance")
+            event_log.note(f"❌ [maint] {rule.name} failed: {e}", error=True)
+    if partitioned:
+        try:
+            summary["partitions"] = {"created": ensure_partitions(), "removed": drop_expired_partitions()}
+        except Exception as e:
+            metrics.error("maintenance")
+            event_log.note(f"❌ [maint] partition upkeep failed: {e}", error=True)
+    return summary
+
+
+def _print_summary(summary: dict, elapsed: float):
+    parts = [f"{name} {r['rows']} row(s)/{r['batches']} batch(es), max lock {r['max_lock_ms']} ms"
+             for name, r in summary.items() if name != "partitions"]
+    if "partitions" in summary:
+        p = summary["partitions"]
+        parts.append(f"partitions +{len(p['created'])}/-{len(p['removed'])}")
+    event_log.note(f"[maint] pass done in {elapsed:.1f}s: " + "; ".join(parts))
+
+
+def loop():
+    event_log.note(f"[maint] running every {MAINT_INTERVAL:.0f}s (batch {MAINT_BATCH}, archive={'on' if MAINT_ARCHIVE else 'off'})")
+    while True:
+        start = time.monotonic()
+        _print_summary(run_once(), time.monotonic() - start)
+        time.sleep(max(0.0, MAINT_INTERVAL - (time.monotonic() - start)))
+
+
+if __name__ == "__main__":
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "run"
+    if cmd == "run":
+        start = time.monotonic()
+        _print_summary(run_once(), time.monotonic() - start)
+    elif cmd == "loop":
+        loop()
+    elif cmd == "partition":
+        convert_to_partitions()
+        ensure_partitions()
+    else:
+        sys.exit(f"usage: {sys.argv[0]} run|loop|partition")
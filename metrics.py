@@ -0,0 +1,410 @@
+"""
+Low-overhead instrumentation with a Prometheus-text /metrics endpoint.
+
+Each process keeps its counters and histograms in memory (a dict update under
+a lock per observation) and writes a snapshot to
+METRICS_DIR/metrics-<pid>-<token>.json every METRICS_FLUSH_INTERVAL seconds;
+the random token keeps a reused pid from overwriting an earlier process's file.
+/metrics, served by whichever gunicorn worker gets the scrape, merges them:
+
+- counters and histograms are summed over all snapshots plus totals.json, into
+  which the snapshots of exited processes are folded (and their files
+  removed), so totals never go backwards on a worker restart
+- gauges (pool in-use, queue depth, ...) are reported per live process with a
+  pid label; snapshots of exited workers contribute no gauges
+
+The default METRICS_DIR is scoped to the process group (the gunicorn master's
+run), so a new deploy starts from zero rather than summing the files of the
+previous one; directories left by groups that are gone are removed.
+
+Component stats (pool, delivery queue, caches, ...) are exported as gauges
+through register_collector().
+"""
+import atexit
+import bisect
+import fcntl
+import glob
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import event_log
+
+_RUNS_DIR = os.path.join(tempfile.gettempdir(), "veil_metrics")
+METRICS_DIR = os.getenv("METRICS_DIR") or os.path.join(_RUNS_DIR, str(os.getpgrp()))
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+
+# seconds; covers sub-ms DB statements up to multi-second Stripe/Discord calls
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    "veil_http_requests_seconds": "Request latency by route, method and status.",
+    "veil_event_seconds": "Event processing time by source, event type and outcome.",
+    "veil_db_statement_seconds": "Time per DB statement (one round trip each).",
+    "veil_stripe_api_seconds": "Stripe API call latency (including signature verification).",
+    "veil_outbound_http_seconds": "Outbound HTTP call latency (Discord).",
+    "veil_event_db_round_trips_total": "DB round trips made while handling events (on the handler's thread).",
+    "veil_errors_total": "Handled errors by branch.",
+    "veil_event_stale_total": "Stripe events skipped because a newer one for the guild was already applied.",
+    "veil_topgg_absorbed_total": "Top.gg votes answered by vote_gate without touching the database, by reason.",
+}
+
+
+def _key(labels: dict) -> str:
+    return json.dumps(sorted(labels.items())) if labels else "[]"
+
+
+class Registry:
+    def __init__(self):
+        self.pid = os.getpid()
+        self.token = os.urandom(4).hex()
+        self._lock = threading.Lock()
+        self._counters = {}     # name -> {label_key: value}
+        self._histograms = {}   # name -> {label_key: [bucket counts..., +Inf count, sum]}
+        self._collectors = {}   # prefix -> callable returning {name: number}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = _key(labels)
+        idx = bisect.bisect_left(DEFAULT_BUCKETS, seconds)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            h = series.get(key)
+            if h is None:
+                h = series[key] = [0] * (len(DEFAULT_BUCKETS) + 2)
+            h[idx] += 1
+            h[-1] += seconds
+
+    def register_collector(self, prefix: str, fn):
+        self._collectors[prefix] = fn
+
+    def snapshot(self) -> dict:
+        gauges = {}
+        pid_key = _key({"pid": self.pid})
+        for prefix, fn in list(self._collectors.items()):
+            try:
+                values = fn()
+            except Exception:
+                continue
+            for k, v in values.items():
+                if isinstance(v, bool):
+                    v = int(v)
+                if isinstance(v, (int, float)):
+                    gauges[f"veil_{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', k)}"] = {pid_key: v}
+        with self._lock:
+            return {
+                "pid": self.pid,
+                "written_at": time.time(),
+                "counters": {n: dict(s) for n, s in self._counters.items()},
+                "histograms": {n: {k: list(h) for k, h in s.items()} for n, s in self._histograms.items()},
+                "gauges": gauges,
+            }
+
+
+_registry = Registry()
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+_write_lock = threading.Lock()
+
+
+def registry() -> Registry:
+    global _registry
+    if _registry.pid != os.getpid():
+        # forked child: start from zero; the parent's numbers are in the parent's file
+        collectors = _registry._collectors
+        _registry = Registry()
+        _registry._collectors = dict(collectors)
+    _ensure_flusher()
+    return _registry
+
+
+def inc(name: str, value: float = 1, **labels):
+    registry().inc(name, value, **labels)
+
+
+def observe(name: str, seconds: float, **labels):
+    registry().observe(name, seconds, **labels)
+
+
+def error(branch: str):
+    registry().inc("veil_errors_total", branch=branch)
+
+
+@contextmanager
+def timed(name: str, **labels):
+    """Observe the block's duration; adds outcome="error" when it raises."""
+    start = time.perf_counter()
+    try:
+        yield labels
+    except BaseException:
+        labels.setdefault("outcome", "error")
+        raise
+    finally:
+        labels.setdefault("outcome", "ok")
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def register_collector(prefix: str, fn):
+    """Export fn()'s numeric values as gauges named veil_<prefix>_<key>."""
+    _registry.register_collector(prefix, fn)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Per-process snapshots and merging
+# ─────────────────────────────────────────────────────────────────────────────
+
+TOTALS_FILE = "totals.json"
+
+
+def _write_json(path: str, data: dict):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _read_json(path: str):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def flush():
+    reg = registry()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    # the flusher thread and a /metrics scrape share the temp file name
+    with _write_lock:
+        _write_json(os.path.join(METRICS_DIR, f"metrics-{reg.pid}-{reg.token}.json"), reg.snapshot())
+
+
+def _flush_forever():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception as e:
+            event_log.note(f"⚠️ [metrics] flush failed: {e}", error=True)
+
+
+def _ensure_flusher():
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    with _flusher_lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+        threading.Thread(target=_flush_forever, name="metrics-flush", daemon=True).start()
+
+
+def _after_fork_in_child():
+    global _flusher_lock, _write_lock
+    _flusher_lock = threading.Lock()
+    _write_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+@atexit.register
+def _flush_on_exit():
+    if _registry.pid == os.getpid():
+        try:
+            flush()
+        except Exception:
+            pass
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _group_alive(pgid: int) -> bool:
+    try:
+        os.killpg(pgid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _add(counters: dict, histograms: dict, snap: dict):
+    for name, series in snap.get("counters", {}).items():
+        out = counters.setdefault(name, {})
+        for k, v in series.items():
+            out[k] = out.get(k, 0) + v
+    for name, series in snap.get("histograms", {}).items():
+        out = histograms.setdefault(name, {})
+        for k, h in series.items():
+            acc = out.get(k)
+            out[k] = list(h) if acc is None else [a + b for a, b in zip(acc, h)]
+
+
+def _fold_dead():
+    """Add the snapshots of exited processes to totals.json and remove them."""
+    with open(os.path.join(METRICS_DIR, ".lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        totals_path = os.path.join(METRICS_DIR, TOTALS_FILE)
+        totals = _read_json(totals_path) or {}
+        folded = set(totals.get("folded", ()))
+        dead = []
+        for path in glob.glob(os.path.join(METRICS_DIR, "metrics-*.json")):
+            name = os.path.basename(path)
+            if name in folded:
+                continue  # added before a crash could remove it
+            snap = _read_json(path)
+            if snap is not None and not _alive(snap.get("pid", 0)):
+                dead.append((name, path, snap))
+        if not dead:
+            return
+        counters, histograms = totals.get("counters", {}), totals.get("histograms", {})
+        for name, _, snap in dead:
+            _add(counters, histograms, snap)
+        # remember what was folded until the files are gone, so a crash between
+        # the two steps cannot count a snapshot twice
+        present = {os.path.basename(p) for p in glob.glob(os.path.join(METRICS_DIR, "metrics-*.json"))}
+        _write_json(totals_path, {"counters": counters, "histograms": histograms,
+                                  "folded": sorted((folded & present) | {n for n, _, _ in dead})})
+        for _, path, _ in dead:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _prune_runs():
+    """Remove default-scoped directories whose process group has gone."""
+    if os.getenv("METRICS_DIR"):
+        return
+    try:
+        runs = os.listdir(_RUNS_DIR)
+    except OSError:
+        return
+    for run in runs:
+        if run.startswith("metrics-") and run.endswith(".json"):
+            try:
+                os.remove(os.path.join(_RUNS_DIR, run))  # left by the unscoped layout
+            except OSError:
+                pass
+        elif run.isdigit() and int(run) != os.getpgrp() and not _group_alive(int(run)):
+            shutil.rmtree(os.path.join(_RUNS_DIR, run), ignore_errors=True)
+
+
+def merged() -> dict:
+    try:
+        _fold_dead()
+        _prune_runs()
+    except OSError as e:
+        event_log.note(f"⚠️ [metrics] folding exited workers failed: {e}", error=True)
+    counters, histograms, gauges = {}, {}, {}
+    totals = _read_json(os.path.join(METRICS_DIR, TOTALS_FILE)) or {}
+    folded = set(totals.get("folded", ()))
+    _add(counters, histograms, totals)
+    fresh = time.time() - max(3 * METRICS_FLUSH_INTERVAL, 30)
+    for path in glob.glob(os.path.join(METRICS_DIR, "metrics-*.json")):
+        if os.path.basename(path) in folded:
+            continue
+        snap = _read_json(path)
+        if snap is None:
+            continue
+        _add(counters, histograms, snap)
+        # a live pid with an old snapshot is a reused pid: its counters count, its gauges don't
+        if _alive(snap.get("pid", 0)) and snap.get("written_at", 0) > fresh:
+            for name, series in snap.get("gauges", {}).items():
+                out = gauges.setdefault(name, {})
+                for k, v in series.items():
+                    out[k] = out.get(k, 0) + v
+    return {"counters": counters, "histograms": histograms, "gauges": gauges}
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(key: str, extra=()) -> str:
+    pairs = [tuple(p) for p in json.loads(key)] + list(extra)
+    if not pairs:
+        return ""
+    body = ",".join(f'{k}="{_escape(v)}"' for k, v in pairs)
+    return "{" + body + "}"
+
+
+def render() -> str:
+    """Prometheus text exposition of all processes' metrics."""
+    flush()
+    data = merged()
+    lines = []
+    for name in sorted(data["counters"]):
+        lines.append(f"# HELP {name} {HELP.get(name, name)}")
+        lines.append(f"# TYPE {name} counter")
+        for k, v in sorted(data["counters"][name].items()):
+            lines.append(f"{name}{_labels(k)} {v}")
+    for name in sorted(data["histograms"]):
+        lines.append(f"# HELP {name} {HELP.get(name, name)}")
+        lines.append(f"# TYPE {name} histogram")
+        for k, h in sorted(data["histograms"][name].items()):
+            cumulative = 0
+            for bound, count in zip(DEFAULT_BUCKETS, h):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(k, [('le', bound)])} {cumulative}")
+            cumulative += h[len(DEFAULT_BUCKETS)]
+            lines.append(f"{name}_bucket{_labels(k, [('le', '+Inf')])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(k)} {h[-1]}")
+            lines.append(f"{name}_count{_labels(k)} {cumulative}")
+    for name in sorted(data["gauges"]):
+        lines.append(f"# TYPE {name} gauge")
+        for k, v in sorted(data["gauges"][name].items()):
+            lines.append(f"{name}{_labels(k)} {v}")
+    return "\n".join(lines) + "\n"
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# DB statement labels
+# ─────────────────────────────────────────────────────────────────────────────
+
+_statement_labels = {}
+_PREPARED_RE = re.compile(r"^\s*(?:PREPARE|EXECUTE)\s+(\w+)", re.IGNORECASE)
+_WRITE_RE = re.compile(r"\b(INSERT\s+INTO|(?<!FOR )(?<!DO )UPDATE|DELETE\s+FROM)\s+(?!SET\b)([\w.]+)", re.IGNORECASE)
+_FROM_RE = re.compile(r"\bFROM\s+([\w.]+)", re.IGNORECASE)
+
+
+def statement_label(query) -> str:
+    """Short, bounded label for a SQL string: verb + table (or prepared statement name)."""
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    label = _statement_labels.get(query)
+    if label is not None:
+        return label
+    m = _PREPARED_RE.match(query)
+    if m:
+        # drop the per-connection generation suffix
+        label = "PREPARED " + re.sub(r"_\d+$", "", m.group(1))
+    elif (m := _WRITE_RE.search(query)):
+        label = f"{m.group(1).split()[0].upper()} {m.group(2)}"
+    elif (m := _FROM_RE.search(query)):
+        label = f"SELECT {m.group(1)}"
+    else:
+        words = query.split()
+        label = re.sub(r"\(.*", "", " ".join(words[:2])).upper() if words else "other"  # SELECT fn(...)
+    if len(_statement_labels) < 1000:
+        _statement_labels[query] = label
+    return label
@@ -0,0 +1,308 @@
+"""
+Schema management: tables and the indexes the webhook hot paths rely on.
+
+    python schema.py migrate     # create missing tables / indexes / notify triggers (idempotent)
+    python schema.py check       # exit 1 if a required index is missing or invalid
+    python schema.py report      # table sizes, scans and index usage
+
+Indexes are matched by definition, not by name: an existing primary key or
+unique constraint on the same columns satisfies a requirement (plus the
+partition key, on a partitioned table -- see maintenance.py). Missing indexes
+are built with CREATE INDEX CONCURRENTLY, so migrating a live database does
+not block the webhook's writes; a build that fails (e.g. duplicate nonces
+preventing a unique index) leaves an INVALID index behind, which the next
+migrate drops and rebuilds.
+
+At startup each worker checks the required indexes once, off the request path
+(SCHEMA_CHECK=warn, the default), or skips the check (SCHEMA_CHECK=off). It
+never builds them: that is `migrate`, the Procfile's release step, run once
+per deploy rather than by every worker.
+"""
+import os
+import re
+import sys
+import threading
+from collections import namedtuple
+
+import bonus_engine
+import coin_ledger
+import entitlements
+import event_log
+import event_order
+import inbox
+from db_pool import get_db_conn
+
+SCHEMA_CHECK = os.getenv("SCHEMA_CHECK", "warn").lower()
+
+TABLES_SQL = """
+    CREATE TABLE IF NOT EXISTS veil_users (
+        user_id            BIGINT NOT NULL,
+        guild_id           BIGINT NOT NULL,
+        coins              INTEGER DEFAULT 0,
+        last_refill        TIMESTAMPTZ,
+        topgg_last_vote_at TIMESTAMPTZ,
+        PRIMARY KEY (user_id, guild_id)
+    );
+    CREATE TABLE IF NOT EXISTS topgg_vote_sessions (
+        id                BIGSERIAL PRIMARY KEY,
+        user_id           BIGINT NOT NULL,
+        guild_id          BIGINT NOT NULL,
+        interaction_token TEXT,
+        application_id    BIGINT,
+        used              BOOLEAN NOT NULL DEFAULT FALSE,
+        created_at        TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    CREATE TABLE IF NOT EXISTS vote_events (
+        id       BIGSERIAL PRIMARY KEY,
+        provider TEXT,
+        user_id  BIGINT,
+        guild_id BIGINT,
+        voted_at TIMESTAMPTZ,
+        nonce    TEXT UNIQUE
+    );
+    CREATE TABLE IF NOT EXISTS coin_checkout_sessions (
+        stripe_session_id TEXT PRIMARY KEY,
+        interaction_token TEXT,
+        application_id    BIGINT,
+        user_id           BIGINT,
+        guild_id          BIGINT,
+        coins             INTEGER,
+        created_at        TIMESTAMPTZ DEFAULT NOW()
+    );
+    -- one row per credited coin pack (credits.py): a session is never credited twice
+    CREATE TABLE IF NOT EXISTS coin_purchase_credits (
+        stripe_session_id TEXT PRIMARY KEY,
+        user_id           BIGINT NOT NULL,
+        guild_id          BIGINT NOT NULL,
+        coins             INTEGER NOT NULL,
+        credited_at       TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    CREATE TABLE IF NOT EXISTS veil_subscriptions (
+        guild_id        BIGINT PRIMARY KEY,
+        tier            TEXT,
+        subscribed_at   TIMESTAMPTZ,
+        renews_at       TIMESTAMPTZ,
+        subscription_id TEXT,
+        payment_failed  BOOLEAN DEFAULT FALSE
+    );
+"""
+
+# tables (and the entitlement notify triggers) owned by other modules; created here
+# too so one migrate sets up everything
+MODULE_SCHEMAS = (inbox.SCHEMA_SQL, coin_ledger.SCHEMA_SQL, bonus_engine.SCHEMA_SQL, entitlements.SCHEMA_SQL,
+                  event_order.SCHEMA_SQL)
+# taken by those modules' own ensure_schema(); a worker starting mid-migrate waits for it
+SCHEMA_LOCKS = (entitlements.SCHEMA_LOCK, event_order.SCHEMA_LOCK)
+
+Index = namedtuple("Index", "name table columns unique where why")
+
+REQUIRED_INDEXES = (
+    Index("veil_users_user_guild_key", "veil_users", ("user_id", "guild_id"), True, None,
+          "ON CONFLICT (user_id, guild_id) in every credit"),
+    Index("veil_users_guild_user_idx", "veil_users", ("guild_id", "user_id"), False, None,
+          "keyset batches of guild-wide bonuses"),
+    Index("topgg_vote_sessions_unused_idx", "topgg_vote_sessions", ("user_id", "created_at DESC"), False, "used = FALSE",
+          "newest unused session per user on every vote"),
+    Index("vote_events_nonce_key", "vote_events", ("nonce",), True, None,
+          "one vote row per session nonce"),
+    Index("coin_checkout_sessions_session_key", "coin_checkout_sessions", ("stripe_session_id",), True, None,
+          "checkout session lookup on coin purchases"),
+    Index("veil_subscriptions_guild_key", "veil_subscriptions", ("guild_id",), True, None,
+          "ON CONFLICT (guild_id) when writing a subscription"),
+)
+
+MANAGED_TABLES = ("veil_users", "topgg_vote_sessions", "vote_events", "coin_checkout_sessions",
+                  "coin_purchase_credits", "veil_subscriptions", "webhook_inbox", "coin_ledger", "bonus_grants")
+
+
+def _norm_predicate(sql):
+    return re.sub(r"[\s()]", "", sql).lower() if sql else None
+
+
+def index_ddl(ix: Index, concurrently: bool = True) -> str:
+    return (f"CREATE {'UNIQUE ' if ix.unique else ''}INDEX {'CONCURRENTLY ' if concurrently else ''}"
+            f"IF NOT EXISTS {ix.name} ON {ix.table} ({', '.join(ix.columns)})"
+            + (f" WHERE {ix.where}" if ix.where else ""))
+
+
+def base_schema_sql() -> str:
+    """Tables plus the non-constraint indexes, as plain DDL (fresh or scratch databases)."""
+    return TABLES_SQL + "".join(f"    {index_ddl(ix, concurrently=False)};\n"
+                                for ix in REQUIRED_INDEXES if not ix.unique)
+
+
+def _existing_indexes(cur, table: str):
+    cur.execute("""
+        SELECT i.relname, ix.indisunique, ix.indisvalid, pg_get_expr(ix.indpred, ix.indrelid),
+               ARRAY(SELECT a.attname
+                       FROM unnest(ix.indkey) WITH ORDINALITY AS k(attnum, ord)
+                       JOIN pg_attribute a ON a.attrelid = ix.indrelid AND a.attnum = k.attnum
+                   ORDER BY k.ord)
+          FROM pg_index ix
+          JOIN pg_class i ON i.oid = ix.indexrelid
+         WHERE ix.indrelid = to_regclass(%s)
+    """, (table,))
+    return cur.fetchall()
+
+
+def _partition_key(cur, table: str) -> tuple:
+    """Partition key columns of `table`, () if it is not partitioned."""
+    cur.execute("""
+        SELECT a.attname
+          FROM pg_partitioned_table p
+          JOIN pg_attribute a ON a.attrelid = p.partrelid AND a.attnum = ANY (p.partattrs::int2[])
+         WHERE p.partrelid = to_regclass(%s)
+    """, (table,))
+    return tuple(r[0] for r in cur.fetchall())
+
+
+def _satisfies(existing, ix: Index, partition_key: tuple = ()) -> bool:
+    name, unique, valid, predicate, columns = existing
+    wanted = tuple(c.split()[0] for c in ix.columns)
+    if ix.unique:
+        # a partitioned table can only be unique together with its partition key
+        wanted += tuple(c for c in partition_key if c not in wanted)
+    # column order matters, direction does not (btree scans both ways)
+    if not valid or tuple(columns) != wanted:
+        return False
+    if ix.unique:
+        return unique and predicate is None  # ON CONFLICT needs a full unique index
+    return predicate is None or _norm_predicate(predicate) == _norm_predicate(ix.where)
+
+
+def check() -> dict:
+    """{index name: "ok" | "missing" | "invalid" | "conflict" | "no table"} for every required index."""
+    result = {}
+    with get_db_conn() as conn, conn.cursor() as cur:
+        for ix in REQUIRED_INDEXES:
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL", (ix.table,))
+            if not cur.fetchone()[0]:
+                result[ix.name] = "no table"
+                continue
+            existing = _existing_indexes(cur, ix.table)
+            if any(_satisfies(e, ix, _partition_key(cur, ix.table)) for e in existing):
+                result[ix.name] = "ok"
+            elif any(e[0] == ix.name and not e[2] for e in existing):
+                result[ix.name] = "invalid"
+            elif any(e[0] == ix.name for e in existing):
+                result[ix.name] = "conflict"  # our name, someone else's definition
+            else:
+                result[ix.name] = "missing"
+    return result
+
+
+def migrate() -> dict:
+    """Create missing tables, indexes and notify triggers. Returns check() afterwards."""
+    with get_db_conn() as conn, conn.cursor() as cur:
+        for key in SCHEMA_LOCKS:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (key,))
+        cur.execute(TABLES_SQL)
+        for sql in MODULE_SCHEMAS:
+            cur.execute(sql)
+
+    for name, state in check().items():
+        ix = next(i for i in REQUIRED_INDEXES if i.name == name)
+        if state == "ok":
+            continue
+        if state in ("conflict", "no table"):
+            event_log.note(f"⚠️ [schema] not building {ix.name}: {state}; needs a manual look", error=True)
+            continue
+        with get_db_conn() as conn, conn.cursor() as cur:
+            partitioned = bool(_partition_key(cur, ix.table))
+        if partitioned:  # CREATE INDEX CONCURRENTLY is not supported on partitioned tables
+            event_log.note(f"⚠️ [schema] not building {ix.name}: {ix.table} is partitioned; build it per partition", error=True)
+            continue
+        with get_db_conn() as conn:
+            conn.autocommit = True  # CONCURRENTLY cannot run inside a transaction
+            try:
+                with conn.cursor() as cur:
+                    if state == "invalid":
+                        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {ix.name}")
+                    event_log.note(f"[schema] building {ix.name} on {ix.table} ({ix.why})")
+                    cur.execute(index_ddl(ix))
+            except Exception as e:
+                event_log.note(f"❌ [schema] could not build {ix.name}: {e}", error=True)
+            finally:
+                conn.autocommit = False
+    return check()
+
+
+def report() -> dict:
+    """Size and scan counts of the managed tables, and usage of their indexes."""
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT relname, n_live_tup, pg_total_relation_size(relid), seq_scan, COALESCE(idx_scan, 0)
+              FROM pg_stat_user_tables
+             WHERE relid = ANY (ARRAY(SELECT to_regclass(t) FROM unnest(%s::text[]) t))
+          ORDER BY pg_total_relation_size(relid) DESC
+        """, (list(MANAGED_TABLES),))
+        tables = [{"table": t, "rows": n, "bytes": size, "seq_scans": seq, "index_scans": idx}
+                  for t, n, size, seq, idx in cur.fetchall()]
+        cur.execute("""
+            SELECT relname, indexrelname, idx_scan, pg_relation_size(indexrelid)
+              FROM pg_stat_user_indexes
+             WHERE relid = ANY (ARRAY(SELECT to_regclass(t) FROM unnest(%s::text[]) t))
+          ORDER BY relname, indexrelname
+        """, (list(MANAGED_TABLES),))
+        indexes = [{"table": t, "index": i, "scans": scans, "bytes": size} for t, i, scans, size in cur.fetchall()]
+    return {"tables": tables, "indexes": indexes}
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Startup check
+# ─────────────────────────────────────────────────────────────────────────────
+
+_checked_pid = None
+_check_lock = threading.Lock()
+
+
+def startup_check() -> bool:
+    """
+    Once per process: warn about missing required indexes. Only checks; the
+    builds are `python schema.py migrate`'s. False if the check could not run.
+    """
+    global _checked_pid
+    if SCHEMA_CHECK == "off" or _checked_pid == os.getpid():
+        return True
+    with _check_lock:
+        if _checked_pid == os.getpid():
+            return True
+        try:
+            states = check()
+        except Exception as e:
+            event_log.note(f"⚠️ [schema] startup check failed: {e}", error=True)
+            return False
+        _checked_pid = os.getpid()
+        bad = {name: state for name, state in states.items() if state != "ok"}
+        if bad:
+            event_log.note(f"⚠️ [schema] required indexes not in place: {bad} -- run `python schema.py migrate`", error=True)
+        return True
+
+
+def _fmt_bytes(n: int) -> str:
+    for unit in ("B", "kB", "MB", "GB"):
+        if n < 1024:
+            return f"{n:.0f} {unit}"
+        n /= 1024
+    return f"{n:.1f} TB"
+
+
+if __name__ == "__main__":
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "check"
+    if cmd in ("migrate", "check"):
+        states = migrate() if cmd == "migrate" else check()
+        for ix in REQUIRED_INDEXES:
+            print(f"{states[ix.name]:>9}  {ix.name:<36} {ix.why}")
+        sys.exit(0 if all(s == "ok" for s in states.values()) else 1)
+    elif cmd == "report":
+        r = report()
+        print(f"{'table':<24}{'rows':>12}{'size':>11}{'seq scans':>12}{'idx scans':>12}")
+        for t in r["tables"]:
+            print(f"{t['table']:<24}{t['rows']:>12}{_fmt_bytes(t['bytes']):>11}{t['seq_scans']:>12}{t['index_scans']:>12}")
+        print()
+        print(f"{'index':<44}{'scans':>12}{'size':>11}")
+        for i in r["indexes"]:
+            flag = "  (unused)" if not i["scans"] else ""
+            print(f"{i['index']:<44}{i['scans']:>12}{_fmt_bytes(i['bytes']):>11}{flag}")
+    else:
+        sys.exit(f"usage: {sys.argv[0]} migrate|check|report")
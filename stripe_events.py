@@ -0,0 +1,190 @@
+"""
+What a Stripe event does to Veil's state -- the one copy of the rules that the
+sync (stripe_webhook) and async (stripe_webhook_async) webhooks and backfill
+all carry out.
+
+decide(event, turn) reads the event, and the subscription snapshot it refers
+to, and returns one action (or None when the event changes nothing):
+
+  CoinPack       credit a coin pack to the buyer
+  SetTier        write the guild's subscription row (checkout / renewal),
+                 then grant the tier bonus and announce it; `write` is False
+                 when a newer event already decided the row (see event_order)
+  PaymentFailed  revert the guild to free and flag it for the bot
+  Cancel         revert the guild to free, unless the deleted subscription is
+                 one an upgrade replaced
+  Invalid        a coin pack without buyer, guild or amount
+
+Each app runs the statements below with its own driver (Prepared.execute for
+psycopg2, typed_sql for asyncpg), in the transaction that also moves the
+guild's watermark. next_row() is the same effect on a row held in memory,
+which backfill uses to work out the end state without writing each step.
+"""
+from collections import namedtuple
+from datetime import datetime, timezone
+
+import stripe
+
+import event_log
+import metrics
+from db_pool import Prepared
+from event_order import UNORDERED
+from subscription_cache import invoice_subscription_id, subscription_cache
+from webhook_common import checkout_details, tier_map, to_int_or_none
+
+CoinPack = namedtuple("CoinPack", "user_id guild_id coins session_id")
+SetTier = namedtuple("SetTier", "guild_id tier renews_at subscription_id grant_key write upgrade")
+PaymentFailed = namedtuple("PaymentFailed", "guild_id subscription_id")
+Cancel = namedtuple("Cancel", "guild_id subscription_id newer")
+Invalid = namedtuple("Invalid", "reason")
+
+HANDLED_TYPES = (
+    "checkout.session.completed",
+    "invoice.payment_succeeded",
+    "invoice.payment_failed",
+    "customer.subscription.deleted",
+)
+
+
+def renews_at(period_end):
+    return datetime.fromtimestamp(period_end, tz=timezone.utc) if period_end else None
+
+
+def decide(event, turn=UNORDERED):
+    """
+    The action for one Stripe event, binding its correlation ids to the current
+    event_log record. `turn` is where the event stands in its guild's order.
+    Raises when an invoice's subscription cannot be looked up; a checkout goes
+    ahead without a renewal date instead.
+    """
+    obj = event["data"]["object"]
+    event_type = event["type"]
+
+    if event_type == "checkout.session.completed":
+        d = checkout_details(obj)
+        event_log.bind(session_id=d["session_id"], guild_id=d["guild_id"], user_id=d["user_id"], mode=d["mode"],
+                       price_id=d["price_id"], tier=d["tier"], subscription_id=d["subscription_id"])
+        if d["mode"] == "payment" and not d["tier"]:
+            if not (d["user_id"] and d["guild_id"] and d["coins"] and d["coins"] > 0):
+                return Invalid(f"Missing data for coin credit: coins={d['coins']}")
+            return CoinPack(d["user_id"], d["guild_id"], d["coins"], d["session_id"])
+        if not (d["tier"] and d["guild_id"]):
+            return None
+        period_end = None
+        if d["subscription_id"]:
+            try:
+                period_end = subscription_cache.fetch(d["subscription_id"])["current_period_end"]
+            except Exception as e:
+                metrics.error("subscription_fetch")
+                event_log.note(f"⚠️ Could not fetch subscription: {e}", error=True)
+        return SetTier(d["guild_id"], d["tier"], renews_at(period_end), d["subscription_id"],
+                       f"checkout:{d['session_id']}", not turn.stale, True)
+
+    if event_type in ("invoice.payment_succeeded", "invoice.payment_failed"):
+        subscription_id = invoice_subscription_id(obj)
+        if not subscription_id:
+            return None
+        sub = subscription_cache.fetch(subscription_id)
+        guild_id = to_int_or_none(sub["guild_id"])
+        event_log.bind(guild_id=guild_id, subscription_id=subscription_id, invoice_id=obj.get("id"))
+        if event_type == "invoice.payment_succeeded":
+            tier = tier_map.get(sub["price_id"])
+            if not (tier and guild_id):
+                return None
+            return SetTier(guild_id, tier, renews_at(sub["current_period_end"]), subscription_id,
+                           f"invoice:{obj.get('id') or event['id']}", not turn.stale, False)
+        if not guild_id or turn.stale:
+            return None
+        return PaymentFailed(guild_id, subscription_id)
+
+    if event_type == "customer.subscription.deleted":
+        guild_id = to_int_or_none((obj.get("metadata") or {}).get("guild_id"))
+        event_log.bind(guild_id=guild_id, subscription_id=obj.get("id"))
+        if not guild_id or turn.stale:
+            return None
+        # An upgrade cancels the subscription it replaces, and that deletion must not
+        # downgrade the guild -- unless the subscription is newer than everything
+        # applied to the guild so far (its checkout has not been processed yet).
+        newer = bool(turn.previous) and (obj.get("created") or 0) > turn.previous
+        return Cancel(guild_id, obj.get("id"), newer)
+
+    return None
+
+
+def replaced(current_subscription_id, action: SetTier):
+    """The subscription an upgrade replaces and should cancel, if any."""
+    if action.upgrade and current_subscription_id and current_subscription_id != action.subscription_id:
+        return current_subscription_id
+    return None
+
+
+def cancel_replaced(subscription_id: str):
+    """
+    Cancel the subscription an upgrade replaced. Called inside the upgrade's
+    transaction, before the new row is written: if the process dies after the
+    cancel, the event's retry still finds the old id and cancels it again.
+    """
+    try:
+        with metrics.timed("veil_stripe_api_seconds", call="Subscription.delete"):
+            stripe.Subscription.delete(subscription_id)
+        event_log.note(f"❌ Old subscription {subscription_id} canceled for upgrade")
+    except Exception as e:
+        metrics.error("subscription_cancel")
+        event_log.note(f"⚠️ Could not cancel old subscription: {e}", error=True)
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Statements
+# ─────────────────────────────────────────────────────────────────────────────
+
+# locked, so a concurrent upgrade of the same guild waits for this one's cancel
+CURRENT_SUBSCRIPTION = Prepared("veil_current_subscription", ("bigint",), """
+    SELECT subscription_id FROM veil_subscriptions WHERE guild_id = $1 FOR UPDATE
+""")
+
+UPSERT_SUBSCRIPTION = Prepared("veil_upsert_subscription", ("bigint", "text", "timestamptz", "text"), """
+    INSERT INTO veil_subscriptions (guild_id, tier, subscribed_at, renews_at, subscription_id, payment_failed)
+    VALUES ($1, $2, NOW(), $3, $4, FALSE)
+    ON CONFLICT (guild_id) DO UPDATE
+    SET tier = EXCLUDED.tier,
+        subscribed_at = NOW(),
+        renews_at = EXCLUDED.renews_at,
+        subscription_id = EXCLUDED.subscription_id,
+        payment_failed = FALSE
+""")
+
+PAYMENT_FAILED = Prepared("veil_subscription_payment_failed", ("bigint",), """
+    UPDATE veil_subscriptions
+       SET tier = 'free',
+           subscribed_at = NOW(),
+           renews_at = NULL,
+           payment_failed = TRUE
+     WHERE guild_id = $1
+""")
+
+CANCEL_SUBSCRIPTION = Prepared("veil_cancel_subscription", ("bigint", "text", "boolean"), """
+    UPDATE veil_subscriptions
+       SET tier = 'free',
+           subscribed_at = NOW(),
+           renews_at = NULL,
+           subscription_id = NULL,
+           payment_failed = FALSE
+     WHERE guild_id = $1
+       AND (subscription_id = $2 OR subscription_id IS NULL OR $3)
+""")
+
+
+def next_row(row, action):
+    """
+    The (tier, renews_at, subscription_id, payment_failed) row the statements
+    above leave for `action`'s guild, given the row it had (None: no row).
+    """
+    if isinstance(action, SetTier):
+        return (action.tier, action.renews_at, action.subscription_id, False) if action.write else row
+    if row is None:  # the failure / cancellation statements only UPDATE
+        return None
+    if isinstance(action, PaymentFailed):
+        return ("free", None, row[2], True)
+    if isinstance(action, Cancel):
+        if row[2] == action.subscription_id or row[2] is None or action.newer:
+            return ("free", None, None, False)
+    return row
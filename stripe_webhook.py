@@ -1,127 +1,115 @@
 import os
+import threading
+import time
 import stripe
-import psycopg2
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from dotenv import load_dotenv
-from datetime import datetime, timezone
-import requests
 
 load_dotenv()
 
+# imported after load_dotenv so their env settings are visible
+import event_log
+import metrics
+from db_pool import get_db_conn, pool_stats, thread_round_trips
+from delivery import deliver, delivery_stats
+from discord_http import discord_stats
+from support_relay import relay_line, relay_stats
+from inbox import INBOX_ENABLED, inbox_stats, start_workers, store_event, topgg_event_id
+from credits import credit_coin_purchase, credit_topgg_vote, credit_topgg_votes
+from bonus_engine import grant_bonus
+from coin_ledger import ensure_compactor, ledger_stats
+from entitlements import ensure_listener, entitlement_stats, guild_tier, user_balance
+from event_order import UNORDERED, ShardBusy, advance, ensure_ready, event_order_stats, in_order, stripe_shard
+from schema import startup_check
+from stripe_events import (
+    CANCEL_SUBSCRIPTION, CURRENT_SUBSCRIPTION, PAYMENT_FAILED, UPSERT_SUBSCRIPTION, CoinPack, Cancel, Invalid,
+    PaymentFailed, SetTier, cancel_replaced, decide, replaced,
+)
+from subscription_cache import observe_event, subscription_cache
+from vote_gate import VoteBatcher, vote_gate, vote_gate_stats
+from webhook_common import (
+    TOPGG_VOTE_COINS, bonus_amounts, coin_topup_line, coin_topup_payload, coin_unpatched_content,
+    interaction_url, to_int_or_none, topgg_vote_line, topgg_vote_payload, upgrade_line,
+)
+
 SUPPORT_WEBHOOK = os.getenv("SUPPORT_WEBHOOK")  # Your support server's webhook URL
 DISCORD_API_BASE = os.getenv("DISCORD_API_BASE", "https://discord.com/api/v10")
 TOPGG_WEBHOOK_AUTH = os.getenv("TOPGG_WEBHOOK_AUTH")
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # optional bearer token for /metrics
+ENTITLEMENT_API_TOKEN = os.getenv("ENTITLEMENT_API_TOKEN")  # optional bearer token for the read API
+STARTUP_RETRY_MAX = float(os.getenv("STARTUP_RETRY_MAX", "60"))  # seconds between startup retries, at most
 
 
 app = Flask(__name__)
 
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+stripe.api_base = os.getenv("STRIPE_API_BASE", stripe.api_base)  # e.g. a local stand-in for load tests
 endpoint_secret = os.getenv("STRIPE_WEBHOOK_SECRET")
 
 # ─────────────────────────────────────────────────────────────────────────────
 # Helpers
 # ─────────────────────────────────────────────────────────────────────────────
 
-def get_db_conn():
-    return psycopg2.connect(os.getenv("DATABASE_URL"), sslmode="require")
-
-def fmt(n: int) -> str:
-    return f"{n:,}"
-
-def to_int_or_none(v):
-    try:
-        return int(v) if v is not None else None
-    except Exception:
-        return None
+class ProcessingError(Exception):
+    """An event could not be applied and should be retried (500 to the sender / inbox retry)."""
 
 def notify_support_server(guild_id: int, tier: str):
-    if not SUPPORT_WEBHOOK:
-        return
-    try:
-        requests.post(SUPPORT_WEBHOOK, json={
-            "content": f"🎉 Guild {guild_id} upgraded to **{tier.title()}** tier!"
-        }, timeout=5)
-        print(f"📢 Support server notified about guild {guild_id} upgrade.")
-    except Exception as e:
-        print("❌ Failed to notify support server:", e)
+    relay_line(upgrade_line(guild_id, tier))
+    event_log.note(f"📢 Support server notification queued for guild {guild_id} upgrade.")
 
 def notify_topgg_vote(user_id: int, guild_id: int, coins: int = 15):
-    if not SUPPORT_WEBHOOK:
-        return
-    try:
-        requests.post(
-            SUPPORT_WEBHOOK,
-            json={"content": f"[TOPGG_VOTE] user_id={user_id} guild_id={guild_id} coins={coins}"},
-            timeout=5
-        )
-    except Exception as e:
-        print("⚠️ Failed to post TOPGG_VOTE:", e)
+    relay_line(topgg_vote_line(user_id, guild_id, coins))
 
 # ── relay a COIN_TOPUP line to your support channel so the bot's on_message sees it
 def notify_coin_topup(session_id: str, user_id: int, guild_id: int, coins: int):
-    if not SUPPORT_WEBHOOK:
-        return
+    # IMPORTANT: keep this format EXACT so your COIN_RE matches
+    relay_line(coin_topup_line(session_id, user_id, guild_id, coins))
+    event_log.note(f"📨 Queued COIN_TOPUP for session {session_id} (+{coins} coins)")
+
+def run_event(source: str, event_type, handler, arg):
+    """
+    Run one event handler, timing it and counting its DB round trips per source / event type;
+    what it notes goes out as one event_log record.
+    """
+    event_type = event_type or "unknown"
+    before = thread_round_trips()
     try:
-        requests.post(
-            SUPPORT_WEBHOOK,
-            json={
-                # IMPORTANT: keep this format EXACT so your COIN_RE matches
-                "content": f"[COIN_TOPUP] session_id={session_id} user_id={user_id} guild_id={guild_id} coins={coins}",
-                "allowed_mentions": {"parse": []},  # no accidental pings
-            },
-            timeout=5
-        )
-        print(f"📨 Posted COIN_TOPUP for session {session_id} (+{coins} coins)")
-    except Exception as e:
-        print("⚠️ Failed to post COIN_TOPUP:", e)
+        with metrics.timed("veil_event_seconds", source=source, event_type=event_type), \
+                event_log.event(source, event_type, **event_log.correlation_ids(source, arg)):
+            handler(arg)
+    finally:
+        metrics.inc("veil_event_db_round_trips_total", thread_round_trips() - before,
+                    source=source, event_type=event_type)
 
 def patch_interaction_original(application_id: int | str, interaction_token: str, payload: dict):
     """
     PATCH the original interaction message (no bot token required).
+    Queued for background delivery; failures are retried by the delivery workers.
     """
-    url = f"{DISCORD_API_BASE}/webhooks/{int(application_id)}/{interaction_token}/messages/@original"
-    r = requests.patch(url, json=payload, timeout=8)
-    print(f"[discord] PATCH @original -> {r.status_code} {r.text[:200]}")
-    r.raise_for_status()
-
-# Tier mapping
-tier_map = {
-    "price_1RuT1sADYgCtNnMoWMzdQ7YI": "basic",
-    "price_1RuT34ADYgCtNnModSx70nr1": "premium",
-    "price_1RuT3ZADYgCtNnMopSZon3vt": "elite",
-}
+    url = interaction_url(DISCORD_API_BASE, application_id, interaction_token)
+    deliver("PATCH", url, payload, timeout=8, label="interaction_patch")
 
-# Coin packs (one-time purchases)
-coin_price_map = {
-    "price_1RuT5IADYgCtNnMorF0zsMRK": 100,   # $1
-    "price_1RuT5dADYgCtNnMoNY5O0cuc": 250,   # $2
-    "price_1RuT5yADYgCtNnMoWTUR4XMC": 500,   # $3
-    "price_1RuT6KADYgCtNnMoKwM3iw9H": 1000,  # $5
-}
-
-def apply_bonus_for_tier(guild_id, tier):
+def apply_bonus_for_tier(guild_id, tier, grant_key: str):
+    """
+    Grant the tier's bonus coins to every member of the guild. `grant_key` names
+    what earned the bonus (checkout session / invoice), so a redelivered event
+    does not pay it twice. Applied in small batches in the background.
+    """
     # ⛔ Elite gets no coin bonus
     if tier == "elite":
-        print(f"⛔ Skipping bonus coins for Elite guild {guild_id}")
+        event_log.note(f"⛔ Skipping bonus coins for Elite guild {guild_id}")
         return
 
-    bonus_amounts = {"basic": 250, "premium": 1000}
     bonus = bonus_amounts.get(tier)
     if not bonus:
         return
 
-    now = datetime.now(timezone.utc)
     try:
-        with get_db_conn() as conn, conn.cursor() as cur:
-            cur.execute("""
-                UPDATE veil_users
-                   SET coins = COALESCE(coins,0) + %s,
-                       last_refill = %s
-                 WHERE guild_id = %s
-            """, (bonus, now, guild_id))
-        print(f"💰 Bonus coins applied: +{bonus} to all users in guild {guild_id}")
+        if grant_bonus(grant_key, guild_id, bonus):
+            event_log.note(f"💰 Bonus coins granted: +{bonus} to all users in guild {guild_id} ({grant_key})")
     except Exception as e:
-        print("❌ Failed to apply bonus coins:", e)
+        metrics.error("bonus")
+        event_log.note(f"❌ Failed to apply bonus coins: {e}", error=True)
 
 # ─────────────────────────────────────────────────────────────────────────────
 # Webhook
@@ -140,354 +128,370 @@ def topgg_webhook():
     except Exception:
         return "Bad JSON", 400
 
+    # 3) Retries and users known to have no pending session stop here
+    user_id = to_int_or_none(data.get("user"))
+    absorbed = vote_gate.admit(user_id) if user_id else None
+    if absorbed:
+        return jsonify(ok=True, absorbed=absorbed)
+
+    if INBOX_ENABLED:
+        try:
+            store_event("topgg", topgg_event_id(data), data.get("type"), data)
+        except Exception as e:
+            vote_gate.release(user_id)
+            metrics.error("inbox_store")
+            event_log.note(f"❌ topgg_webhook inbox error: {e}", error=True, source="topgg", user_id=user_id)
+            return "Server error", 500
+        return jsonify(ok=True)
+
+    try:
+        run_event("topgg", data.get("type"), process_topgg_vote, data)
+    except Exception:
+        vote_gate.release(user_id)
+        metrics.error("topgg")  # run_event's record has the error
+        return "Server error", 500
+    return jsonify(ok=True)
+
+def _credit_votes(user_ids, coins: int) -> dict:
+    with get_db_conn() as conn, conn.cursor() as cur:
+        return credit_topgg_votes(cur, user_ids, coins)
+
+def _credit_vote(user_id: int, coins: int):
+    with get_db_conn() as conn, conn.cursor() as cur:
+        return credit_topgg_vote(cur, user_id, coins)
+
+_vote_batcher = VoteBatcher(_credit_votes, _credit_vote)
+
+def process_topgg_vote(data: dict):
     # known fields: user, bot, type, isWeekend
     user_id = to_int_or_none(data.get("user"))
     if not user_id:
         # Ignore malformed/test payloads quietly
-        return jsonify(ok=True)
+        return
 
-    coins_to_add = 15
+    coins_to_add = TOPGG_VOTE_COINS
 
-    try:
-        # 3) Find the most recent *unused* vote session created by /vote
-        with get_db_conn() as conn, conn.cursor() as cur:
-            cur.execute("""
-                SELECT id, guild_id, interaction_token, application_id
-                  FROM topgg_vote_sessions
-                 WHERE user_id = %s AND used = FALSE
-              ORDER BY created_at DESC
-                 LIMIT 1
-            """, (user_id,))
-            row = cur.fetchone()
-
-            if not row:
-                print(f"[topgg] No pending session for user {user_id}; credit skipped.")
-                notify_topgg_vote(user_id, guild_id=0, coins=0)
-                return jsonify(ok=True)
-
-            session_id, guild_id, interaction_token, application_id = row
-
-            # 4) Ensure user row exists, credit coins, record vote timestamp, fetch new balance
-            cur.execute("""
-                INSERT INTO veil_users (user_id, guild_id, coins)
-                VALUES (%s, %s, 0)
-                ON CONFLICT (user_id, guild_id) DO NOTHING
-            """, (user_id, guild_id))
-
-            cur.execute("""
-                UPDATE veil_users
-                   SET coins = COALESCE(coins, 0) + %s,
-                       topgg_last_vote_at = NOW()
-                 WHERE user_id = %s AND guild_id = %s
-             RETURNING coins
-            """, (coins_to_add, user_id, guild_id))
-            new_balance = (cur.fetchone() or [0])[0]
-
-            cur.execute("""
-                INSERT INTO vote_events (provider, user_id, guild_id, voted_at, nonce)
-                VALUES (%s, %s, %s, NOW(), %s)
-                ON CONFLICT (nonce) DO NOTHING
-            """, ("topgg", user_id, guild_id, str(session_id)))
-
-            # 5) Mark the session used (idempotent)
-            cur.execute("""
-                UPDATE topgg_vote_sessions
-                   SET used = TRUE
-                 WHERE id = %s AND used = FALSE
-            """, (session_id,))
-
-        # 6) Patch the original /vote message with the *real* new balance
-        coins_str = fmt(coins_to_add)
-        bal_str   = fmt(new_balance or 0)
-        payload = {
-            "embeds": [{
-                "title": "⭐ Thanks for voting on top.gg!",
-                "description": (
-                    f"**+{coins_str} Veil Coins** have been added to your balance.\n\n"
-                    f"New balance: **{bal_str}**"
-                ),
-                "color": 0xeeac00,
-                "footer": {"text": "You can vote again in 12 hours."}
-            }],
-            "components": []
-        }
+    # 4) Consume the most recent *unused* vote session created by /vote, credit coins,
+    #    record the vote and fetch the new balance -- one statement, one round trip,
+    #    shared with the other votes of a burst
+    generation = vote_gate.generation()
+    row = _vote_batcher.credit(user_id, coins_to_add)
 
-        try:
-            patch_interaction_original(application_id, interaction_token, payload)
-        except Exception as e:
-            print(f"[topgg] PATCH failed: {e}")
+    if not row:
+        vote_gate.no_session(user_id, generation)
+        event_log.note(f"[topgg] No pending session for user {user_id}; credit skipped.")
+        notify_topgg_vote(user_id, guild_id=0, coins=0)
+        return
 
-        # 7) Log to support channel
-        notify_topgg_vote(user_id, guild_id, coins_to_add)
+    session_id, guild_id, interaction_token, application_id, new_balance = row
+    event_log.bind(guild_id=guild_id, vote_session_id=session_id)
 
-        return jsonify(ok=True)
+    # 5) Patch the original /vote message with the *real* new balance
+    payload = topgg_vote_payload(coins_to_add, new_balance)
 
+    try:
+        patch_interaction_original(application_id, interaction_token, payload)
     except Exception as e:
-        print("❌ topgg_webhook error:", e)
-        return "Server error", 500
+        metrics.error("topgg_patch")
+        event_log.note(f"[topgg] PATCH failed: {e}", error=True)
+
+    # 6) Log to support channel
+    notify_topgg_vote(user_id, guild_id, coins_to_add)
 
 @app.route("/stripe-webhook", methods=["POST"])
 def webhook():
     payload = request.data
     sig_header = request.headers.get("stripe-signature")
 
+    start = time.perf_counter()
     try:
         event = stripe.Webhook.construct_event(payload, sig_header, endpoint_secret)
     except ValueError:
+        metrics.error("stripe_payload")
         return "Invalid payload", 400
     except stripe.error.SignatureVerificationError:
+        metrics.error("stripe_signature")
         return "Invalid signature", 400
+    finally:
+        metrics.observe("veil_stripe_api_seconds", time.perf_counter() - start, call="Webhook.construct_event")
 
-    # ── checkout.session.completed ────────────────────────────────────────────
-    if event["type"] == "checkout.session.completed":
-        session = event["data"]["object"]
-
-        mode = session.get("mode")  # "payment" (coins) or "subscription" (tiers)
-        discord_user_id = to_int_or_none(session.get("client_reference_id"))
-        md = session.get("metadata", {}) or {}
-        guild_id = to_int_or_none(md.get("guild_id"))
-
-        # Prefer metadata price_id; fall back to older structures if needed
-        price_id = md.get("price_id")
-        if not price_id:
-            # Legacy fallback (older Checkout flows)
-            line_items = session.get("display_items", [])
-            if line_items and isinstance(line_items, list):
-                price_id = line_items[0].get("price", {}).get("id")
-
-        subscription_tier = tier_map.get(price_id)
-        subscription_id = session.get("subscription")
-        stripe_session_id = session.get("id")  # ← used to look up interaction
-
-        print("🧾 Stripe Session Info:")
-        print("  mode:", mode)
-        print("  client_reference_id (user_id):", discord_user_id)
-        print("  guild_id:", guild_id)
-        print("  price_id:", price_id)
-        print("  subscription_tier:", subscription_tier)
-        print("  subscription_id:", subscription_id)
-        print("  stripe_session_id:", stripe_session_id)
-
-        # ---------- ONE-TIME COIN PURCHASES ----------
-        if mode == "payment" and not subscription_tier:
-            # Coins to add: metadata.coins preferred, else price map
-            coins_from_meta = md.get("coins")
-            coins_to_add = to_int_or_none(coins_from_meta) if coins_from_meta else coin_price_map.get(price_id, 0)
-
-            if not (discord_user_id and guild_id and coins_to_add and coins_to_add > 0):
-                print("⚠️ Missing data for coin credit:", discord_user_id, guild_id, coins_to_add, price_id)
-                return jsonify(success=True)
-
-            try:
-                # 1) Credit coins and get fresh balance in a single roundtrip
-                with get_db_conn() as conn, conn.cursor() as cur:
-                    # Ensure row exists
-                    cur.execute("""
-                        INSERT INTO veil_users (user_id, guild_id, coins)
-                        VALUES (%s, %s, 0)
-                        ON CONFLICT (user_id, guild_id) DO NOTHING
-                    """, (discord_user_id, guild_id))
-
-                    # Credit and return new balance
-                    cur.execute("""
-                        UPDATE veil_users
-                           SET coins = COALESCE(coins,0) + %s
-                         WHERE user_id = %s AND guild_id = %s
-                     RETURNING coins
-                    """, (coins_to_add, discord_user_id, guild_id))
-                    row = cur.fetchone()
-                    new_balance = row[0] if row else None
-
-                print(f"💰 Credited +{coins_to_add} to user {discord_user_id} in guild {guild_id}; new balance={new_balance}")
-
-                # 2) Look up the interaction to PATCH @original (no bot token needed)
-                with get_db_conn() as conn, conn.cursor() as cur:
-                    cur.execute("""
-                        SELECT interaction_token, application_id, user_id, guild_id, coins
-                          FROM coin_checkout_sessions
-                         WHERE stripe_session_id = %s
-                    """, (stripe_session_id,))
-                    sess_row = cur.fetchone()
-
-                if not sess_row:
-                    print(f"[coin] ⚠️ No coin_checkout_sessions row for {stripe_session_id}; cannot edit interaction.")
-                    # Optional: still log to support server
-                    if SUPPORT_WEBHOOK:
-                        requests.post(SUPPORT_WEBHOOK, json={
-                            "content": f"🪙 Credited **+{coins_to_add}** to <@{discord_user_id}> in guild `{guild_id}`, "
-                                       f"but no interaction found to patch (session `{stripe_session_id}`)."
-                        }, timeout=5)
-                    return jsonify(success=True)
-
-                interaction_token, application_id, u_saved, g_saved, coins_saved = sess_row
-
-                # 3) Sanity checks
-                if u_saved != discord_user_id or g_saved != guild_id:
-                    print(f"[coin] id mismatch for {stripe_session_id}; saved=({u_saved},{g_saved}) got=({discord_user_id},{guild_id})")
-                    return jsonify(success=True)
-
-                # 4) Build the same embed you had in your bot
-                veilcoinemoji = "🪙"  # server-side fallback; custom emoji not available here
-                coins_str = fmt(coins_saved or coins_to_add)
-                bal_str   = fmt(new_balance or 0)
-
-                payload = {
-                    "embeds": [{
-                        "title": f"{veilcoinemoji} +{coins_str} Veil Coins Added",
-                        "description": f"Thanks for your support! Your new balance is **{bal_str}**.",
-                        "color": 0xeeac00,
-                        "fields": [
-                            {"name": "Amount",  "value": f"{veilcoinemoji} `{coins_str}`", "inline": True},
-                            {"name": "Balance", "value": f"`{bal_str}`",                   "inline": True},
-                        ],
-                        "footer": {"text": "Tip: use /user any time to see your balance."}
-                    }],
-                    "components": []
-                }
-
-                # 5) PATCH the original interaction message
-                try:
-                    patch_interaction_original(application_id, interaction_token, payload)
-                except Exception as e:
-                    print(f"[coin] ❌ PATCH failed: {e}")
-
-                notify_coin_topup(stripe_session_id, discord_user_id, guild_id, coins_to_add)
-
-            except Exception as e:
-                print("❌ DB error while crediting coins:", e)
-
-            return jsonify(success=True)
-
-        # ---------- SUBSCRIPTIONS (create/upgrade) ----------
-        # (unchanged from your code, DB updates + optional notifications)
+    if INBOX_ENABLED:
+        # persist-then-ack: a retry of an already stored event costs one indexed lookup
         try:
-            renews_at = None
-            if subscription_id:
-                sub = stripe.Subscription.retrieve(subscription_id)
-                items = sub.get("items", {}).get("data", [])
-                if items and items[0].get("current_period_end"):
-                    period_end = items[0]["current_period_end"]
-                    renews_at = datetime.fromtimestamp(period_end, tz=timezone.utc)
-
-        except Exception as sub_err:
-            renews_at = None
-            print("⚠️ Could not fetch subscription:", sub_err)
-
-        if subscription_tier and guild_id:
-            try:
-                with get_db_conn() as conn, conn.cursor() as cur:
-                    # cancel old sub if needed
-                    cur.execute("SELECT subscription_id FROM veil_subscriptions WHERE guild_id=%s", (guild_id,))
-                    old_sub = cur.fetchone()
-                    if old_sub and old_sub[0] and old_sub[0] != subscription_id:
-                        try:
-                            stripe.Subscription.delete(old_sub[0])
-                            print(f"❌ Old subscription {old_sub[0]} canceled for upgrade")
-                        except Exception as cancel_err:
-                            print("⚠️ Could not cancel old subscription:", cancel_err)
-
-                    cur.execute('''
-                        INSERT INTO veil_subscriptions (guild_id, tier, subscribed_at, renews_at, subscription_id, payment_failed)
-                        VALUES (%s, %s, NOW(), %s, %s, FALSE)
-                        ON CONFLICT (guild_id) DO UPDATE
-                        SET tier = EXCLUDED.tier,
-                            subscribed_at = NOW(),
-                            renews_at = EXCLUDED.renews_at,
-                            subscription_id = EXCLUDED.subscription_id,
-                            payment_failed = FALSE
-                    ''', (guild_id, subscription_tier, renews_at, subscription_id))
-                print(f"✅ Updated subscription: guild_id={guild_id}, tier={subscription_tier}, renews_at={renews_at}")
-
-                apply_bonus_for_tier(guild_id, subscription_tier)
-                notify_support_server(guild_id, subscription_tier)
-
-            except Exception as e:
-                print("❌ DB error:", e)
-                print("⚠️ Data was — guild_id:", guild_id, "tier:", subscription_tier)
-                return "Database error", 500
-
-    # ── invoice.payment_succeeded (renewals) ──────────────────────────────────
-    elif event["type"] == "invoice.payment_succeeded":
-        invoice = event["data"]["object"]
-        subscription_id = invoice.get("subscription")
-
-        if subscription_id:
-            try:
-                sub = stripe.Subscription.retrieve(subscription_id)
-                price_id = sub.get("items", {}).get("data", [])[0].get("price", {}).get("id")
-                guild_id = sub.get("metadata", {}).get("guild_id")
-                subscription_tier = tier_map.get(price_id)
-
-                period_end = sub.get("current_period_end")
-                renews_at = datetime.fromtimestamp(period_end, tz=timezone.utc) if period_end else None
-
-                if subscription_tier and guild_id:
-                    with get_db_conn() as conn, conn.cursor() as cur:
-                        cur.execute('''
-                            INSERT INTO veil_subscriptions (guild_id, tier, subscribed_at, renews_at, subscription_id, payment_failed)
-                            VALUES (%s, %s, NOW(), %s, %s, FALSE)
-                            ON CONFLICT (guild_id) DO UPDATE
-                            SET tier = EXCLUDED.tier,
-                                subscribed_at = NOW(),
-                                renews_at = EXCLUDED.renews_at,
-                                subscription_id = EXCLUDED.subscription_id,
-                                payment_failed = FALSE
-                        ''', (guild_id, subscription_tier, renews_at, subscription_id))
-                    print(f"✅ Renewed subscription: guild_id={guild_id}, tier={subscription_tier}, renews_at={renews_at}")
-
-                    apply_bonus_for_tier(guild_id, subscription_tier)
-                    notify_support_server(guild_id, subscription_tier)
-
-            except Exception as e:
-                print("❌ DB error during renewal:", e)
-
-    # ── invoice.payment_failed ────────────────────────────────────────────────
-    elif event["type"] == "invoice.payment_failed":
-        invoice = event["data"]["object"]
-        subscription_id = invoice.get("subscription")
-
-        if subscription_id:
-            try:
-                sub = stripe.Subscription.retrieve(subscription_id)
-                guild_id = sub.get("metadata", {}).get("guild_id")
-
-                if guild_id:
-                    with get_db_conn() as conn, conn.cursor() as cur:
-                        cur.execute('''
-                            UPDATE veil_subscriptions
-                               SET tier = 'free',
-                                   subscribed_at = NOW(),
-                                   renews_at = NULL,
-                                   payment_failed = TRUE
-                             WHERE guild_id = %s
-                        ''', (guild_id,))
-                    print(f"⚠️ Payment failed: Reverted guild {guild_id} to free tier and flagged for bot notification")
-
-            except Exception as e:
-                print("❌ DB error on failed payment:", e)
-
-    # ── customer.subscription.deleted ────────────────────────────────────────
-    elif event["type"] == "customer.subscription.deleted":
-        sub = event["data"]["object"]
-        guild_id = sub.get("metadata", {}).get("guild_id")
-        if guild_id:
-            with get_db_conn() as conn, conn.cursor() as cur:
-                cur.execute("""
-                    UPDATE veil_subscriptions
-                       SET tier = 'free',
-                           subscribed_at = NOW(),
-                           renews_at = NULL,
-                           subscription_id = NULL,
-                           payment_failed = FALSE
-                     WHERE guild_id = %s
-                """, (guild_id,))
-            print(f"❌ Subscription canceled: guild {guild_id} downgraded to free")
+            store_event("stripe", event["id"], event["type"], payload.decode("utf-8"))
+        except Exception as e:
+            metrics.error("inbox_store")
+            event_log.note(f"❌ Failed to store Stripe event in inbox: {e}", error=True, source="stripe",
+                           event_type=event["type"], event_id=event["id"])
+            return "Database error", 500
+        return jsonify(success=True)
 
+    try:
+        run_event("stripe", event["type"], process_stripe_event_in_order, event)
+    except ProcessingError as e:
+        return str(e), 500
     return jsonify(success=True)
 
+def process_stripe_event_in_order(event):
+    """
+    process_stripe_event under the event's guild (or coin buyer's) shard lock.
+    If a newer event for the guild has already been applied, this one's
+    subscription state change is skipped (its bonus and notification are not).
+    """
+    # prime / invalidate the subscription snapshot cache from what Stripe sent us
+    observe_event(event)
+    shard, ordered = stripe_shard(event)
+    try:
+        with in_order(shard, event["created"] if ordered else None, event["id"]) as t:
+            if t.stale:
+                metrics.inc("veil_event_stale_total", event_type=event["type"])
+                event_log.note(f"⏭️ [order] older than the last event applied to {shard}; leaving its state as is",
+                               stale=True)
+            process_stripe_event(event, t)
+    except ShardBusy as e:
+        raise ProcessingError(str(e)) from e
+
+def process_stripe_event(event, turn=UNORDERED):
+    """
+    Apply one verified Stripe event: carry out what stripe_events.decide() says.
+    Raises ProcessingError (or lets DB errors escape) when the event should be
+    retried. `turn` is where the event stands in its guild's order (see
+    event_order); each write moves the guild's watermark in its own transaction.
+    The caller has passed the event to observe_event().
+    """
+    try:
+        action = decide(event, turn)
+    except Exception as e:
+        metrics.error("subscription_fetch")
+        event_log.note(f"⚠️ Could not fetch subscription: {e}", error=True)
+        return
+
+    if isinstance(action, Invalid):
+        event_log.note(f"⚠️ {action.reason}", error=True)
+    elif isinstance(action, CoinPack):
+        credit_coin_pack(action)
+    elif isinstance(action, SetTier):
+        set_tier(action, turn)
+    elif isinstance(action, PaymentFailed):
+        try:
+            with get_db_conn() as conn, conn.cursor() as cur:
+                PAYMENT_FAILED.execute(cur, (action.guild_id,))
+                advance(cur, turn)
+            event_log.note(f"⚠️ Payment failed: Reverted guild {action.guild_id} to free tier and flagged for bot notification")
+        except Exception as e:
+            metrics.error("payment_failed")
+            event_log.note(f"❌ DB error on failed payment: {e}", error=True)
+    elif isinstance(action, Cancel):
+        with get_db_conn() as conn, conn.cursor() as cur:
+            CANCEL_SUBSCRIPTION.execute(cur, (action.guild_id, action.subscription_id, action.newer))
+            downgraded = cur.rowcount
+            advance(cur, turn)
+        if downgraded:
+            event_log.note(f"❌ Subscription canceled: guild {action.guild_id} downgraded to free")
+        else:  # e.g. the subscription an upgrade replaced
+            event_log.note(f"[order] {action.subscription_id} is no longer guild {action.guild_id}'s subscription; nothing to downgrade")
+
+def credit_coin_pack(action: CoinPack):
+    """One-time coin purchase: credit, then PATCH the buyer's interaction and tell the support channel."""
+    user_id, guild_id, coins, session_id = action
+    try:
+        # 1) Credit coins, get the fresh balance and the interaction to PATCH @original
+        #    (no bot token needed) in a single roundtrip
+        with get_db_conn() as conn, conn.cursor() as cur:
+            new_balance, sess_row = credit_coin_purchase(cur, user_id, guild_id, coins, session_id)
+        if new_balance is None:
+            event_log.note(f"[coin] {session_id} was already credited; nothing to do")
+            return
+
+        event_log.note(f"💰 Credited +{coins} to user {user_id} in guild {guild_id}; new balance={new_balance}")
+
+        if not sess_row:
+            event_log.note(f"[coin] ⚠️ No coin_checkout_sessions row for {session_id}; cannot edit interaction.")
+            # Optional: still log to support server
+            if SUPPORT_WEBHOOK:
+                deliver("POST", SUPPORT_WEBHOOK, {
+                    "content": coin_unpatched_content(user_id, guild_id, coins, session_id)
+                }, timeout=5, label="coin_unpatched")
+            return
+
+        interaction_token, application_id, u_saved, g_saved, coins_saved = sess_row
+
+        # 2) Sanity checks
+        if u_saved != user_id or g_saved != guild_id:
+            event_log.note(f"[coin] id mismatch for {session_id}; saved=({u_saved},{g_saved}) got=({user_id},{guild_id})",
+                           error=True)
+            return
+
+        # 3) Build the same embed you had in your bot
+        payload = coin_topup_payload(coins_saved or coins, new_balance)
+
+        # 4) PATCH the original interaction message
+        try:
+            patch_interaction_original(application_id, interaction_token, payload)
+        except Exception as e:
+            metrics.error("coin_patch")
+            event_log.note(f"[coin] ❌ PATCH failed: {e}", error=True)
+
+        notify_coin_topup(session_id, user_id, guild_id, coins)
+
+    except Exception as e:
+        metrics.error("coin_credit")
+        event_log.note(f"❌ DB error while crediting coins: {e}", error=True)
+
+def set_tier(action: SetTier, turn):
+    """
+    Checkout (upgrade=True) or renewal: write the guild's row unless a newer event
+    already decided it, then grant the bonus and announce the tier. A failed
+    checkout write is retried; a failed renewal write is reported only.
+    """
+    guild_id, tier, renews_at = action.guild_id, action.tier, action.renews_at
+    try:
+        if action.write:
+            with get_db_conn() as conn, conn.cursor() as cur:
+                if action.upgrade:
+                    row = CURRENT_SUBSCRIPTION.execute(cur, (guild_id,)).fetchone()
+                    old_sub = replaced(row[0] if row else None, action)
+                    if old_sub:
+                        cancel_replaced(old_sub)
+                UPSERT_SUBSCRIPTION.execute(cur, (guild_id, tier, renews_at, action.subscription_id))
+                advance(cur, turn)
+            event_log.note(f"✅ {'Updated' if action.upgrade else 'Renewed'} subscription: guild_id={guild_id}, "
+                           f"tier={tier}, renews_at={renews_at}")
+
+        apply_bonus_for_tier(guild_id, tier, action.grant_key)
+        notify_support_server(guild_id, tier)
+
+    except Exception as e:
+        if not action.upgrade:
+            metrics.error("renewal")
+            event_log.note(f"❌ DB error during renewal: {e}", error=True)
+            return
+        metrics.error("subscription_upsert")
+        event_log.note(f"❌ DB error: {e}", error=True)
+        raise ProcessingError("Database error") from e
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Inbox workers (WEBHOOK_INBOX=1)
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _process_inbox_stripe(payload: dict):
+    event = stripe.Event.construct_from(payload, stripe.api_key)
+    run_event("stripe", event["type"], process_stripe_event_in_order, event)
+
+def _process_inbox_topgg(payload: dict):
+    run_event("topgg", payload.get("type"), process_topgg_vote, payload)
+
+INBOX_HANDLERS = {
+    "stripe": _process_inbox_stripe,
+    "topgg": _process_inbox_topgg,
+}
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Background startup
+# ─────────────────────────────────────────────────────────────────────────────
+
+_background_pid = None
+_background_lock = threading.Lock()
+
+def _start_inbox() -> bool:
+    return start_workers(INBOX_HANDLERS) if INBOX_ENABLED else True
+
+def _start_until_ready():
+    """Run each startup step until it succeeds, backing off while the database is down."""
+    steps = [startup_check, ensure_ready, _start_inbox, ensure_compactor]
+    delay = 2
+    while True:
+        steps = [step for step in steps if not step()]
+        if not steps:
+            return
+        event_log.note(f"⚠️ [startup] {', '.join(s.__name__ for s in steps)} failed; retrying in {delay:g}s",
+                       error=True)
+        time.sleep(delay)
+        delay = min(delay * 2, STARTUP_RETRY_MAX)
+
+def start_background():
+    """
+    Start this worker's background work once: the schema check, the watermark
+    table, inbox workers, the ledger compactor and the entitlement listener.
+    Called by gunicorn's post_worker_init hook (gunicorn.conf.py), off the
+    request path; the steps run in a thread of their own.
+    """
+    global _background_pid
+    if _background_pid == os.getpid():
+        return
+    with _background_lock:
+        if _background_pid == os.getpid():
+            return
+        ensure_listener()  # retries on its own
+        threading.Thread(target=_start_until_ready, name="startup", daemon=True).start()
+        _background_pid = os.getpid()
+
+@app.route("/stats")
+def stats():
+    return jsonify(pid=os.getpid(), db_pool=pool_stats(), delivery=delivery_stats(), inbox=inbox_stats(),
+                   subscription_cache=subscription_cache.stats(), coin_ledger=ledger_stats(),
+                   discord=discord_stats(), support_relay=relay_stats(), entitlements=entitlement_stats(),
+                   event_order=event_order_stats(), vote_gate=vote_gate_stats(), event_log=event_log.event_log_stats())
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Entitlement reads (for the bot)
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _entitlement_auth_failed() -> bool:
+    return bool(ENTITLEMENT_API_TOKEN) and request.headers.get("Authorization") != f"Bearer {ENTITLEMENT_API_TOKEN}"
+
+@app.route("/guild/<int:guild_id>/tier")
+def get_guild_tier(guild_id: int):
+    if _entitlement_auth_failed():
+        return "Unauthorized", 401
+    return jsonify(guild_tier(guild_id))
+
+@app.route("/user/<int:user_id>/<int:guild_id>/balance")
+def get_user_balance(user_id: int, guild_id: int):
+    if _entitlement_auth_failed():
+        return "Unauthorized", 401
+    return jsonify(user_balance(user_id, guild_id))
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Metrics
+# ─────────────────────────────────────────────────────────────────────────────
+
+# the /stats numbers, exported per process as gauges
+metrics.register_collector("db_pool", pool_stats)
+metrics.register_collector("delivery", delivery_stats)
+metrics.register_collector("inbox", inbox_stats)
+metrics.register_collector("subscription_cache", subscription_cache.stats)
+metrics.register_collector("coin_ledger", ledger_stats)
+metrics.register_collector("discord", discord_stats)
+metrics.register_collector("support_relay", relay_stats)
+metrics.register_collector("entitlements", entitlement_stats)
+metrics.register_collector("event_order", event_order_stats)
+metrics.register_collector("vote_gate", vote_gate_stats)
+metrics.register_collector("event_log", event_log.event_log_stats)
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _observe_request(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.observe("veil_http_requests_seconds", time.perf_counter() - started,
+                        route=route, method=request.method, status=str(response.status_code))
+    return response
+
+@app.route("/metrics")
+def metrics_endpoint():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return "Unauthorized", 401
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/")
 def home():
     return "VeilBot Stripe Webhook Active!"
 
 if __name__ == "__main__":
+    start_background()
     app.run(host="0.0.0.0", port=8080)
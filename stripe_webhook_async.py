@@ -0,0 +1,836 @@
+"""
+Async entry point: the webhook routes on aiohttp + asyncpg.
+
+    gunicorn stripe_webhook_async:app -k aiohttp.GunicornWebWorker
+
+Same rules (stripe_events), statements and Discord messages as stripe_webhook,
+but a worker process no longer blocks on network I/O: Postgres goes through an
+asyncpg pool (the $n statements), Discord through one aiohttp session, and
+Stripe SDK calls run in a thread (asyncio.to_thread). Independent Discord steps
+run concurrently -- the interaction PATCH and the support-channel post.
+
+Outbound Discord calls happen after the response, like the sync app's delivery
+queue: retried with the same backoff and, when retries run out, written to the
+same dead-letter spool (DELIVERY_SPOOL_DIR), which either app replays on start.
+Bonus grants and WEBHOOK_INBOX processing run as tasks on the same pool (the
+asyncpg sections of bonus_engine and inbox); only the coin ledger compactor and
+the entitlement listener keep their threads.
+"""
+import asyncio
+import glob
+import json
+import os
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+import aiohttp
+import asyncpg
+import stripe
+from aiohttp import web
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# imported after load_dotenv so their env settings are visible
+import bonus_engine
+import event_log
+import inbox
+import metrics
+from bonus_engine import (
+    BONUS_BACKGROUND, BONUS_RESUME_AFTER, create_grant_async, pending_grants_async, run_grant_async,
+)
+from coin_ledger import ensure_compactor
+from credits import credit_coin_purchase_async, credit_topgg_vote_async, credit_topgg_votes_async
+from db_pool import DATABASE_URL, DB_POOL_MAX, DB_SSLMODE
+from delivery import DELIVERY_DRAIN_TIMEOUT, DELIVERY_MAX_ATTEMPTS, DELIVERY_SPOOL_DIR, expired, retry_delay
+from entitlements import (
+    GUILD_TIER, MISSING, balance_statement, ensure_listener, entitlement_cache, entitlement_stats, tier_result,
+)
+from event_order import (
+    ENTER, EVENT_LOCK_TIMEOUT, EVENT_ORDERING, LOCK_WAIT, ShardBusy, ensure_ready, event_order_stats, lock_key,
+    UNORDERED, advance_async, record, record_busy, record_queued, stripe_shard, turn,
+)
+from inbox import INBOX_ENABLED, store_event_async, topgg_event_id
+from schema import startup_check
+from stripe_events import (
+    CANCEL_SUBSCRIPTION, CURRENT_SUBSCRIPTION, PAYMENT_FAILED, UPSERT_SUBSCRIPTION, CoinPack, Cancel, Invalid,
+    PaymentFailed, SetTier, cancel_replaced, decide, replaced,
+)
+from subscription_cache import observe_event, subscription_cache
+from support_relay import DISCORD_CONTENT_LIMIT, SUPPORT_RELAY_WINDOW
+from vote_gate import AsyncVoteBatcher, vote_gate, vote_gate_stats
+from webhook_common import (
+    TOPGG_VOTE_COINS, bonus_amounts, coin_topup_line, coin_topup_payload, coin_unpatched_content,
+    interaction_url, to_int_or_none, topgg_vote_line, topgg_vote_payload, upgrade_line,
+)
+
+SUPPORT_WEBHOOK = os.getenv("SUPPORT_WEBHOOK")
+DISCORD_API_BASE = os.getenv("DISCORD_API_BASE", "https://discord.com/api/v10")
+TOPGG_WEBHOOK_AUTH = os.getenv("TOPGG_WEBHOOK_AUTH")
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+ENTITLEMENT_API_TOKEN = os.getenv("ENTITLEMENT_API_TOKEN")
+STARTUP_RETRY_MAX = float(os.getenv("STARTUP_RETRY_MAX", "60"))
+
+stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+stripe.api_base = os.getenv("STRIPE_API_BASE", stripe.api_base)
+endpoint_secret = os.getenv("STRIPE_WEBHOOK_SECRET")
+
+
+class ProcessingError(Exception):
+    """An event could not be applied and should be retried (500 to the sender)."""
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Postgres
+# ─────────────────────────────────────────────────────────────────────────────
+
+_db = None                                             # asyncpg pool, one per worker process
+_round_trips = ContextVar("round_trips", default=0)    # per event, like db_pool.thread_round_trips
+_pinned = ContextVar("pinned", default=None)            # the shard lock's connection inside in_order()
+
+
+class CountingConnection:
+    """asyncpg connection wrapper that times and counts statements."""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    async def _run(self, method, sql, *args):
+        _round_trips.set(_round_trips.get() + 1)
+        start = time.perf_counter()
+        try:
+            return await getattr(self._conn, method)(sql, *args)
+        finally:
+            metrics.observe("veil_db_statement_seconds", time.perf_counter() - start,
+                            statement=metrics.statement_label(sql))
+
+    async def fetchrow(self, sql, *args):
+        return await self._run("fetchrow", sql, *args)
+
+    async def fetchval(self, sql, *args):
+        return await self._run("fetchval", sql, *args)
+
+    async def fetch(self, sql, *args):
+        return await self._run("fetch", sql, *args)
+
+    async def execute(self, sql, *args):
+        return await self._run("execute", sql, *args)
+
+    def transaction(self):
+        return self._conn.transaction()
+
+
+@asynccontextmanager
+async def db_conn():
+    conn = _pinned.get()
+    if conn is not None:
+        yield CountingConnection(conn)
+        return
+    async with _db.acquire() as conn:
+        yield CountingConnection(conn)
+
+
+_shards = {}   # shard -> [asyncio.Lock, users]: this process's queue, as in event_order
+
+
+@asynccontextmanager
+async def in_order(shard, created=None, event_id=None):
+    """event_order.in_order on asyncpg: db_conn() inside the block uses the lock's connection."""
+    if not (EVENT_ORDERING and shard):
+        yield UNORDERED
+        return
+
+    entry = _shards.setdefault(shard, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        if entry[0].locked():
+            record_queued()
+        try:
+            await asyncio.wait_for(entry[0].acquire(), EVENT_LOCK_TIMEOUT)
+        except asyncio.TimeoutError:
+            record_busy()
+            raise ShardBusy(f"{shard} busy for {EVENT_LOCK_TIMEOUT:g}s") from None
+        try:
+            conn = await _db.acquire()
+            start = time.monotonic()
+            try:
+                t = turn(shard, created, event_id, await CountingConnection(conn).fetchval(
+                    ENTER.typed_sql, lock_key(shard), shard, created, event_id, LOCK_WAIT))
+            except BaseException as e:
+                conn.terminate()  # with any lock it got before the error
+                await _db.release(conn)
+                if isinstance(e, asyncpg.LockNotAvailableError):
+                    record_busy()
+                    raise ShardBusy(f"{shard} busy for {LOCK_WAIT}") from e
+                raise
+            record(time.monotonic() - start, t)
+
+            token = _pinned.set(conn)
+            try:
+                yield t
+            finally:
+                _pinned.reset(token)
+                await _db.release(conn)  # the pool's reset runs pg_advisory_unlock_all()
+        finally:
+            entry[0].release()
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _shards[shard]
+
+
+def _ssl_arg(sslmode: str):
+    return False if sslmode == "disable" else sslmode
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Discord (after the response)
+# ─────────────────────────────────────────────────────────────────────────────
+
+_tasks = set()
+
+
+def spawn(coro):
+    """Run a coroutine in the background, keeping a reference until it finishes."""
+    task = asyncio.get_running_loop().create_task(coro)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+
+class DiscordSender:
+    def __init__(self, session: aiohttp.ClientSession):
+        self.session = session
+        self.stats = {"delivered": 0, "retried": 0, "failed": 0, "spooled": 0, "expired": 0}
+
+    async def send(self, method: str, url: str, body, timeout: float = 5, label: str = "", attempts: int = 0,
+                   enqueued_at: float = None):
+        job = {"method": method, "url": url, "json": body, "timeout": timeout, "label": label,
+               "attempts": attempts, "enqueued_at": enqueued_at or time.time()}
+        try:
+            while True:
+                job["attempts"] += 1
+                retry_after, err = await self._attempt(job)
+                if err is None:
+                    self.stats["delivered"] += 1
+                    return
+                if retry_after is False:
+                    self.stats["failed"] += 1
+                    event_log.note(f"[delivery] ❌ {label} {method} gave up: {err}", error=True)
+                    return
+                if job["attempts"] >= DELIVERY_MAX_ATTEMPTS:
+                    self._spool(job, f"{job['attempts']} attempt(s), last error: {err}")
+                    return
+                self.stats["retried"] += 1
+                await asyncio.sleep(retry_delay(job["attempts"], retry_after))
+        except asyncio.CancelledError:
+            self._spool(job, "shutdown")
+            raise
+
+    async def _attempt(self, job):
+        """(retry_after, error): error None on success; retry_after False when not retryable."""
+        start = time.monotonic()
+        try:
+            async with self.session.request(job["method"], job["url"], json=job["json"],
+                                            timeout=aiohttp.ClientTimeout(total=job["timeout"])) as r:
+                text = await r.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            metrics.observe("veil_outbound_http_seconds", time.monotonic() - start,
+                            method=job["method"], status="error")
+            return None, str(e) or type(e).__name__
+        metrics.observe("veil_outbound_http_seconds", time.monotonic() - start,
+                        method=job["method"], status=f"{r.status // 100}xx")
+        if r.status == 429:
+            try:
+                return float(json.loads(text)["retry_after"]), "429 rate limited"
+            except Exception:
+                return float(r.headers.get("Retry-After") or 1), "429 rate limited"
+        if r.status >= 500:
+            return None, f"{r.status} {text[:200]}"
+        if r.status >= 400:
+            return False, f"{r.status} {text[:200]}"
+        return None, None
+
+    def _spool(self, job, reason):
+        if expired(job):
+            self.stats["expired"] += 1
+            event_log.note(f"[delivery] dropped expired {job.get('label')} {job['method']} ({reason})")
+            return
+        job = dict(job, dead_reason=reason)
+        try:
+            os.makedirs(DELIVERY_SPOOL_DIR, exist_ok=True)
+            with open(os.path.join(DELIVERY_SPOOL_DIR, f"dead-{os.getpid()}.jsonl"), "a", encoding="utf-8") as f:
+                f.write(json.dumps(job) + "\n")
+            self.stats["spooled"] += 1
+            event_log.note(f"[delivery] ⚠️ spooled {job.get('label')} {job['method']} ({reason})", error=True)
+        except Exception as e:
+            event_log.note(f"[delivery] ❌ could not spool {job.get('label')} job ({reason}): {e}", error=True)
+
+    def replay_spool(self):
+        """Re-send dead letters left by previous processes (claimed by rename, as delivery.py does)."""
+        for path in sorted(glob.glob(os.path.join(DELIVERY_SPOOL_DIR, "dead-*.jsonl"))):
+            claimed = f"{path}.replay-{os.getpid()}"
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue
+            count = stale = 0
+            with open(claimed, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        job = json.loads(line)
+                    except ValueError:
+                        continue
+                    if expired(job):
+                        stale += 1
+                        continue
+                    spawn(self.send(job["method"], job["url"], job.get("json"), job.get("timeout", 5),
+                                    job.get("label", ""), enqueued_at=job.get("enqueued_at")))
+                    count += 1
+            os.remove(claimed)
+            self.stats["expired"] += stale
+            event_log.note(f"[delivery] replayed {count} dead-lettered job(s) from {os.path.basename(path)}"
+                           + (f", dropped {stale} expired interaction PATCH(es)" if stale else ""))
+
+
+class AsyncRelay:
+    """support_relay.SupportRelay on the event loop: lines coalesced per window, split at 2000 chars."""
+
+    def __init__(self, sender: DiscordSender, url, window=SUPPORT_RELAY_WINDOW, limit=DISCORD_CONTENT_LIMIT):
+        self.sender = sender
+        self.url = url
+        self.window = window
+        self.limit = limit
+        self._lines = []
+        self._size = 0
+        self._timer = None
+
+    async def add(self, line: str):
+        if not self.url:
+            return
+        line = line[: self.limit]
+        if self.window <= 0:
+            await self._post([line])
+            return
+        extra = len(line) + (1 if self._lines else 0)
+        if self._lines and self._size + extra > self.limit:
+            self.flush()
+            extra = len(line)
+        self._lines.append(line)
+        self._size += extra
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._lines:
+            lines, self._lines, self._size = self._lines, [], 0
+            spawn(self._post(lines))
+
+    async def _post(self, lines):
+        await self.sender.send("POST", self.url, {
+            "content": "\n".join(lines),
+            "allowed_mentions": {"parse": []},
+        }, timeout=5, label="support_relay")
+
+
+_sender = None
+_relay = None
+
+
+def notify(line: str = None, patch: tuple = None):
+    """
+    After the response: PATCH the original interaction (application_id, token, payload)
+    and relay a support-channel line, concurrently.
+    """
+    steps = []
+    if patch is not None:
+        application_id, interaction_token, payload = patch
+        url = interaction_url(DISCORD_API_BASE, application_id, interaction_token)
+        steps.append(_sender.send("PATCH", url, payload, timeout=8, label="interaction_patch"))
+    if line is not None:
+        steps.append(_relay.add(line))
+    if steps:
+        spawn(_concurrently(steps))
+
+
+async def _concurrently(steps):
+    await asyncio.gather(*steps)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Handlers (mirror stripe_webhook)
+# ─────────────────────────────────────────────────────────────────────────────
+
+async def run_event(source: str, event_type, handler, arg):
+    """
+    Run one event handler, timing it and counting its DB round trips per source / event type;
+    what it notes goes out as one event_log record.
+    """
+    event_type = event_type or "unknown"
+    token = _round_trips.set(0)
+    try:
+        with metrics.timed("veil_event_seconds", source=source, event_type=event_type), \
+                event_log.event(source, event_type, **event_log.correlation_ids(source, arg)):
+            await handler(arg)
+    finally:
+        metrics.inc("veil_event_db_round_trips_total", _round_trips.get(), source=source, event_type=event_type)
+        _round_trips.reset(token)
+
+
+async def apply_bonus_for_tier(guild_id, tier, grant_key: str):
+    if tier == "elite":
+        event_log.note(f"⛔ Skipping bonus coins for Elite guild {guild_id}")
+        return
+    bonus = bonus_amounts.get(tier)
+    if not bonus:
+        return
+    try:
+        async with db_conn() as conn:
+            created = await create_grant_async(conn, grant_key, guild_id, bonus)
+        if not created:
+            event_log.note(f"[bonus] grant {grant_key} already recorded; skipping")
+            return
+        event_log.note(f"💰 Bonus coins granted: +{bonus} to all users in guild {guild_id} ({grant_key})")
+    except Exception as e:
+        metrics.error("bonus")
+        event_log.note(f"❌ Failed to apply bonus coins: {e}", error=True)
+        return
+    if BONUS_BACKGROUND:
+        spawn(_run_grant(grant_key))
+    else:
+        await _run_grant(grant_key)
+
+
+_grants = set()   # grant keys being applied by this process
+
+
+async def _run_grant(grant_key: str):
+    """bonus_engine's runner, as a task: batches on this process's pool."""
+    if grant_key in _grants:
+        return
+    _grants.add(grant_key)
+    try:
+        await run_grant_async(_db, grant_key)
+    except Exception as e:
+        # the cursor is committed per batch; _resume_grants() picks it up from there
+        event_log.note(f"❌ Bonus grant {grant_key} interrupted: {e}", error=True)
+    finally:
+        _grants.discard(grant_key)
+
+
+async def _resume_grants():
+    """Every BONUS_RESUME_AFTER seconds, pick up grants left running by a crashed or restarted process."""
+    while True:
+        try:
+            async with _db.acquire() as conn:
+                keys = [k for k in await pending_grants_async(conn) if k not in _grants]
+            for key in keys:
+                spawn(_run_grant(key))
+            if keys:
+                event_log.note(f"[bonus] resuming {len(keys)} unfinished grant(s)")
+        except Exception as e:
+            event_log.note(f"⚠️ [bonus] could not look for unfinished grants: {e}", error=True)
+        await asyncio.sleep(BONUS_RESUME_AFTER)
+
+
+async def _credit_votes(user_ids, coins: int) -> dict:
+    async with db_conn() as conn:
+        return await credit_topgg_votes_async(conn, user_ids, coins)
+
+
+async def _credit_vote(user_id: int, coins: int):
+    async with db_conn() as conn:
+        return await credit_topgg_vote_async(conn, user_id, coins)
+
+
+_vote_batcher = AsyncVoteBatcher(_credit_votes, _credit_vote)
+
+
+async def process_topgg_vote(data: dict):
+    user_id = to_int_or_none(data.get("user"))
+    if not user_id:
+        return
+
+    coins_to_add = TOPGG_VOTE_COINS
+    generation = vote_gate.generation()
+    row = await _vote_batcher.credit(user_id, coins_to_add)
+
+    if not row:
+        vote_gate.no_session(user_id, generation)
+        event_log.note(f"[topgg] No pending session for user {user_id}; credit skipped.")
+        notify(line=topgg_vote_line(user_id, 0, 0))
+        return
+
+    session_id, guild_id, interaction_token, application_id, new_balance = row
+    event_log.bind(guild_id=guild_id, vote_session_id=session_id)
+    notify(line=topgg_vote_line(user_id, guild_id, coins_to_add),
+           patch=(application_id, interaction_token, topgg_vote_payload(coins_to_add, new_balance)))
+
+
+async def process_stripe_event_in_order(event):
+    observe_event(event)
+    shard, ordered = await asyncio.to_thread(stripe_shard, event)
+    try:
+        async with in_order(shard, event["created"] if ordered else None, event["id"]) as t:
+            if t.stale:
+                metrics.inc("veil_event_stale_total", event_type=event["type"])
+                event_log.note(f"⏭️ [order] older than the last event applied to {shard}; leaving its state as is",
+                               stale=True)
+            await process_stripe_event(event, t)
+    except ShardBusy as e:
+        raise ProcessingError(str(e)) from e
+
+
+async def process_stripe_event(event, turn=UNORDERED):
+    """stripe_webhook.process_stripe_event: carry out what stripe_events.decide() says."""
+    try:
+        # decide() may look the subscription up in Stripe
+        action = await asyncio.to_thread(decide, event, turn)
+    except Exception as e:
+        metrics.error("subscription_fetch")
+        event_log.note(f"⚠️ Could not fetch subscription: {e}", error=True)
+        return
+
+    if isinstance(action, Invalid):
+        event_log.note(f"⚠️ {action.reason}", error=True)
+    elif isinstance(action, CoinPack):
+        await credit_coin_pack(action)
+    elif isinstance(action, SetTier):
+        await set_tier(action, turn)
+    elif isinstance(action, PaymentFailed):
+        try:
+            async with db_conn() as conn, conn.transaction():
+                await conn.execute(PAYMENT_FAILED.typed_sql, action.guild_id)
+                await advance_async(conn, turn)
+            event_log.note(f"⚠️ Payment failed: Reverted guild {action.guild_id} to free tier and flagged for bot notification")
+        except Exception as e:
+            metrics.error("payment_failed")
+            event_log.note(f"❌ DB error on failed payment: {e}", error=True)
+    elif isinstance(action, Cancel):
+        async with db_conn() as conn, conn.transaction():
+            status = await conn.execute(CANCEL_SUBSCRIPTION.typed_sql, action.guild_id, action.subscription_id,
+                                        action.newer)
+            await advance_async(conn, turn)
+        if status != "UPDATE 0":
+            event_log.note(f"❌ Subscription canceled: guild {action.guild_id} downgraded to free")
+        else:  # e.g. the subscription an upgrade replaced
+            event_log.note(f"[order] {action.subscription_id} is no longer guild {action.guild_id}'s subscription; nothing to downgrade")
+
+
+async def credit_coin_pack(action: CoinPack):
+    user_id, guild_id, coins, session_id = action
+    try:
+        async with db_conn() as conn:
+            new_balance, sess_row = await credit_coin_purchase_async(conn, user_id, guild_id, coins, session_id)
+    except Exception as e:
+        metrics.error("coin_credit")
+        event_log.note(f"❌ DB error while crediting coins: {e}", error=True)
+        return
+    if new_balance is None:
+        event_log.note(f"[coin] {session_id} was already credited; nothing to do")
+        return
+    event_log.note(f"💰 Credited +{coins} to user {user_id} in guild {guild_id}; new balance={new_balance}")
+
+    if not sess_row:
+        event_log.note(f"[coin] ⚠️ No coin_checkout_sessions row for {session_id}; cannot edit interaction.")
+        if SUPPORT_WEBHOOK:
+            spawn(_sender.send("POST", SUPPORT_WEBHOOK, {
+                "content": coin_unpatched_content(user_id, guild_id, coins, session_id)
+            }, timeout=5, label="coin_unpatched"))
+        return
+
+    interaction_token, application_id, u_saved, g_saved, coins_saved = sess_row
+    if u_saved != user_id or g_saved != guild_id:
+        event_log.note(f"[coin] id mismatch for {session_id}; saved=({u_saved},{g_saved}) got=({user_id},{guild_id})",
+                       error=True)
+        return
+    notify(line=coin_topup_line(session_id, user_id, guild_id, coins),
+           patch=(application_id, interaction_token, coin_topup_payload(coins_saved or coins, new_balance)))
+
+
+async def set_tier(action: SetTier, turn):
+    """stripe_webhook.set_tier: the lookup, the replaced subscription's cancel and the write, in one transaction."""
+    guild_id, tier, renews_at = action.guild_id, action.tier, action.renews_at
+    try:
+        if action.write:
+            async with db_conn() as conn, conn.transaction():
+                if action.upgrade:
+                    old_sub = replaced(await conn.fetchval(CURRENT_SUBSCRIPTION.typed_sql, guild_id), action)
+                    if old_sub:
+                        await asyncio.to_thread(cancel_replaced, old_sub)
+                await conn.execute(UPSERT_SUBSCRIPTION.typed_sql, guild_id, tier, renews_at, action.subscription_id)
+                await advance_async(conn, turn)
+            event_log.note(f"✅ {'Updated' if action.upgrade else 'Renewed'} subscription: guild_id={guild_id}, "
+                           f"tier={tier}, renews_at={renews_at}")
+        await apply_bonus_for_tier(guild_id, tier, action.grant_key)
+        notify(line=upgrade_line(guild_id, tier))
+    except Exception as e:
+        if not action.upgrade:
+            metrics.error("renewal")
+            event_log.note(f"❌ DB error during renewal: {e}", error=True)
+            return
+        metrics.error("subscription_upsert")
+        event_log.note(f"❌ DB error: {e}", error=True)
+        raise ProcessingError("Database error") from e
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Inbox workers (WEBHOOK_INBOX=1)
+# ─────────────────────────────────────────────────────────────────────────────
+
+async def _process_inbox_stripe(payload: dict):
+    event = stripe.Event.construct_from(payload, stripe.api_key)
+    await run_event("stripe", event["type"], process_stripe_event_in_order, event)
+
+
+async def _process_inbox_topgg(payload: dict):
+    await run_event("topgg", payload.get("type"), process_topgg_vote, payload)
+
+
+INBOX_HANDLERS = {
+    "stripe": _process_inbox_stripe,
+    "topgg": _process_inbox_topgg,
+}
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Routes
+# ─────────────────────────────────────────────────────────────────────────────
+
+routes = web.RouteTableDef()
+
+
+@routes.post("/topgg-webhook")
+async def topgg_webhook(request: web.Request):
+    if not TOPGG_WEBHOOK_AUTH or request.headers.get("Authorization") != TOPGG_WEBHOOK_AUTH:
+        return web.Response(text="Unauthorized", status=401)
+    try:
+        data = json.loads(await request.read())
+    except ValueError:
+        return web.Response(text="Bad JSON", status=400)
+
+    user_id = to_int_or_none(data.get("user"))
+    absorbed = vote_gate.admit(user_id) if user_id else None
+    if absorbed:
+        return web.json_response({"ok": True, "absorbed": absorbed})
+
+    try:
+        if INBOX_ENABLED:
+            async with db_conn() as conn:
+                await store_event_async(conn, "topgg", topgg_event_id(data), data.get("type"), data)
+        else:
+            await run_event("topgg", data.get("type"), process_topgg_vote, data)
+    except Exception as e:
+        vote_gate.release(user_id)
+        metrics.error("inbox_store" if INBOX_ENABLED else "topgg")
+        if INBOX_ENABLED:  # else run_event's record has the error
+            event_log.note(f"❌ topgg_webhook inbox error: {e}", error=True, source="topgg", user_id=user_id)
+        return web.Response(text="Server error", status=500)
+    return web.json_response({"ok": True})
+
+
+@routes.post("/stripe-webhook")
+async def stripe_webhook(request: web.Request):
+    payload = await request.read()
+    start = time.perf_counter()
+    try:
+        event = stripe.Webhook.construct_event(payload, request.headers.get("stripe-signature"), endpoint_secret)
+    except ValueError:
+        metrics.error("stripe_payload")
+        return web.Response(text="Invalid payload", status=400)
+    except stripe.error.SignatureVerificationError:
+        metrics.error("stripe_signature")
+        return web.Response(text="Invalid signature", status=400)
+    finally:
+        metrics.observe("veil_stripe_api_seconds", time.perf_counter() - start, call="Webhook.construct_event")
+
+    if INBOX_ENABLED:
+        try:
+            async with db_conn() as conn:
+                await store_event_async(conn, "stripe", event["id"], event["type"], payload.decode("utf-8"))
+        except Exception as e:
+            metrics.error("inbox_store")
+            event_log.note(f"❌ Failed to store Stripe event in inbox: {e}", error=True, source="stripe",
+                           event_type=event["type"], event_id=event["id"])
+            return web.Response(text="Database error", status=500)
+        return web.json_response({"success": True})
+
+    try:
+        await run_event("stripe", event["type"], process_stripe_event_in_order, event)
+    except ProcessingError as e:
+        return web.Response(text=str(e), status=500)
+    return web.json_response({"success": True})
+
+
+async def _cached(key, load):
+    value, generation = entitlement_cache.get(key)
+    if value is MISSING:
+        value = await load()
+        entitlement_cache.put(key, value, generation)
+    return value
+
+
+def _entitlement_auth_failed(request: web.Request) -> bool:
+    return bool(ENTITLEMENT_API_TOKEN) and request.headers.get("Authorization") != f"Bearer {ENTITLEMENT_API_TOKEN}"
+
+
+@routes.get("/guild/{guild_id:\\d+}/tier")
+async def get_guild_tier(request: web.Request):
+    if _entitlement_auth_failed(request):
+        return web.Response(text="Unauthorized", status=401)
+    guild_id = int(request.match_info["guild_id"])
+
+    async def load():
+        async with db_conn() as conn:
+            return tier_result(guild_id, await conn.fetchrow(GUILD_TIER.typed_sql, guild_id))
+    return web.json_response(await _cached(("tier", guild_id), load))
+
+
+@routes.get("/user/{user_id:\\d+}/{guild_id:\\d+}/balance")
+async def get_user_balance(request: web.Request):
+    if _entitlement_auth_failed(request):
+        return web.Response(text="Unauthorized", status=401)
+    user_id, guild_id = int(request.match_info["user_id"]), int(request.match_info["guild_id"])
+
+    async def load():
+        async with db_conn() as conn:
+            return int(await conn.fetchval(balance_statement().typed_sql, user_id, guild_id))
+    coins = await _cached(("balance", user_id, guild_id), load)
+    return web.json_response({"user_id": user_id, "guild_id": guild_id, "coins": coins})
+
+
+@routes.get("/metrics")
+async def metrics_endpoint(request: web.Request):
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return web.Response(text="Unauthorized", status=401)
+    body = await asyncio.to_thread(metrics.render)
+    return web.Response(text=body, content_type="text/plain")
+
+
+@routes.get("/")
+async def home(request: web.Request):
+    return web.Response(text="VeilBot Stripe Webhook Active!")
+
+
+@web.middleware
+async def observe_request(request: web.Request, handler):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        route = request.match_info.route.resource
+        metrics.observe("veil_http_requests_seconds", time.perf_counter() - start,
+                        route=route.canonical if route is not None else "unmatched",
+                        method=request.method, status=str(status))
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# App lifecycle
+# ─────────────────────────────────────────────────────────────────────────────
+
+async def on_startup(app: web.Application):
+    global _db, _sender, _relay
+    _db = await asyncpg.create_pool(DATABASE_URL, ssl=_ssl_arg(DB_SSLMODE), min_size=1, max_size=DB_POOL_MAX)
+    session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=int(os.getenv("DISCORD_HTTP_POOL", "10"))),
+        headers={"User-Agent": "VeilBot-Webhook (aiohttp)"},
+    )
+    app["http"] = session
+    _sender = DiscordSender(session)
+    _relay = AsyncRelay(_sender, SUPPORT_WEBHOOK)
+    _sender.replay_spool()
+
+    metrics.register_collector("db_pool", lambda: {"open": _db.get_size(), "idle": _db.get_idle_size(),
+                                                   "in_use": _db.get_size() - _db.get_idle_size()})
+    metrics.register_collector("delivery", lambda: dict(_sender.stats, in_flight=len(_tasks)))
+    metrics.register_collector("subscription_cache", subscription_cache.stats)
+    metrics.register_collector("entitlements", entitlement_stats)
+    metrics.register_collector("event_order", event_order_stats)
+    metrics.register_collector("vote_gate", vote_gate_stats)
+    metrics.register_collector("event_log", event_log.event_log_stats)
+
+    await asyncio.to_thread(ensure_listener)  # the listener is a thread (retrying on its own); the cache is shared
+    app["background"] = {}
+    app["background"]["startup"] = asyncio.get_running_loop().create_task(_start_until_ready(app["background"]))
+
+
+def _ensure_bonus_schema() -> bool:
+    try:
+        bonus_engine.ensure_schema()
+    except Exception as e:
+        event_log.note(f"❌ [bonus] could not ensure schema: {e}", error=True)
+        return False
+    return True
+
+
+def _ensure_inbox_schema() -> bool:
+    try:
+        inbox.ensure_schema()
+    except Exception as e:
+        event_log.note(f"❌ [inbox] could not ensure schema: {e}", error=True)
+        return False
+    return True
+
+
+async def _start_until_ready(background: dict):
+    """
+    stripe_webhook._start_until_ready as a task: run each startup step (in a
+    thread) until it succeeds, backing off while the database is down, then
+    start the bonus and inbox tasks that depend on them.
+    """
+    steps = [startup_check, ensure_ready, ensure_compactor, _ensure_bonus_schema]
+    if INBOX_ENABLED:
+        steps.append(_ensure_inbox_schema)
+    delay = 2
+    while True:
+        steps = [step for step in steps if not await asyncio.to_thread(step)]
+        if not steps:
+            break
+        event_log.note(f"⚠️ [startup] {', '.join(s.__name__ for s in steps)} failed; retrying in {delay:g}s",
+                       error=True)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, STARTUP_RETRY_MAX)
+
+    loop = asyncio.get_running_loop()
+    background["bonus"] = loop.create_task(_resume_grants())
+    if INBOX_ENABLED:
+        background["inbox"] = loop.create_task(inbox.work_async(_db, INBOX_HANDLERS))
+        event_log.note(f"[inbox] started async worker in pid {os.getpid()}")
+
+
+async def on_cleanup(app: web.Application):
+    for task in app["background"].values():
+        task.cancel()
+    _relay.flush()
+    if _tasks:
+        _, pending = await asyncio.wait(set(_tasks), timeout=DELIVERY_DRAIN_TIMEOUT)
+        for task in pending:
+            task.cancel()  # DiscordSender.send spools the job on cancel
+        if pending:
+            await asyncio.wait(pending)
+    await app["http"].close()
+    await _db.close()
+
+
+def create_app() -> web.Application:
+    app = web.Application(middlewares=[observe_request])
+    app.add_routes(routes)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+app = create_app()
+
+if __name__ == "__main__":
+    web.run_app(app, host="0.0.0.0", port=int(os.getenv("PORT", "8080")))
@@ -0,0 +1,152 @@
+"""
+Snapshot cache for Stripe subscriptions.
+
+The webhook branches only need three things from a subscription: the price id,
+metadata.guild_id and current_period_end. Instead of calling
+stripe.Subscription.retrieve for every event, keep a small TTL + LRU cache of
+those snapshots, filled from data Stripe already sends us (customer.subscription.*
+payloads and invoice line items) and invalidated on update/delete events.
+
+Set SUBSCRIPTION_CACHE=0 to bypass the cache (always retrieve) while debugging.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import stripe
+
+import metrics
+
+SUBSCRIPTION_CACHE_ENABLED = os.getenv("SUBSCRIPTION_CACHE", "1").lower() not in ("0", "false", "no")
+SUBSCRIPTION_CACHE_TTL = float(os.getenv("SUBSCRIPTION_CACHE_TTL", "600"))
+SUBSCRIPTION_CACHE_MAX = int(os.getenv("SUBSCRIPTION_CACHE_MAX", "5000"))
+
+
+def snapshot_from_subscription(sub) -> dict:
+    """Reduce a Subscription object (API response or event payload) to what the handlers use."""
+    items = (sub.get("items") or {}).get("data") or []
+    first = items[0] if items else {}
+    return {
+        "id": sub.get("id"),
+        "price_id": (first.get("price") or {}).get("id"),
+        "guild_id": (sub.get("metadata") or {}).get("guild_id"),
+        # newer API versions moved current_period_end onto the item
+        "current_period_end": first.get("current_period_end") or sub.get("current_period_end"),
+    }
+
+
+def invoice_subscription_id(invoice):
+    sub_id = invoice.get("subscription")
+    if not sub_id:
+        details = (invoice.get("parent") or {}).get("subscription_details") or {}
+        sub_id = details.get("subscription")
+    if isinstance(sub_id, dict):
+        sub_id = sub_id.get("id")
+    return sub_id
+
+
+def snapshot_from_invoice(invoice):
+    """
+    Build a snapshot from an invoice's subscription line item, or None if the
+    invoice does not carry enough information (then we fall back to retrieve).
+    """
+    sub_id = invoice_subscription_id(invoice)
+    if not sub_id:
+        return None
+    sub_details = invoice.get("subscription_details") \
+        or (invoice.get("parent") or {}).get("subscription_details") or {}
+    for line in (invoice.get("lines") or {}).get("data") or []:
+        price_id = (line.get("price") or {}).get("id")
+        if not price_id:
+            price_id = ((line.get("pricing") or {}).get("price_details") or {}).get("price")
+        guild_id = (line.get("metadata") or {}).get("guild_id") \
+            or (sub_details.get("metadata") or {}).get("guild_id")
+        period_end = (line.get("period") or {}).get("end")
+        if price_id and guild_id and period_end:
+            return {"id": sub_id, "price_id": price_id, "guild_id": guild_id, "current_period_end": period_end}
+    return None
+
+
+class SubscriptionCache:
+    def __init__(self, ttl=SUBSCRIPTION_CACHE_TTL, maxsize=SUBSCRIPTION_CACHE_MAX, enabled=SUBSCRIPTION_CACHE_ENABLED):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.enabled = enabled
+        self._data = OrderedDict()   # subscription_id -> (expires_at, snapshot)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.primed = 0
+        self.invalidations = 0
+
+    def get(self, subscription_id):
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(subscription_id)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self._data[subscription_id]
+                return None
+            self._data.move_to_end(subscription_id)
+            return entry[1]
+
+    def put(self, snapshot):
+        if not self.enabled or not snapshot or not snapshot.get("id"):
+            return
+        with self._lock:
+            self._data[snapshot["id"]] = (time.monotonic() + self.ttl, snapshot)
+            self._data.move_to_end(snapshot["id"])
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            self.primed += 1
+
+    def invalidate(self, subscription_id):
+        with self._lock:
+            if self._data.pop(subscription_id, None) is not None:
+                self.invalidations += 1
+
+    def fetch(self, subscription_id) -> dict:
+        """Cached snapshot, falling back to stripe.Subscription.retrieve on a miss."""
+        snap = self.get(subscription_id)
+        if snap is not None:
+            with self._lock:
+                self.hits += 1
+            return snap
+        with self._lock:
+            self.misses += 1
+        with metrics.timed("veil_stripe_api_seconds", call="Subscription.retrieve"):
+            sub = stripe.Subscription.retrieve(subscription_id)
+        snap = snapshot_from_subscription(sub)
+        self.put(snap)
+        return snap
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+                "primed": self.primed,
+                "invalidations": self.invalidations,
+            }
+
+
+subscription_cache = SubscriptionCache()
+
+
+def observe_event(event):
+    """Feed a Stripe event's payload into the cache (prime on create / invoice, drop on update / delete)."""
+    obj = event["data"]["object"]
+    etype = event["type"]
+    if etype == "customer.subscription.created":
+        subscription_cache.put(snapshot_from_subscription(obj))
+    elif etype in ("customer.subscription.updated", "customer.subscription.deleted"):
+        subscription_cache.invalidate(obj.get("id"))
+    elif etype.startswith("invoice."):
+        subscription_cache.put(snapshot_from_invoice(obj))
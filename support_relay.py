@@ -0,0 +1,142 @@
+"""
+Coalescing relay for the support channel.
+
+[TOPGG_VOTE] / [COIN_TOPUP] lines (and upgrade notices) used to be one webhook
+execution each; during a vote surge that hits the webhook's rate limit and
+floods the bot's on_message parser. The relay buffers lines for up to
+SUPPORT_RELAY_WINDOW seconds and posts them as one message, one line per
+event, never exceeding Discord's 2000-character content limit. Lines are
+passed through verbatim so the bot's regexes keep matching. The buffer is
+flushed when the window ends, when the next line would not fit, and on
+process exit. SUPPORT_RELAY_WINDOW=0 posts every line on its own.
+"""
+import atexit
+import os
+import threading
+import time
+
+from delivery import deliver
+
+SUPPORT_WEBHOOK = os.getenv("SUPPORT_WEBHOOK")
+SUPPORT_RELAY_WINDOW = float(os.getenv("SUPPORT_RELAY_WINDOW", "2"))
+DISCORD_CONTENT_LIMIT = 2000
+
+
+class SupportRelay:
+    def __init__(self, url, window=SUPPORT_RELAY_WINDOW, limit=DISCORD_CONTENT_LIMIT):
+        self.url = url
+        self.window = window
+        self.limit = limit
+        self.pid = os.getpid()
+        self._cond = threading.Condition()
+        self._lines = []
+        self._size = 0            # length of "\n".join(self._lines)
+        self._deadline = None     # monotonic time the current window closes
+        self._stats = {"lines": 0, "messages": 0, "flush_window": 0, "flush_full": 0, "flush_exit": 0}
+        if window > 0:
+            threading.Thread(target=self._run, name="support-relay", daemon=True).start()
+
+    def add(self, line: str):
+        line = line[: self.limit]
+        if self.window <= 0:
+            with self._cond:
+                self._stats["lines"] += 1
+                self._post([line])
+            return
+        with self._cond:
+            self._stats["lines"] += 1
+            extra = len(line) + (1 if self._lines else 0)
+            if self._lines and self._size + extra > self.limit:
+                self._stats["flush_full"] += 1
+                self._flush_locked()
+                extra = len(line)
+            self._lines.append(line)
+            self._size += extra
+            if self._deadline is None:
+                self._deadline = time.monotonic() + self.window
+                self._cond.notify()
+
+    def flush(self, reason="flush_exit"):
+        with self._cond:
+            if self._lines:
+                self._stats[reason] += 1
+                self._flush_locked()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return dict(self._stats, buffered=len(self._lines))
+
+    # ── internals ──────────────────────────────────────────────────────────
+    def _flush_locked(self):
+        lines, self._lines, self._size, self._deadline = self._lines, [], 0, None
+        self._post(lines)
+
+    def _post(self, lines):
+        # deliver() only enqueues, so it is fine to call with the lock held
+        deliver("POST", self.url, {
+            "content": "\n".join(lines),
+            "allowed_mentions": {"parse": []},  # no accidental pings
+        }, timeout=5, label="support_relay")
+        self._stats["messages"] += 1
+
+    def _run(self):
+        with self._cond:
+            while True:
+                if self._deadline is None:
+                    self._cond.wait()
+                    continue
+                remaining = self._deadline - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                if self._lines:
+                    self._stats["flush_window"] += 1
+                    self._flush_locked()
+                self._deadline = None
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Process-wide relay
+# ─────────────────────────────────────────────────────────────────────────────
+
+_relay = None
+_relay_lock = threading.Lock()
+
+
+def relay_line(line: str):
+    """Queue one line for the support channel (no-op without SUPPORT_WEBHOOK)."""
+    global _relay
+    if not SUPPORT_WEBHOOK:
+        return
+    relay = _relay
+    if relay is None or relay.pid != os.getpid():
+        with _relay_lock:
+            if _relay is None or _relay.pid != os.getpid():
+                _relay = SupportRelay(SUPPORT_WEBHOOK)
+            relay = _relay
+    relay.add(line)
+
+
+def relay_stats() -> dict:
+    relay = _relay
+    if relay is None or relay.pid != os.getpid():
+        return {"lines": 0, "buffered": 0}
+    return relay.stats()
+
+
+def _after_fork_in_child():
+    global _relay, _relay_lock
+    _relay = None
+    _relay_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+# registered after delivery's own exit hook, so it runs first and the final
+# message still goes through the delivery queue's drain / spool
+@atexit.register
+def _flush_on_exit():
+    relay = _relay
+    if relay is not None and relay.pid == os.getpid():
+        relay.flush()
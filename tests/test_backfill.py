@@ -0,0 +1,147 @@
+"""
+backfill.py against the Stripe stand-in (benchmarks/standins.py) and a scratch
+schema. Needs a Postgres to create schemas in:
+
+    BENCH_DATABASE_URL=postgresql://localhost/veil_bench python -m pytest tests
+"""
+import os
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+pytestmark = pytest.mark.skipif(not os.getenv("BENCH_DATABASE_URL"),
+                                reason="set BENCH_DATABASE_URL to a scratch database")
+
+from common import scratch_schema  # noqa: E402
+from standins import COIN_PRICES, TIER_PRICES, StandInServer, subscription_object  # noqa: E402
+
+import db_pool  # noqa: E402
+import event_order  # noqa: E402
+
+NOW = int(time.time())
+
+
+def checkout(event_id, created, guild_id, tier):
+    return {"id": event_id, "object": "event", "type": "checkout.session.completed", "created": created,
+            "data": {"object": {"id": f"cs_{event_id}", "object": "checkout.session", "mode": "subscription",
+                                "subscription": f"sub_bench_{guild_id}_{tier}", "client_reference_id": "1",
+                                "metadata": {"guild_id": str(guild_id), "price_id": TIER_PRICES[tier]}}}}
+
+
+def coin_pack(event_id, created, user_id, guild_id, coins):
+    return {"id": event_id, "object": "event", "type": "checkout.session.completed", "created": created,
+            "data": {"object": {"id": f"cs_{event_id}", "object": "checkout.session", "mode": "payment",
+                                "client_reference_id": str(user_id),
+                                "metadata": {"guild_id": str(guild_id), "price_id": COIN_PRICES[coins]}}}}
+
+
+def deleted(event_id, created, guild_id, tier):
+    sub = subscription_object(f"sub_bench_{guild_id}_{tier}", guild_id, tier, status="canceled")
+    return {"id": event_id, "object": "event", "type": "customer.subscription.deleted", "created": created,
+            "data": {"object": sub}}
+
+
+def query(sql, params=()):
+    with db_pool.get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute(sql, params)
+        return cur.fetchall() if cur.description else None
+
+
+@pytest.fixture(scope="module")
+def standin():
+    """The Stripe stand-in, with backfill's Stripe client pointed at it."""
+    server = StandInServer().start()
+    import backfill
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(backfill.stripe, "api_key", backfill.stripe.api_key or "sk_test_backfill")
+        mp.setattr(backfill.stripe, "api_base", server.base_url)
+        yield server
+    server.stop()
+
+
+@pytest.fixture
+def db():
+    with scratch_schema(maxconn=2) as name:
+        yield name
+
+
+@pytest.fixture
+def backfill_run(db, standin):
+    """backfill.run over the last day, with the stand-in serving `events` and `subscriptions`."""
+    import backfill
+
+    def run(events, subscriptions=()):
+        standin.events, standin.subscriptions = list(events), list(subscriptions)
+        standin.requests.clear()
+        return backfill.run(NOW - 86400, NOW + 60, credit_unverified=True, notify=False)
+    return run
+
+
+def test_pages_through_events_and_subscriptions(backfill_run, standin):
+    guilds = range(1000, 1150)
+    events = [checkout(f"evt_page_{g}", NOW - 3600 + g, g, "basic") for g in guilds]
+    events += [coin_pack(f"evt_page_coins_{i}", NOW - 1800 + i, 5000 + i, 9000, 100) for i in range(120)]
+    subs = [subscription_object(f"sub_bench_{g}_basic", g, "basic") for g in guilds]
+
+    report = backfill_run(events, subs)
+
+    assert report["events"] == len(events)
+    assert standin.requests["stripe GET events list"] == 3        # 270 events, 100 a page
+    assert standin.requests["stripe GET subscriptions list"] == 2
+    assert query("SELECT COUNT(*) FROM veil_subscriptions WHERE tier = 'basic'") == [(len(guilds),)]
+    assert query("SELECT COUNT(*), SUM(coins) FROM veil_users WHERE guild_id = 9000") == [(120, 120 * 100)]
+
+
+def test_applies_events_oldest_first(backfill_run):
+    # listed newest first by Stripe: applied in that order the checkout would win
+    events = [checkout("evt_order_1", NOW - 600, 2001, "premium"), deleted("evt_order_2", NOW - 300, 2001, "premium")]
+
+    backfill_run(events)
+
+    assert query("SELECT tier, subscription_id FROM veil_subscriptions WHERE guild_id = 2001") == [("free", None)]
+    assert query("SELECT created, event_id FROM event_watermarks WHERE shard = 'guild:2001'") == \
+        [(NOW - 300, "evt_order_2")]
+
+
+def test_events_older_than_the_watermark_are_stale(backfill_run):
+    # the webhook already applied a newer event for the guild
+    event_order.ensure_schema()
+    query("""
+        INSERT INTO veil_subscriptions (guild_id, tier, subscribed_at, subscription_id, payment_failed)
+        VALUES (2002, 'elite', NOW(), 'sub_bench_2002_elite', FALSE)
+    """)
+    query("INSERT INTO event_watermarks (shard, created, event_id) VALUES ('guild:2002', %s, 'evt_live')", (NOW,))
+    events = [checkout("evt_stale_1", NOW - 600, 2002, "basic"), deleted("evt_stale_2", NOW - 300, 2002, "elite")]
+
+    report = backfill_run(events)
+
+    assert report["guild_changes"] == 0
+    assert query("SELECT tier, subscription_id FROM veil_subscriptions WHERE guild_id = 2002") == \
+        [("elite", "sub_bench_2002_elite")]
+    assert query("SELECT created, event_id FROM event_watermarks WHERE shard = 'guild:2002'") == [(NOW, "evt_live")]
+
+
+def test_rerun_applies_nothing(backfill_run):
+    events = [checkout("evt_rerun_1", NOW - 600, 2003, "basic"),
+              coin_pack("evt_rerun_2", NOW - 500, 77, 2003, 250),
+              checkout("evt_rerun_3", NOW - 400, 2004, "premium"),
+              deleted("evt_rerun_4", NOW - 300, 2004, "premium")]
+    subs = [subscription_object("sub_bench_2003_basic", 2003, "basic")]
+
+    first = backfill_run(events, subs)
+    state = query("SELECT guild_id, tier, subscription_id, renews_at FROM veil_subscriptions ORDER BY 1")
+    coins = query("SELECT user_id, guild_id, coins FROM veil_users ORDER BY 1, 2")
+    second = backfill_run(events, subs)
+
+    assert (first["guild_changes"], first["coin_credits"], first["grants"]) == (2, 1, 2)
+    assert second["skipped"] == len(events)
+    assert (second["guild_changes"], second["coin_credits"], second["grants"]) == (0, 0, 0)
+    assert query("SELECT guild_id, tier, subscription_id, renews_at FROM veil_subscriptions ORDER BY 1") == state
+    assert query("SELECT user_id, guild_id, coins FROM veil_users ORDER BY 1, 2") == coins
+    # recorded in backfill's own table; webhook_inbox is only written with WEBHOOK_INBOX
+    assert query("SELECT COUNT(*) FROM backfill_events") == [(len(events),)]
+    assert query("SELECT to_regclass('webhook_inbox')") == [(None,)]
@@ -0,0 +1,68 @@
+"""
+inbox.py reclaiming events against a scratch schema. Needs a Postgres to
+create schemas in:
+
+    BENCH_DATABASE_URL=postgresql://localhost/veil_bench python -m pytest tests
+"""
+import os
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+pytestmark = pytest.mark.skipif(not os.getenv("BENCH_DATABASE_URL"),
+                                reason="set BENCH_DATABASE_URL to a scratch database")
+
+from common import scratch_schema  # noqa: E402
+from standins import COIN_PRICES  # noqa: E402
+
+import coin_ledger  # noqa: E402
+import db_pool  # noqa: E402
+import event_order  # noqa: E402
+import inbox  # noqa: E402
+import stripe_webhook  # noqa: E402
+
+
+def coin_pack(event_id, user_id, guild_id, coins):
+    return {"id": event_id, "object": "event", "type": "checkout.session.completed", "created": int(time.time()),
+            "data": {"object": {"id": f"cs_{event_id}", "object": "checkout.session", "mode": "payment",
+                                "client_reference_id": str(user_id),
+                                "metadata": {"guild_id": str(guild_id), "price_id": COIN_PRICES[coins]}}}}
+
+
+def query(sql, params=()):
+    with db_pool.get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute(sql, params)
+        return cur.fetchall() if cur.description else None
+
+
+@pytest.fixture
+def db():
+    with scratch_schema(maxconn=2) as name:
+        inbox.ensure_schema()
+        coin_ledger.ensure_schema()
+        event_order.ensure_schema()
+        yield name
+
+
+@pytest.mark.parametrize("ledger", [False, True], ids=["coins", "ledger"])
+def test_reclaimed_coin_pack_is_credited_once(db, monkeypatch, ledger):
+    monkeypatch.setattr(coin_ledger, "COIN_LEDGER_ENABLED", ledger)
+    monkeypatch.setattr(inbox, "INBOX_CLAIM_TIMEOUT", 0)  # a processing row is reclaimable at once
+    event = coin_pack("evt_reclaim", 77, 3001, 250)
+    assert inbox.store_event("stripe", event["id"], event["type"], event)
+
+    # the first run's mark-done never lands (a crash, or a handler slower than INBOX_CLAIM_TIMEOUT)
+    for attempt in (1, 2):
+        [(event_id, source, payload, attempts)] = inbox._claim(inbox.INBOX_BATCH)
+        assert (event_id, attempts) == ("evt_reclaim", attempt)
+        stripe_webhook.INBOX_HANDLERS[source](payload)
+
+    assert query("""
+        SELECT COALESCE((SELECT coins FROM veil_users WHERE user_id = 77 AND guild_id = 3001), 0)
+             + COALESCE((SELECT SUM(delta) FROM coin_ledger WHERE user_id = 77 AND guild_id = 3001), 0)
+    """) == [(250,)]
+    assert query("SELECT stripe_session_id, coins FROM coin_purchase_credits") == [("cs_evt_reclaim", 250)]
@@ -0,0 +1,79 @@
+"""
+maintenance.py's vote_events partitions against a scratch schema. Needs a
+Postgres to create schemas in:
+
+    BENCH_DATABASE_URL=postgresql://localhost/veil_bench python -m pytest tests
+"""
+import os
+import sys
+from datetime import date
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+pytestmark = pytest.mark.skipif(not os.getenv("BENCH_DATABASE_URL"),
+                                reason="set BENCH_DATABASE_URL to a scratch database")
+
+from common import scratch_schema  # noqa: E402
+
+import db_pool  # noqa: E402
+import maintenance  # noqa: E402
+
+DAY = 86400
+
+
+def query(sql, params=()):
+    with db_pool.get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute(sql, params)
+        return cur.fetchall() if cur.description else None
+
+
+def partitions():
+    with db_pool.get_db_conn() as conn, conn.cursor() as cur:
+        return [name for name, _, _ in maintenance._partitions(cur)]
+
+
+def vote(nonce, voted_at):
+    query("INSERT INTO vote_events (provider, user_id, guild_id, voted_at, nonce) VALUES ('topgg', 1, 1, %s, %s)",
+          (voted_at, nonce))
+
+
+@pytest.fixture
+def db():
+    with scratch_schema(maxconn=2) as name:
+        yield name
+
+
+def test_drops_expired_months_next_to_the_default_partition(db, monkeypatch):
+    # converted two years ago, then maintenance caught up to today
+    vote("legacy", "2024-06-15 00:00:00+00")
+    monkeypatch.setattr(maintenance, "_utc_today", lambda: date(2024, 6, 15))
+    maintenance.convert_to_partitions()
+    maintenance.ensure_partitions(1)
+    monkeypatch.undo()
+    maintenance.ensure_partitions()
+    vote("old", "2024-07-15 00:00:00+00")
+    vote("recent", maintenance._utc_today().isoformat() + " 00:00:00+00")
+    assert maintenance.DEFAULT_PARTITION in partitions()
+
+    removed = maintenance.drop_expired_partitions(retention=90 * DAY)
+
+    assert {"vote_events_legacy", "vote_events_y2024m07", "vote_events_y2024m08"} <= set(removed)
+    assert maintenance.partition_name(maintenance._month_start(maintenance._utc_today())) in partitions()
+    assert maintenance.DEFAULT_PARTITION in partitions()
+    assert query("SELECT nonce FROM vote_events ORDER BY nonce") == [("recent",)]
+    assert query("SELECT to_regclass('vote_events_y2024m07')") == [(None,)]
+
+
+def test_votes_for_a_missing_month_wait_in_the_default_partition(db):
+    maintenance.convert_to_partitions()
+    maintenance.ensure_partitions(0)
+    later = maintenance._month_start(maintenance._utc_today(), 5)
+    vote("early", f"{later.isoformat()} 12:00:00+00")
+    assert query("SELECT tableoid::regclass::text FROM vote_events") == [(maintenance.DEFAULT_PARTITION,)]
+
+    maintenance.ensure_partitions(5)
+
+    assert query("SELECT tableoid::regclass::text FROM vote_events") == [(maintenance.partition_name(later),)]
@@ -0,0 +1,285 @@
+"""
+Front stage for the Top.gg vote webhook (TOPGG_VOTE_GATE=1, the default).
+
+Top.gg retries deliveries and sends votes in bursts (weekends especially).
+Before a vote reaches Postgres or the inbox, each worker process:
+
+  - drops a repeat delivery for a user it let through less than
+    TOPGG_DEDUPE_WINDOW seconds ago. Top.gg takes one vote per user every
+    12 hours, so a second one that soon is a retry. A delivery that fails
+    (500) is forgotten, so Top.gg's retry of it gets through;
+  - drops a vote from a user whose last vote found no pending /vote
+    session, for TOPGG_NEGATIVE_TTL seconds; while the entitlements listener
+    is disconnected this cache is bypassed.
+
+Inserting a topgg_vote_sessions row notifies `v:<user>` on the entitlements
+listener, which forgets the user in both, so a vote that follows /vote is
+never dropped. Votes that get through are credited in micro-batches: the
+first waits up to TOPGG_BATCH_WINDOW seconds for others (at most
+TOPGG_BATCH_MAX) and credits them all with one statement in one transaction.
+If the batch fails, each vote is retried on its own statement. Batches only
+form from concurrent requests in one worker: gunicorn.conf.py runs gthread
+workers for that, and a server with one thread per worker should set
+TOPGG_BATCH_WINDOW=0.
+
+Dropped votes are answered 200 without a database round trip or a support
+post (the vote that found no session still posts its line). Counts are in
+/stats and /metrics (veil_vote_gate_*). TOPGG_BATCH_WINDOW=0 credits every
+vote on its own.
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import event_log
+import metrics
+from entitlements import watch
+
+TOPGG_VOTE_GATE = os.getenv("TOPGG_VOTE_GATE", "1").lower() not in ("0", "false", "no")
+TOPGG_DEDUPE_WINDOW = float(os.getenv("TOPGG_DEDUPE_WINDOW", "300"))
+TOPGG_NEGATIVE_TTL = float(os.getenv("TOPGG_NEGATIVE_TTL", "60"))
+TOPGG_GATE_MAX = int(os.getenv("TOPGG_GATE_MAX", "50000"))         # users remembered per map
+TOPGG_BATCH_WINDOW = float(os.getenv("TOPGG_BATCH_WINDOW", "0.01"))
+TOPGG_BATCH_MAX = int(os.getenv("TOPGG_BATCH_MAX", "100"))
+
+DUPLICATE = "duplicate"
+NO_SESSION = "no_session"
+
+
+class VoteGate:
+    def __init__(self, enabled=TOPGG_VOTE_GATE, window=TOPGG_DEDUPE_WINDOW, ttl=TOPGG_NEGATIVE_TTL,
+                 maxsize=TOPGG_GATE_MAX):
+        self.enabled = enabled
+        self.window = window
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.live = False            # set by the entitlements listener; until then no negative hits
+        self._seen = OrderedDict()   # user -> admitted until (monotonic)
+        self._empty = OrderedDict()  # user -> known to have no pending session until
+        self._lock = threading.Lock()
+        self._generation = 0         # bumped by every session notification
+        self._stats = {"admitted": 0, "duplicates": 0, "no_session_hits": 0, "no_session_cached": 0,
+                       "released": 0, "notifications": 0}
+
+    @staticmethod
+    def _put(data, key, until, maxsize):
+        data[key] = until
+        data.move_to_end(key)
+        while len(data) > maxsize:
+            data.popitem(last=False)
+
+    def admit(self, user_id: int):
+        """None to let the vote through (remembering the user), else DUPLICATE / NO_SESSION."""
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            if self._seen.get(user_id, 0) >= now:
+                self._stats["duplicates"] += 1
+                reason = DUPLICATE
+            elif self.live and self._empty.get(user_id, 0) >= now:
+                self._stats["no_session_hits"] += 1
+                reason = NO_SESSION
+            else:
+                self._stats["admitted"] += 1
+                self._put(self._seen, user_id, now + self.window, self.maxsize)
+                return None
+        metrics.inc("veil_topgg_absorbed_total", reason=reason)
+        return reason
+
+    def release(self, user_id: int):
+        """The admitted vote failed; let the sender's retry through."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._seen.pop(user_id, None) is not None:
+                self._stats["released"] += 1
+
+    def generation(self):
+        """Take before reading sessions; hand to no_session() afterwards."""
+        with self._lock:
+            return self._generation if self.live else None
+
+    def no_session(self, user_id: int, generation):
+        """Remember a user with no pending session -- unless a session arrived since generation()."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if generation is None or generation != self._generation or not self.live:
+                return
+            self._stats["no_session_cached"] += 1
+            self._put(self._empty, user_id, time.monotonic() + self.ttl, self.maxsize)
+
+    def apply(self, payload: str):
+        """`v:<user>` from the entitlements listener: that user now has a session, so let the next vote in."""
+        user = int(payload.partition(":")[2])
+        with self._lock:
+            self._generation += 1
+            self._stats["notifications"] += 1
+            self._empty.pop(user, None)
+            self._seen.pop(user, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._empty.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, enabled=self.enabled, live=self.live,
+                        seen=len(self._seen), no_session=len(self._empty))
+
+
+vote_gate = VoteGate()
+if TOPGG_VOTE_GATE:
+    watch("v", vote_gate)
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Micro-batches
+# ─────────────────────────────────────────────────────────────────────────────
+
+_batch_stats_lock = threading.Lock()
+_batch_stats = {"batches": 0, "batched_votes": 0, "largest_batch": 0, "batch_failures": 0}
+
+
+def _record_batch(size: int, failed: bool = False):
+    with _batch_stats_lock:
+        _batch_stats["batches"] += 1
+        _batch_stats["batched_votes"] += size
+        _batch_stats["largest_batch"] = max(_batch_stats["largest_batch"], size)
+        _batch_stats["batch_failures"] += failed
+
+
+class _Batch:
+    def __init__(self, coins: int, event=threading.Event):
+        self.coins = coins
+        self.users = set()
+        self.full = event()
+        self.done = event()
+        self.rows = None    # {user_id: row}, or None if the batch failed
+
+
+class VoteBatcher:
+    """
+    Groups concurrent vote credits. `credit_many(user_ids, coins)` credits a
+    batch in one transaction and returns {user_id: row}; `credit_one(user_id,
+    coins)` is the single statement used outside batches and after a failure.
+    """
+
+    def __init__(self, credit_many, credit_one, window=TOPGG_BATCH_WINDOW, maxsize=TOPGG_BATCH_MAX):
+        self.credit_many = credit_many
+        self.credit_one = credit_one
+        self.window = window
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._open = None
+
+    def credit(self, user_id: int, coins: int):
+        """credit_one's row for this user (None: no pending session)."""
+        if self.window <= 0:
+            return self.credit_one(user_id, coins)
+        with self._lock:
+            batch = self._open
+            if batch is not None and (batch.coins != coins or user_id in batch.users):
+                batch = None  # a user's votes never share a batch
+                leader = None
+            elif batch is None:
+                batch = self._open = _Batch(coins)
+                leader = True
+            else:
+                leader = False
+            if batch is not None:
+                batch.users.add(user_id)
+                if len(batch.users) >= self.maxsize:
+                    self._open = None
+                    batch.full.set()
+        if batch is None:
+            return self.credit_one(user_id, coins)
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._open is batch:
+                    self._open = None
+            try:
+                batch.rows = self.credit_many(batch.users, coins)
+            except Exception as e:
+                event_log.note(f"⚠️ [topgg] batch of {len(batch.users)} vote(s) failed, crediting one by one: {e}",
+                               error=True)
+            finally:
+                _record_batch(len(batch.users), failed=batch.rows is None)
+                batch.done.set()
+        else:
+            batch.done.wait()
+
+        if batch.rows is None:
+            return self.credit_one(user_id, coins)
+        return batch.rows.get(user_id)
+
+
+class AsyncVoteBatcher:
+    """VoteBatcher for one event loop; credit_many / credit_one are coroutines."""
+
+    def __init__(self, credit_many, credit_one, window=TOPGG_BATCH_WINDOW, maxsize=TOPGG_BATCH_MAX):
+        self.credit_many = credit_many
+        self.credit_one = credit_one
+        self.window = window
+        self.maxsize = maxsize
+        self._open = None
+
+    async def credit(self, user_id: int, coins: int):
+        if self.window <= 0:
+            return await self.credit_one(user_id, coins)
+        batch = self._open
+        if batch is not None and (batch.coins != coins or user_id in batch.users):
+            return await self.credit_one(user_id, coins)
+        leader = batch is None
+        if leader:
+            batch = self._open = _Batch(coins, asyncio.Event)
+        batch.users.add(user_id)
+        if len(batch.users) >= self.maxsize:
+            self._open = None
+            batch.full.set()
+
+        if leader:
+            try:
+                await asyncio.wait_for(batch.full.wait(), self.window)
+            except asyncio.TimeoutError:
+                pass
+            if self._open is batch:
+                self._open = None
+            try:
+                batch.rows = await self.credit_many(batch.users, coins)
+            except Exception as e:
+                event_log.note(f"⚠️ [topgg] batch of {len(batch.users)} vote(s) failed, crediting one by one: {e}",
+                               error=True)
+            finally:
+                _record_batch(len(batch.users), failed=batch.rows is None)
+                batch.done.set()
+        else:
+            await batch.done.wait()
+
+        if batch.rows is None:
+            return await self.credit_one(user_id, coins)
+        return batch.rows.get(user_id)
+
+
+def vote_gate_stats() -> dict:
+    with _batch_stats_lock:
+        out = dict(_batch_stats)
+    out["avg_batch"] = round(out["batched_votes"] / out["batches"], 2) if out["batches"] else 0.0
+    out.update(vote_gate.stats())
+    return out
+
+
+def _after_fork_in_child():
+    global _batch_stats_lock
+    _batch_stats_lock = threading.Lock()
+    vote_gate._lock = threading.Lock()
+    vote_gate.live = False
+    vote_gate.clear()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
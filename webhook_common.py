@@ -0,0 +1,110 @@
+"""
+Pieces shared by the sync (stripe_webhook) and async (stripe_webhook_async)
+entry points: price mappings, number formatting, and the exact Discord
+payloads / support-channel lines the bot expects.
+"""
+
+# Tier mapping
+tier_map = {
+    "price_1RuT1sADYgCtNnMoWMzdQ7YI": "basic",
+    "price_1RuT34ADYgCtNnModSx70nr1": "premium",
+    "price_1RuT3ZADYgCtNnMopSZon3vt": "elite",
+}
+
+# Coin packs (one-time purchases)
+coin_price_map = {
+    "price_1RuT5IADYgCtNnMorF0zsMRK": 100,   # $1
+    "price_1RuT5dADYgCtNnMoNY5O0cuc": 250,   # $2
+    "price_1RuT5yADYgCtNnMoWTUR4XMC": 500,   # $3
+    "price_1RuT6KADYgCtNnMoKwM3iw9H": 1000,  # $5
+}
+
+# Coins granted to every member of a guild per tier purchase/renewal (⛔ Elite gets none)
+bonus_amounts = {"basic": 250, "premium": 1000}
+
+TOPGG_VOTE_COINS = 15
+
+
+def fmt(n: int) -> str:
+    return f"{n:,}"
+
+def to_int_or_none(v):
+    try:
+        return int(v) if v is not None else None
+    except Exception:
+        return None
+
+def checkout_details(session) -> dict:
+    """What a checkout.session.completed payload says was bought, and for whom."""
+    md = session.get("metadata", {}) or {}
+    # Prefer metadata price_id; fall back to older structures if needed
+    price_id = md.get("price_id")
+    if not price_id:
+        # Legacy fallback (older Checkout flows)
+        line_items = session.get("display_items", [])
+        if line_items and isinstance(line_items, list):
+            price_id = line_items[0].get("price", {}).get("id")
+    # Coins for a coin pack: metadata.coins preferred, else price map
+    coins_from_meta = md.get("coins")
+    return {
+        "mode": session.get("mode"),  # "payment" (coins) or "subscription" (tiers)
+        "user_id": to_int_or_none(session.get("client_reference_id")),
+        "guild_id": to_int_or_none(md.get("guild_id")),
+        "price_id": price_id,
+        "tier": tier_map.get(price_id),
+        "subscription_id": session.get("subscription"),
+        "session_id": session.get("id"),  # ← used to look up interaction
+        "coins": to_int_or_none(coins_from_meta) if coins_from_meta else coin_price_map.get(price_id, 0),
+    }
+
+# ── support-channel lines; keep these formats EXACT so the bot's regexes match
+def upgrade_line(guild_id: int, tier: str) -> str:
+    return f"🎉 Guild {guild_id} upgraded to **{tier.title()}** tier!"
+
+def topgg_vote_line(user_id: int, guild_id: int, coins: int) -> str:
+    return f"[TOPGG_VOTE] user_id={user_id} guild_id={guild_id} coins={coins}"
+
+def coin_topup_line(session_id: str, user_id: int, guild_id: int, coins: int) -> str:
+    return f"[COIN_TOPUP] session_id={session_id} user_id={user_id} guild_id={guild_id} coins={coins}"
+
+def coin_unpatched_content(user_id: int, guild_id: int, coins: int, session_id: str) -> str:
+    return (f"🪙 Credited **+{coins}** to <@{user_id}> in guild `{guild_id}`, "
+            f"but no interaction found to patch (session `{session_id}`).")
+
+# ── interaction message edits
+def interaction_url(api_base: str, application_id, interaction_token: str) -> str:
+    return f"{api_base}/webhooks/{int(application_id)}/{interaction_token}/messages/@original"
+
+def topgg_vote_payload(coins: int, new_balance) -> dict:
+    coins_str = fmt(coins)
+    bal_str   = fmt(new_balance or 0)
+    return {
+        "embeds": [{
+            "title": "⭐ Thanks for voting on top.gg!",
+            "description": (
+                f"**+{coins_str} Veil Coins** have been added to your balance.\n\n"
+                f"New balance: **{bal_str}**"
+            ),
+            "color": 0xeeac00,
+            "footer": {"text": "You can vote again in 12 hours."}
+        }],
+        "components": []
+    }
+
+def coin_topup_payload(coins: int, new_balance) -> dict:
+    veilcoinemoji = "🪙"  # server-side fallback; custom emoji not available here
+    coins_str = fmt(coins)
+    bal_str   = fmt(new_balance or 0)
+    return {
+        "embeds": [{
+            "title": f"{veilcoinemoji} +{coins_str} Veil Coins Added",
+            "description": f"Thanks for your support! Your new balance is **{bal_str}**.",
+            "color": 0xeeac00,
+            "fields": [
+                {"name": "Amount",  "value": f"{veilcoinemoji} `{coins_str}`", "inline": True},
+                {"name": "Balance", "value": f"`{bal_str}`",                   "inline": True},
+            ],
+            "footer": {"text": "Tip: use /user any time to see your balance."}
+        }],
+        "components": []
+    }